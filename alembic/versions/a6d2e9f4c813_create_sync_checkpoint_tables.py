@@ -0,0 +1,41 @@
+"""create sync checkpoint tables
+
+Revision ID: a6d2e9f4c813
+Revises: f3c9a2d81b57
+Create Date: 2026-10-17 16:20:37.118402
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6d2e9f4c813'
+down_revision: Union[str, None] = 'f3c9a2d81b57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.create_table(
+        'sync_checkpoints',
+        sa.Column('account', sa.String(255), primary_key=True),
+        sa.Column('history_id', sa.String(32)),
+        sa.Column('page_token', sa.String),
+        sa.Column('last_msg_id', sa.String),
+        sa.Column('updated_at', sa.DateTime),
+    )
+    op.create_table(
+        'failed_messages',
+        sa.Column('account', sa.String(255), primary_key=True),
+        sa.Column('msg_id', sa.String(255), primary_key=True),
+        sa.Column('error', sa.Text),
+        sa.Column('attempts', sa.Integer),
+        sa.Column('failed_at', sa.DateTime),
+    )
+
+
+def downgrade():
+    op.drop_table('failed_messages')
+    op.drop_table('sync_checkpoints')
@@ -0,0 +1,40 @@
+"""create action outbox table
+
+Revision ID: b4e1d6a8c392
+Revises: c8f4e2a7d159
+Create Date: 2026-10-17 20:05:51.274630
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4e1d6a8c392'
+down_revision: Union[str, None] = 'c8f4e2a7d159'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.create_table(
+        'action_outbox',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('account', sa.String(255)),
+        sa.Column('msg_id', sa.String(255)),
+        sa.Column('add_label_ids', sa.String),
+        sa.Column('remove_label_ids', sa.String),
+        sa.Column('status', sa.String(16)),
+        sa.Column('attempts', sa.Integer),
+        sa.Column('error', sa.Text),
+        sa.Column('enqueued_at', sa.DateTime),
+        sa.Column('next_attempt_at', sa.DateTime),
+        sa.Column('done_at', sa.DateTime),
+    )
+    op.create_index('ix_action_outbox_status_next_attempt_at', 'action_outbox', ['status', 'next_attempt_at'])
+
+
+def downgrade():
+    op.drop_index('ix_action_outbox_status_next_attempt_at', table_name='action_outbox')
+    op.drop_table('action_outbox')
@@ -0,0 +1,30 @@
+"""create sync state table
+
+Revision ID: b8aee7063f38
+Revises: 27ecb06f3df6
+Create Date: 2026-10-17 09:12:41.503118
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8aee7063f38'
+down_revision: Union[str, None] = '27ecb06f3df6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.create_table(
+        'sync_state',
+        sa.Column('account', sa.String(255), primary_key=True),
+        sa.Column('history_id', sa.String(32), nullable=False),
+        sa.Column('updated_at', sa.DateTime, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('sync_state')
@@ -0,0 +1,60 @@
+"""add email body search
+
+Revision ID: c8f4e2a7d159
+Revises: a6d2e9f4c813
+Create Date: 2026-10-17 18:42:09.561027
+
+"""
+import re
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'c8f4e2a7d159'
+down_revision: Union[str, None] = 'a6d2e9f4c813'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# the text search configuration of content_tsv and the words of email_terms, as in models.email
+TEXT_SEARCH_CONFIG = 'simple'
+TERM_RE = re.compile(r'[^\W_]+')
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        # the inverted index of the bodies where the database has no full-text search, filled as emails
+        # are upserted. PostgreSQL searches content_tsv instead, so it has no use for the table
+        op.create_table(
+            'email_terms',
+            sa.Column('term', sa.String, primary_key=True),
+            sa.Column('msg_id', sa.String(255), primary_key=True),
+            sqlite_with_rowid=False,
+        )
+        op.create_index('ix_email_terms_msg_id', 'email_terms', ['msg_id'])
+        email_terms = sa.table('email_terms', sa.column('term'), sa.column('msg_id'))
+        bodies = bind.execute(sa.text('SELECT msg_id, content FROM emails WHERE content IS NOT NULL')).all()
+        for msg_id, content in bodies:
+            rows = [{'term': term, 'msg_id': msg_id} for term in set(TERM_RE.findall(content.lower()))]
+            if rows:
+                op.bulk_insert(email_terms, rows)
+        return
+
+    # a stored generated column is computed for every existing row, which rewrites the table under a lock
+    op.execute(f"ALTER TABLE emails ADD COLUMN content_tsv tsvector "
+               f"GENERATED ALWAYS AS (to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(content, ''))) STORED")
+    # CONCURRENTLY keeps the table writable while the index builds, but cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_emails_content_tsv', 'emails', ['content_tsv'], postgresql_using='gin',
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_emails_content_tsv', table_name='emails')
+        op.drop_column('emails', 'content_tsv')
+    else:
+        op.drop_index('ix_email_terms_msg_id', table_name='email_terms')
+        op.drop_table('email_terms')
@@ -0,0 +1,40 @@
+"""add email rule indexes
+
+Revision ID: d41f7c2a9e06
+Revises: b8aee7063f38
+Create Date: 2026-10-17 11:03:27.914350
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41f7c2a9e06'
+down_revision: Union[str, None] = 'b8aee7063f38'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# columns the rules filter with contains, i.e. LIKE '%value%'
+TRIGRAM_COLUMNS = ('sender', 'subject', 'recipient', 'cc')
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        op.create_index('ix_emails_date_received', 'emails', ['date_received'])
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # CONCURRENTLY keeps the table writable while the indexes build, but cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_emails_date_received', 'emails', ['date_received'], postgresql_concurrently=True)
+        for column in TRIGRAM_COLUMNS:
+            op.create_index(f'ix_emails_{column}_trgm', 'emails', [column], postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'}, postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for column in TRIGRAM_COLUMNS:
+            op.drop_index(f'ix_emails_{column}_trgm', table_name='emails')
+    op.drop_index('ix_emails_date_received', table_name='emails')
@@ -0,0 +1,73 @@
+"""key emails by account
+
+Revision ID: d9a5f1c3e7b2
+Revises: b4e1d6a8c392
+Create Date: 2026-10-17 21:14:37.820516
+
+"""
+import re
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'd9a5f1c3e7b2'
+down_revision: Union[str, None] = 'b4e1d6a8c392'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# the words of email_terms, as in models.email
+TERM_RE = re.compile(r'[^\W_]+')
+# names the unique constraint of emails.msg_id, which the create_table of 27ecb06f3df6 left unnamed, so that
+# the batch can drop it on SQLite. PostgreSQL named it itself
+NAMING_CONVENTION = {'uq': 'uq_%(table_name)s_%(column_0_name)s'}
+
+
+def _msg_id_unique_name():
+    return 'emails_msg_id_key' if op.get_bind().dialect.name == 'postgresql' else 'uq_emails_msg_id'
+
+
+def upgrade():
+    # a message ID is only unique within a mailbox, so the upserts conflict on (account, msg_id), with ''
+    # standing for the emails stored without an account
+    op.execute("UPDATE emails SET account = '' WHERE account IS NULL")
+    with op.batch_alter_table('emails', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.alter_column('account', existing_type=sa.String, nullable=False, server_default='')
+        batch_op.drop_constraint(_msg_id_unique_name(), type_='unique')
+        batch_op.create_unique_constraint('uq_emails_account_msg_id', ['account', 'msg_id'])
+
+    if op.get_bind().dialect.name != 'postgresql':
+        # the terms of the bodies are keyed the same way. They are only derived from the bodies, so the table
+        # is built again rather than altered, as for c8f4e2a7d159
+        _create_email_terms(['account', 'msg_id'])
+
+
+def downgrade():
+    # fails while two accounts hold the same message ID, as the emails table can no longer tell them apart
+    with op.batch_alter_table('emails', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint('uq_emails_account_msg_id', type_='unique')
+        batch_op.create_unique_constraint(_msg_id_unique_name(), ['msg_id'])
+        batch_op.alter_column('account', existing_type=sa.String, nullable=True, server_default=None)
+    op.execute("UPDATE emails SET account = NULL WHERE account = ''")
+
+    if op.get_bind().dialect.name != 'postgresql':
+        _create_email_terms(['msg_id'])
+
+
+def _create_email_terms(key):
+    # replaces email_terms with a table keyed by term and the given emails columns, filled from the bodies
+    op.drop_table('email_terms')
+    op.create_table(
+        'email_terms',
+        sa.Column('term', sa.String, primary_key=True),
+        *(sa.Column(column, sa.String(255), primary_key=True) for column in key),
+        sqlite_with_rowid=False,
+    )
+    op.create_index(f"ix_email_terms_{'_'.join(key)}", 'email_terms', key)
+    email_terms = sa.table('email_terms', sa.column('term'), *(sa.column(column) for column in key))
+    bodies = op.get_bind().execute(sa.text(f"SELECT {', '.join(key)}, content FROM emails WHERE content IS NOT NULL"))
+    for *values, content in bodies.all():
+        rows = [dict(zip(key, values), term=term) for term in set(TERM_RE.findall(content.lower()))]
+        if rows:
+            op.bulk_insert(email_terms, rows)
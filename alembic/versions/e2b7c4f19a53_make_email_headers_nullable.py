@@ -0,0 +1,34 @@
+"""make email headers nullable
+
+Revision ID: e2b7c4f19a53
+Revises: e7a3c5b1f924
+Create Date: 2026-10-17 14:02:51.508217
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2b7c4f19a53'
+down_revision: Union[str, None] = 'e7a3c5b1f924'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# headers a message may lack, e.g. To on Bcc-only mail, which are then stored as NULL
+HEADER_COLUMNS = {'subject': sa.String(255), 'sender': sa.String(255), 'recipient': sa.String(255),
+                  'date_received': sa.DateTime}
+
+
+def upgrade():
+    # SQLite cannot alter a column in place, the batch copies the table instead
+    with op.batch_alter_table('emails') as batch_op:
+        for column, type_ in HEADER_COLUMNS.items():
+            batch_op.alter_column(column, existing_type=type_, nullable=True)
+
+
+def downgrade():
+    with op.batch_alter_table('emails') as batch_op:
+        for column, type_ in HEADER_COLUMNS.items():
+            batch_op.alter_column(column, existing_type=type_, nullable=False)
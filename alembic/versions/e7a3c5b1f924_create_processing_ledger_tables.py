@@ -0,0 +1,39 @@
+"""create processing ledger tables
+
+Revision ID: e7a3c5b1f924
+Revises: d41f7c2a9e06
+Create Date: 2026-10-17 13:26:08.471902
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7a3c5b1f924'
+down_revision: Union[str, None] = 'd41f7c2a9e06'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.create_table(
+        'rule_set_runs',
+        sa.Column('rule_set_hash', sa.String(64), primary_key=True),
+        sa.Column('rules_file_path', sa.String(255)),
+        sa.Column('watermark', sa.DateTime),
+        sa.Column('last_run_at', sa.DateTime, nullable=False),
+    )
+    op.create_table(
+        'applied_actions',
+        sa.Column('rule_set_hash', sa.String(64), primary_key=True),
+        sa.Column('msg_id', sa.String(255), primary_key=True),
+        sa.Column('actions', sa.Text, nullable=False),
+        sa.Column('applied_at', sa.DateTime, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('applied_actions')
+    op.drop_table('rule_set_runs')
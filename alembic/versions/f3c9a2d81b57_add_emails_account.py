@@ -0,0 +1,27 @@
+"""add emails account
+
+Revision ID: f3c9a2d81b57
+Revises: e2b7c4f19a53
+Create Date: 2026-10-17 15:02:41.305518
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3c9a2d81b57'
+down_revision: Union[str, None] = 'e2b7c4f19a53'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.add_column('emails', sa.Column('account', sa.String))
+    op.create_index('ix_emails_account', 'emails', ['account'])
+
+
+def downgrade():
+    op.drop_index('ix_emails_account', table_name='emails')
+    op.drop_column('emails', 'account')
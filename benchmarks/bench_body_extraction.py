@@ -0,0 +1,121 @@
+"""
+bench_body_extraction.py
+
+Compares the body extraction of body_extractor with the BeautifulSoup path it replaced, over a corpus of
+synthetic message resources: throughput, Python heap peak (tracemalloc) and growth of the resident set,
+which also covers the memory lxml allocates outside the Python heap. Each extractor runs in its own process.
+
+Usage:
+    python -m benchmarks.bench_body_extraction --messages 2000
+
+"""
+
+import argparse
+import base64
+import multiprocessing
+import random
+import resource
+import time
+import tracemalloc
+
+from email_manager.body_extractor import extract_body
+
+WORDS = ('invoice', 'meeting', 'quarterly', 'report', 'unsubscribe', 'offer', 'security', 'alert', 'shipping',
+         'update', 'newsletter', 'team', 'weekly', 'digest', 'password', 'account')
+
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def synthetic_messages(count, seed=0):
+    """
+    Builds message resources shaped like messages.get returns them: a multipart/alternative with the
+    HTML version first, which the old path relied on, and a plain text version for half of them.
+
+    Yields:
+        dict: A message resource.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        paragraphs = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(10, 80)))
+                      for _ in range(rng.randint(1, 60))]
+        html = ('<html><head><style>td {padding: 4px}</style></head><body><table><tr><td>'
+                + ''.join(f'<p class="c{n}">{text} &amp; <a href="https://example.com/{n}">more</a></p>'
+                          for n, text in enumerate(paragraphs))
+                + '</td></tr></table></body></html>')
+        parts = [{'mimeType': 'text/html', 'filename': '', 'body': {'size': len(html), 'data': encode(html)}}]
+        if i % 2:
+            plain = '\n\n'.join(paragraphs)
+            parts.append({'mimeType': 'text/plain', 'filename': '', 'body': {'size': len(plain), 'data': encode(plain)}})
+        headers = [{'name': 'Subject', 'value': f'{rng.choice(WORDS)} {rng.choice(WORDS)} #{i}'},
+                   {'name': 'From', 'value': f'{rng.choice(WORDS)}@example.com'},
+                   {'name': 'To', 'value': 'me@example.com'},
+                   {'name': 'Date', 'value': 'Sat, 23 Mar 2024 10:00:00 +0000'}]
+        yield {'id': f'msg{i:07d}', 'sizeEstimate': len(html) * 2,
+               'payload': {'mimeType': 'multipart/alternative', 'headers': headers, 'parts': parts}}
+
+
+def extract_with_beautifulsoup(payload):
+    # the body parsing EmailManager._parse_message did before body_extractor
+    from bs4 import BeautifulSoup
+    parts = payload.get('parts')[0]
+    data = parts['body']['data'].replace("-", "+").replace("_", "/")
+    decoded_data = base64.b64decode(data + '=' * (-len(data) % 4))
+    soup = BeautifulSoup(decoded_data, "lxml")
+    return str(soup.body())
+
+
+EXTRACTORS = {
+    'beautifulsoup': extract_with_beautifulsoup,
+    'body_extractor': extract_body,
+}
+
+
+def measure(name, count, sample):
+    extract = EXTRACTORS[name]
+    messages = list(synthetic_messages(count))
+    encoded = sum(len(part['body']['data']) for message in messages for part in message['payload']['parts'])
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    failed = stored = 0
+    for message in messages:
+        try:
+            stored += len(extract(message['payload']))
+        except Exception:
+            failed += 1
+    elapsed = time.perf_counter() - started
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+    # tracemalloc slows allocations down a lot, so the heap is only traced over a sample
+    tracemalloc.start()
+    for message in messages[:sample]:
+        try:
+            extract(message['payload'])
+        except Exception:
+            pass
+    _, heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, encoded, stored, failed, heap_peak, rss_growth * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000, help='number of synthetic messages')
+    parser.add_argument('--sample', type=int, default=100, help='number of messages the heap is traced over')
+    args = parser.parse_args()
+
+    print(f"{'extractor':16} {'messages/s':>11} {'MB/s':>7} {'stored MB':>10} {'failed':>7} "
+          f"{'heap peak MB':>13} {'RSS growth MB':>14}")
+    context = multiprocessing.get_context('spawn')
+    for name in EXTRACTORS:
+        with context.Pool(1) as pool:
+            result = pool.apply(measure, (name, args.messages, args.sample))
+        elapsed, encoded, stored, failed, heap_peak, rss_growth = result
+        print(f"{name:16} {args.messages / elapsed:11,.0f} {encoded / elapsed / 1e6:7.1f} {stored / 1e6:10.1f} "
+              f"{failed:7d} {heap_peak / 1e6:13.1f} {rss_growth / 1e6:14.1f}")
+
+
+if __name__ == '__main__':
+    main()
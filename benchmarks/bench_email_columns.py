@@ -0,0 +1,57 @@
+"""
+bench_email_columns.py
+
+Measures the throughput of evaluating rule files in memory with EmailColumns, in rules x emails
+evaluated per millisecond. The emails are synthetic and never touch a database.
+
+Usage:
+    python -m benchmarks.bench_email_columns --emails 1000000
+
+"""
+
+import argparse
+import statistics
+import time
+
+from benchmarks.bench_rule_filter import synthetic_rows
+from rule_engine.email_columns import EmailColumns
+from rule_engine.rule_engine import RuleEngine
+
+COLUMNS = ('sender', 'subject', 'recipient', 'cc', 'date_received')
+
+
+def build_email_columns(count):
+    values = dict((name, []) for name in ('msg_id',) + COLUMNS)
+    for row in synthetic_rows(count):
+        for name in values:
+            values[name].append(row[name])
+    return EmailColumns(values.pop('msg_id'), values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('rules_files', nargs='*', default=['rules/mark_as_read_rule.json', 'rules/move_yt_or_mani.json'],
+                        help='rule files to evaluate')
+    parser.add_argument('--emails', type=int, default=1000000, help='number of synthetic emails')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per rule file; the median is reported')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    email_columns = build_email_columns(args.emails)
+    print(f"built {args.emails} emails in memory in {time.perf_counter() - started:.1f}s")
+
+    print(f"{'rules':40} {'rules':>5} {'matches':>8} {'time':>10} {'rules x emails/ms':>18}")
+    for path in args.rules_files:
+        rule_engine = RuleEngine(path)
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            matches = rule_engine.evaluate(email_columns)
+            timings.append(time.perf_counter() - started)
+        elapsed = statistics.median(timings)
+        throughput = len(rule_engine.rules) * args.emails / (elapsed * 1000)
+        print(f"{path:40} {len(rule_engine.rules):5d} {len(matches):8d} {elapsed * 1000:8.1f}ms {throughput:18,.0f}")
+
+
+if __name__ == '__main__':
+    main()
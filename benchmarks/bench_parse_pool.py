@@ -0,0 +1,55 @@
+"""
+bench_parse_pool.py
+
+Measures how parsing synthetic message resources scales with the number of ParsePool processes,
+against parsing them in the calling process. Messages are parsed a list page at a time, the way a
+sync hands them over, on one pool started for the whole run as a sync does. Pool start-up is
+included in the timings, as it is part of every sync.
+
+Usage:
+    python -m benchmarks.bench_parse_pool --messages 5000 --processes 1 2 4 8
+
+"""
+
+import argparse
+import logging
+import os
+import time
+
+from benchmarks.bench_body_extraction import synthetic_messages
+from email_manager.parse_pool import ParsePool, parse_chunk
+from logger import logger
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000, help='number of synthetic messages')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8], help='pool sizes to time')
+    parser.add_argument('--chunk-size', type=int, default=100, help='messages sent to a worker at a time')
+    parser.add_argument('--page-size', type=int, default=100, help='messages handed to the pool per parse')
+    args = parser.parse_args()
+    # the per-message logging would dominate the timings
+    logger.setLevel(logging.WARNING)
+
+    messages = list(synthetic_messages(args.messages))
+    pages = [messages[start:start + args.page_size] for start in range(0, len(messages), args.page_size)]
+    print(f"{args.messages} messages in pages of {args.page_size}, {os.cpu_count()} CPUs")
+
+    started = time.perf_counter()
+    for page in pages:
+        parse_chunk(page)
+    baseline = time.perf_counter() - started
+    print(f"{'processes':>10} {'messages/s':>11} {'speedup':>8}")
+    print(f"{'in-process':>10} {args.messages / baseline:11,.0f} {1:8.2f}")
+
+    for processes in args.processes:
+        started = time.perf_counter()
+        with ParsePool(workers=processes, chunk_size=args.chunk_size) as pool:
+            count = sum(1 for page in pages for _ in pool.parse(page))
+        elapsed = time.perf_counter() - started
+        assert count == args.messages
+        print(f"{processes:10d} {args.messages / elapsed:11,.0f} {baseline / elapsed:8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+bench_rule_filter.py
+
+Measures how long RuleEngine.filter takes over a large emails table with and without the indexes
+declared on the Email model: the B-tree index on date_received and, on PostgreSQL, the pg_trgm GIN
+indexes serving `contains` predicates.
+
+The rows are seeded into the emails table of DATABASE_URL, which must be empty; point it at a
+scratch database. The seeded rows are deleted again when the benchmark ends.
+
+Usage:
+    DATABASE_URL=postgresql://localhost/gmail_bench python -m benchmarks.bench_rule_filter --rows 1000000
+
+"""
+
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from models.email import Base, Email, session
+from rule_engine.rule_engine import RuleEngine
+
+WORDS = ['alert', 'invoice', 'meeting', 'weekly', 'report', 'security', 'newsletter', 'offer', 'update',
+         'reminder', 'receipt', 'order', 'shipped', 'welcome', 'digest', 'happyfox', 'youtube', 'review']
+DOMAINS = ['accounts.google.com', 'youtube.com', 'github.com', 'example.com', 'mail.example.org',
+           'happyfox.com', 'news.example.net', 'shop.example.com']
+
+
+def synthetic_rows(count, seed=0):
+    rng = random.Random(seed)
+    now = datetime.now()
+    for i in range(count):
+        yield {
+            'msg_id': f'bench{i:08d}',
+            'sender': f'{rng.choice(WORDS)}{rng.randrange(1000)}@{rng.choice(DOMAINS)}',
+            'subject': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))),
+            'recipient': f'user{rng.randrange(100)}@example.com',
+            'cc': None,
+            'content': '',
+            'date_received': now - timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+            'synced_at': now,
+        }
+
+
+def seed(count, chunk_size=10000):
+    rows = synthetic_rows(count)
+    for start in range(0, count, chunk_size):
+        session.execute(insert(Email), [next(rows) for _ in range(min(chunk_size, count - start))])
+        session.commit()
+
+
+def analyze(bind):
+    # refresh the planner statistics so that it actually considers the indexes
+    with bind.connect() as conn:
+        conn.exec_driver_sql('ANALYZE emails')
+        conn.commit()
+
+
+def time_filter(rule_engine, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rule_engine.filter()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), len(rule_engine.filtered_email_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('rules_files', nargs='*', default=['rules/mark_as_read_rule.json', 'rules/move_yt_or_mani.json'],
+                        help='rule files to filter with')
+    parser.add_argument('--rows', type=int, default=1000000, help='number of synthetic emails to seed')
+    parser.add_argument('--repeat', type=int, default=5, help='filter runs per rule file and mode; the median is reported')
+    args = parser.parse_args()
+
+    bind = session.get_bind()
+    Base.metadata.create_all(bind)
+    if session.query(Email.msg_id).first() is not None:
+        parser.error('the emails table is not empty, point DATABASE_URL at a scratch database')
+
+    rule_engines = [RuleEngine(path) for path in args.rules_files]
+    indexes = sorted(Email.__table__.indexes, key=lambda index: index.name)
+    try:
+        started = time.perf_counter()
+        seed(args.rows)
+        print(f"seeded {args.rows} emails on {bind.dialect.name} in {time.perf_counter() - started:.1f}s")
+
+        results = {}
+        for indexed in (False, True):
+            for index in indexes:
+                if indexed:
+                    index.create(bind, checkfirst=True)
+                else:
+                    index.drop(bind, checkfirst=True)
+            analyze(bind)
+            for path, rule_engine in zip(args.rules_files, rule_engines):
+                results[path, indexed] = time_filter(rule_engine, args.repeat)
+    finally:
+        session.rollback()
+        session.query(Email).filter(Email.msg_id.like('bench%')).delete(synchronize_session=False)
+        session.commit()
+
+    print(f"{'rules':40} {'matches':>8} {'no index':>10} {'indexed':>10} {'speedup':>8}")
+    for path in args.rules_files:
+        (unindexed, matches), (indexed, _) = results[path, False], results[path, True]
+        print(f"{path:40} {matches:8d} {unindexed * 1000:8.1f}ms {indexed * 1000:8.1f}ms {unindexed / indexed:7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
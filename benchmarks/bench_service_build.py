@@ -0,0 +1,60 @@
+"""
+bench_service_build.py
+
+Measures what building the Gmail service object costs per action, comparing the old behaviour of
+building it on every call with the cached EmailManager.service. Actions run against the local fake
+Gmail server, so the numbers are client overhead plus loopback latency only.
+
+Usage:
+    python -m benchmarks.bench_service_build --actions 200
+
+"""
+
+import argparse
+import time
+from unittest.mock import patch
+
+from google.auth.credentials import AnonymousCredentials
+
+from email_manager.email_manager import EmailManager
+from email_manager.tests.fake_gmail_server import FakeGmailServer, make_message
+
+
+def time_builds(email_manager, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        email_manager._build_service()
+    return (time.perf_counter() - started) / count
+
+
+def time_actions(email_manager, msg_ids, rebuild):
+    started = time.perf_counter()
+    for msg_id in msg_ids:
+        if rebuild:
+            email_manager._service = None
+        email_manager.mark_as_read(msg_id)
+    return (time.perf_counter() - started) / len(msg_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--actions', type=int, default=200, help='number of mark_as_read calls per mode')
+    args = parser.parse_args()
+
+    msg_ids = [f'msg{i:05d}' for i in range(args.actions)]
+    with FakeGmailServer([make_message(msg_id) for msg_id in msg_ids]) as server, \
+            patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+        email_manager = EmailManager(api_endpoint=server.url)
+
+        build = time_builds(email_manager, 20)
+        rebuilt = time_actions(email_manager, msg_ids, rebuild=True)
+        cached = time_actions(email_manager, msg_ids, rebuild=False)
+
+    print(f"service build (static discovery): {build * 1000:8.2f} ms")
+    print(f"mark_as_read, build per call:     {rebuilt * 1000:8.2f} ms/action")
+    print(f"mark_as_read, cached service:     {cached * 1000:8.2f} ms/action")
+    print(f"speedup:                          {rebuilt / cached:8.1f}x over {args.actions} actions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+bench_suite.py
+
+Runs end-to-end driver.process_rule_json scenarios: a sync of a synthetic mailbox served by the local
+fake Gmail server, the rule filter and the batchModify calls of its actions. Scenarios vary the fetch
+threads, parse processes, network latency, error rate and quota. For each one the throughput, the
+p50/p99 of every timer the code reports (Gmail calls by method, parsing, database statements, rules)
+and the peak RSS are recorded to a JSON file, which serves as the baseline of later runs: given
+--baseline, the results are compared against it and the exit status is 1 when a scenario got slower
+or bigger by more than --tolerance.
+
+Each scenario syncs into a fresh database, a temporary SQLite file unless --database-url is given, and
+runs in a process of its own so that its peak RSS is its own. The fake server runs in this process.
+A --database-url database must be empty: the tables are created before and dropped after every
+scenario.
+
+Usage:
+    python -m benchmarks.bench_suite --messages 10000 --output baseline.json
+    python -m benchmarks.bench_suite --messages 10000 --baseline baseline.json
+    python -m benchmarks.bench_suite --database-url postgresql://localhost/gmail_bench --scenarios workers
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.synthetic_mailbox import SyntheticMailbox
+from email_manager.tests.fake_gmail_server import FakeGmailServer
+
+# the knobs of each scenario: fetch threads and parse processes of the client, and the fake server's
+# latency per request, fraction of gets failing with 503 and per-user quota in units per second
+SCENARIOS = {
+    'serial': {'workers': 1},
+    'workers': {'workers': 8},
+    'parse_workers': {'workers': 8, 'parse_workers': 2},
+    'latency': {'workers': 8, 'latency': 0.02},
+    'errors': {'workers': 8, 'error_rate': 0.01},
+    # list calls are not retried on 429, so this one fails when the quota runs out at the wrong time
+    'quota': {'workers': 8, 'quota_units_per_second': 10000},
+}
+DEFAULT_SCENARIOS = ['serial', 'workers', 'parse_workers', 'latency', 'errors']
+RULES = {
+    'collection_predicate': 'any',
+    'rules': [
+        {'field_name': 'subject', 'predicate': 'contains', 'value': 'Invoice'},
+        {'field_name': 'from', 'predicate': 'contains', 'value': 'billing'},
+    ],
+    'actions': [{'action_name': 'mark_as_read'}, {'action_name': 'move_to_label', 'action_value': 'Finance'}],
+}
+# p99s estimated from fewer timings than this are too noisy to compare
+MIN_TIMINGS = 100
+
+
+def run_scenario(config):
+    """
+    Runs a scenario in a spawned process. The database URL is set before the models are imported, as
+    the session is bound when they are.
+
+    Returns:
+        dict: The measurements of the scenario.
+    """
+    os.environ['DATABASE_URL'] = config['database_url']
+    from unittest.mock import patch
+
+    from google.auth.credentials import AnonymousCredentials
+
+    import driver
+    from email_manager.email_manager import EmailManager
+    from instrumentation import metrics
+    from logger import configure
+    from models.email import Base, Email, session
+
+    configure(logging.WARNING)
+    bind = session.get_bind()
+    Base.metadata.create_all(bind)
+    try:
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            started = time.perf_counter()
+            driver.process_rule_json(config['rules_file'], workers=config.get('workers', 1),
+                                     parse_workers=config.get('parse_workers'), api_endpoint=config['server_url'])
+            elapsed = time.perf_counter() - started
+        emails = session.query(Email).count()
+    finally:
+        session.close()
+        if config['drop_tables']:
+            Base.metadata.drop_all(bind)
+
+    snapshot = metrics.snapshot()
+    counters = dict((_series(s), s['value']) for s in snapshot['counters'])
+    sync_seconds = next(s['sum'] for s in snapshot['timers'] if s['name'] == 'sync_seconds')
+    return {
+        'seconds': elapsed,
+        'sync_seconds': sync_seconds,
+        'throughput': config['messages'] / elapsed,
+        'sync_throughput': config['messages'] / sync_seconds,
+        'emails': emails,
+        'emails_modified': counters.get('emails_modified_total', 0),
+        'api_calls': dict((series, value) for series, value in counters.items()
+                          if series.startswith('gmail_api_calls_total')),
+        'latency': dict((_series(s), {'count': s['count'], 'p50': s['p50'], 'p99': s['p99'], 'max': s['max']})
+                        for s in snapshot['timers']),
+        # kilobytes on Linux, bytes on macOS
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin'
+                                                                             else 2 ** 10),
+    }
+
+
+def _series(series):
+    labels = ','.join(f'{key}={value}' for key, value in sorted(series['labels'].items()))
+    return f"{series['name']}{{{labels}}}" if labels else series['name']
+
+
+def run_suite(scenarios, messages, database_url=None, seed=0, page_size=100):
+    """
+    Runs the given scenarios one after the other.
+
+    Returns:
+        dict: The run: its settings and, for each scenario, its measurements or the error it failed with.
+    """
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'messages': messages,
+        'database': database_url.split(':', 1)[0] if database_url else 'sqlite',
+        'scenarios': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rules_file = os.path.join(tmp_dir, 'rules.json')
+        with open(rules_file, 'w') as f:
+            json.dump(RULES, f)
+
+        for name in scenarios:
+            settings = SCENARIOS[name]
+            mailbox = SyntheticMailbox(messages, seed=seed)
+            with FakeGmailServer(mailbox, page_size=page_size, error_rate=settings.get('error_rate', 0),
+                                 quota_units_per_second=settings.get('quota_units_per_second'),
+                                 seed=seed) as server:
+                server.latency = settings.get('latency', 0)
+                server.labels.append({'id': 'Label_1', 'name': 'Finance', 'type': 'user'})
+                config = dict(settings, messages=messages, rules_file=rules_file, server_url=server.url,
+                              database_url=database_url or f"sqlite:///{os.path.join(tmp_dir, f'{name}.db')}",
+                              drop_tables=database_url is not None)
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    try:
+                        result = executor.submit(run_scenario, config).result()
+                    except Exception as e:
+                        result = {'error': f'{type(e).__name__}: {e}'}
+                result.update(settings=settings, http_requests=server.http_requests,
+                              errors_injected=server.errors_injected, quota_rejections=server.quota_rejections)
+            results['scenarios'][name] = result
+            print_result(name, result)
+    return results
+
+
+def print_result(name, result):
+    if 'error' in result:
+        print(f"{name:>14} failed: {result['error']}")
+        return
+    batch = result['latency'].get('gmail_api_seconds{method=batch}', {})
+    print(f"{name:>14} {result['throughput']:9,.0f} msg/s {result['seconds']:8.2f}s "
+          f"batch p50 {(batch.get('p50') or 0) * 1000:7.1f}ms p99 {(batch.get('p99') or 0) * 1000:7.1f}ms "
+          f"rss {result['peak_rss_mb']:7.1f}MB {result['emails']:>8} emails {result['http_requests']:>6} requests")
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares a run against a baseline run: throughput must not drop, and peak RSS and the p99 of the
+    timers must not grow, by more than `tolerance` (a fraction).
+
+    Returns:
+        list: A description of each regression.
+    """
+    if results['messages'] != baseline['messages']:
+        print(f"warning: the baseline synced {baseline['messages']} messages, this run {results['messages']}")
+    regressions = []
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None or 'error' in result or 'error' in before:
+            continue
+        checks = [('throughput', result['throughput'], before['throughput'], False),
+                  ('peak_rss_mb', result['peak_rss_mb'], before['peak_rss_mb'], True)]
+        for series, latency in result['latency'].items():
+            previous = before['latency'].get(series)
+            if previous is not None and min(latency['count'], previous['count']) >= MIN_TIMINGS:
+                checks.append((f'{series} p99', latency['p99'], previous['p99'], True))
+        for metric, now, then, higher_is_worse in checks:
+            if not then:
+                continue
+            change = (now - then) / then
+            if (change > tolerance) if higher_is_worse else (change < -tolerance):
+                regressions.append(f"{name}: {metric} {then:.4g} -> {now:.4g} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10000, help='number of messages in the synthetic mailbox')
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=DEFAULT_SCENARIOS,
+                        help='scenarios to run')
+    parser.add_argument('--database-url', help='an empty database to sync into, instead of temporary SQLite files')
+    parser.add_argument('--seed', type=int, default=0, help='picks the synthetic mailbox')
+    parser.add_argument('--page-size', type=int, default=100, help='message IDs per messages.list page')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='fraction a measurement may worsen by')
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages, {os.cpu_count()} CPUs")
+    results = run_suite(args.scenarios, args.messages, database_url=args.database_url, seed=args.seed,
+                        page_size=args.page_size)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regression beyond {args.tolerance:.0%}")
+
+
+if __name__ == '__main__':
+    main()
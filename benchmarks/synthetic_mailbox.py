@@ -0,0 +1,228 @@
+"""
+synthetic_mailbox.py
+
+Generates large, reproducible mailboxes for the benchmarks to serve from the fake Gmail server. Messages
+look like real mail: display names, mailing list and reply subjects, RFC 2047 encoded words, dates over
+two years in several time zones, the transport headers real messages carry, and MIME trees from a lone
+text/plain part to multipart/mixed with a multipart/alternative body and an attachment.
+
+Classes:
+    SyntheticMailbox: A mailbox of synthetic messages, generated on demand from their index.
+
+Functions:
+    synthetic_message: Builds the message resource of the given index.
+
+"""
+
+import base64
+import random
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta, timezone
+from email.header import Header
+from email.utils import format_datetime
+
+FIRST_NAMES = ('Alice', 'Bob', 'Chandra', 'Dmitri', 'Elena', 'Farah', 'Gustavo', 'Hiro', 'Ines', 'José',
+               'Kavya', 'Liam', 'Mei', 'Noah', 'Olga', 'Priya', 'Quentin', 'Rosa', 'Sven', 'Zoë')
+LAST_NAMES = ('Anand', 'Berg', 'Chen', 'Dubois', 'Erikson', 'Fischer', 'García', 'Haddad', 'Ito', 'Jones',
+              'Kowalski', 'López', 'Müller', 'Nakamura', 'Okafor', 'Petrov', 'Rossi', 'Singh', 'Tanaka')
+DOMAINS = ('example.com', 'mail.example.org', 'billing.example.net', 'news.example.io', 'github.com',
+           'accounts.google.com', 'shop.example.com', 'happyfox.com', 'youtube.com')
+TOPICS = ('quarterly report', 'team offsite', 'security alert', 'password reset', 'weekly digest',
+          'meeting notes', 'release plan', 'shipping update', 'invoice reminder', 'design review',
+          'budget approval', 'on-call handover', 'customer feedback', 'roadmap draft')
+LISTS = ('dev', 'announce', 'ops', 'python-users', 'billing')
+WORDS = ('the', 'report', 'attached', 'please', 'review', 'meeting', 'tomorrow', 'invoice', 'payment',
+         'account', 'update', 'team', 'deadline', 'project', 'customer', 'thanks', 'schedule', 'shipping',
+         'security', 'order', 'weekly', 'summary', 'feedback', 'release', 'budget', 'approval')
+ENCODED_SUBJECTS = ('Café meeting ☕', 'Überweisung bestätigt', 'Résumé — final version', '会议纪要', 'Счёт на оплату')
+# historyId-like message IDs, 16 hex digits that sort in generation order
+BASE_ID = 0x18e0000000000000
+LATEST_DATE = datetime(2024, 3, 23, 10, tzinfo=timezone.utc)
+
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def _address(rng):
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    email = f'{first.lower()}.{last.lower()}@{rng.choice(DOMAINS)}'.encode('ascii', 'ignore').decode()
+    kind = rng.random()
+    if kind < 0.2:
+        return email
+    name = f'{first} {last}'
+    if not name.isascii():
+        return f'{Header(name, "utf-8").encode()} <{email}>'
+    return f'"{last}, {first}" <{email}>' if kind < 0.3 else f'{name} <{email}>'
+
+
+def _subject(rng, i):
+    kind = rng.random()
+    topic = rng.choice(TOPICS)
+    if kind < 0.05:
+        return Header(rng.choice(ENCODED_SUBJECTS), 'utf-8').encode()
+    if kind < 0.25:
+        return f'Re: {topic}'
+    if kind < 0.32:
+        return f'Fwd: {topic}'
+    if kind < 0.5:
+        return f'[{rng.choice(LISTS)}] {topic}'
+    if kind < 0.6:
+        return f'Invoice #{100000 + i} from {rng.choice(DOMAINS)}'
+    return topic.capitalize()
+
+
+def _paragraphs(rng):
+    # body lengths are skewed: mostly short notes, with a long tail of newsletters
+    count = min(80, int(rng.lognormvariate(1.5, 0.9)) + 1)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 60))).capitalize() + '.'
+            for _ in range(count)]
+
+
+def _text_part(mime_type, text):
+    return {'partId': '', 'mimeType': mime_type, 'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="UTF-8"'}],
+            'body': {'size': len(text.encode()), 'data': _encode(text)}}
+
+
+def _body(rng, i):
+    paragraphs = _paragraphs(rng)
+    plain = _text_part('text/plain', '\n\n'.join(paragraphs))
+    html = _text_part('text/html', '<html><head><style>p {margin: 0 0 1em}</style></head><body><div>'
+                      + ''.join(f'<p>{text} <a href="https://{rng.choice(DOMAINS)}/t/{i}">link</a></p>'
+                                for text in paragraphs)
+                      + '</div></body></html>')
+    kind = rng.random()
+    if kind < 0.1:
+        return plain
+    if kind < 0.25:
+        return html
+    alternative = {'partId': '', 'mimeType': 'multipart/alternative', 'filename': '', 'headers': [],
+                   'body': {'size': 0}, 'parts': [plain, html]}
+    if kind < 0.85:
+        return alternative
+    attachment = {'partId': '', 'mimeType': 'application/pdf', 'filename': f'document-{i}.pdf', 'headers': [],
+                  'body': {'attachmentId': f'att{i:x}', 'size': rng.randint(20000, 2000000)}}
+    return {'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'headers': [],
+            'body': {'size': 0}, 'parts': [alternative, attachment]}
+
+
+def _number_parts(part, part_id=''):
+    part['partId'] = part_id
+    for n, child in enumerate(part.get('parts', [])):
+        _number_parts(child, f'{part_id}.{n}' if part_id else str(n))
+    return part
+
+
+def _size(part):
+    return part['body'].get('size', 0) + sum(_size(child) for child in part.get('parts', []))
+
+
+def synthetic_message(i, seed=0, recipient='me@example.com'):
+    """
+    Builds the message resource of index `i`, always the same for the same index and seed.
+
+    Returns:
+        dict: The message resource, in the shape messages.get returns with format=full.
+    """
+    rng = random.Random((seed << 40) | i)
+    msg_id = f'{BASE_ID + i:016x}'
+    date = (LATEST_DATE - timedelta(seconds=rng.randrange(2 * 365 * 24 * 3600))).astimezone(
+        timezone(timedelta(hours=rng.choice((-8, -5, 0, 1, 2, 5.5, 9)))))
+    sender = _address(rng)
+    payload = _number_parts(_body(rng, i))
+    headers = [
+        {'name': 'Return-Path', 'value': f'<bounce-{i}@{rng.choice(DOMAINS)}>'},
+        {'name': 'Received', 'value': f'from mx{rng.randint(1, 9)}.example.net by mx.google.com; '
+                                      f'{format_datetime(date)}'},
+        {'name': 'DKIM-Signature', 'value': f'v=1; a=rsa-sha256; d={rng.choice(DOMAINS)}; s=s1; '
+                                            f'b={_encode(str(rng.getrandbits(512)))}'},
+        {'name': 'MIME-Version', 'value': '1.0'},
+        {'name': 'Message-ID', 'value': f'<{msg_id}.{rng.getrandbits(32):x}@{rng.choice(DOMAINS)}>'},
+        {'name': 'Date', 'value': format_datetime(date)},
+        {'name': 'Subject', 'value': _subject(rng, i)},
+        {'name': 'From', 'value': sender},
+        {'name': 'To', 'value': recipient if rng.random() < 0.8 else f'{recipient}, {_address(rng)}'},
+    ]
+    if rng.random() < 0.25:
+        headers.append({'name': 'Cc', 'value': ', '.join(_address(rng) for _ in range(rng.randint(1, 4)))})
+    if rng.random() < 0.3:
+        headers.append({'name': 'List-Unsubscribe', 'value': f'<https://{rng.choice(DOMAINS)}/unsubscribe/{i}>'})
+    headers.append({'name': 'Content-Type', 'value': f'{payload["mimeType"]}; boundary="{rng.getrandbits(64):x}"'})
+    payload['headers'] = headers + payload['headers']
+
+    label_ids = ['INBOX'] + (['UNREAD'] if rng.random() < 0.6 else [])
+    label_ids.append(rng.choice(('CATEGORY_PERSONAL', 'CATEGORY_UPDATES', 'CATEGORY_PROMOTIONS')))
+    return {
+        'id': msg_id,
+        'threadId': msg_id,
+        'labelIds': label_ids,
+        'snippet': ' '.join(rng.choice(WORDS) for _ in range(20)),
+        'historyId': str(1000 + i),
+        'internalDate': str(int(date.timestamp() * 1000)),
+        'sizeEstimate': _size(payload) + sum(len(h['name']) + len(h['value']) + 4 for h in headers),
+        'payload': payload,
+    }
+
+
+class SyntheticMailbox(MutableMapping):
+    """
+    A mailbox of `count` synthetic messages, message ID to message resource. Messages are generated
+    when they are looked up rather than held in memory, so a million-message mailbox costs next to
+    nothing until it is read; only the messages added or changed since are stored.
+
+    Attributes:
+        count (int): The number of messages generated.
+        seed (int): Picks the mailbox; the same count and seed give the same messages.
+    """
+
+    def __init__(self, count, seed=0):
+        self.count = count
+        self.seed = seed
+        self._changed = {}
+        self._deleted = set()
+        self._added = set()
+
+    def _index(self, msg_id):
+        # the index of a generated message ID, or None
+        try:
+            index = int(msg_id, 16) - BASE_ID
+        except (TypeError, ValueError):
+            return None
+        return index if 0 <= index < self.count and f'{BASE_ID + index:016x}' == msg_id else None
+
+    def __getitem__(self, msg_id):
+        if msg_id in self._changed:
+            return self._changed[msg_id]
+        index = self._index(msg_id)
+        if index is None or msg_id in self._deleted:
+            raise KeyError(msg_id)
+        return synthetic_message(index, self.seed)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._changed or (msg_id not in self._deleted and self._index(msg_id) is not None)
+
+    def __setitem__(self, msg_id, message):
+        if self._index(msg_id) is None:
+            self._added.add(msg_id)
+        self._deleted.discard(msg_id)
+        self._changed[msg_id] = message
+
+    def __delitem__(self, msg_id):
+        if msg_id not in self:
+            raise KeyError(msg_id)
+        self._changed.pop(msg_id, None)
+        if self._index(msg_id) is None:
+            self._added.discard(msg_id)
+        else:
+            self._deleted.add(msg_id)
+
+    def __iter__(self):
+        for index in range(self.count):
+            msg_id = f'{BASE_ID + index:016x}'
+            if msg_id not in self._deleted:
+                yield msg_id
+        yield from sorted(self._added)
+
+    def __len__(self):
+        return self.count - len(self._deleted) + len(self._added)
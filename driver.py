@@ -1,15 +1,29 @@
+import argparse
+import logging
+
+from instrumentation import RunProfiler, metrics, sink_for_path
+from logger import configure
+from rule_engine.action_executor import OutboxDrain, OutboxExecutor
 from rule_engine.rule_engine import RuleEngine
+from rule_engine.processing_ledger import ProcessingLedger
+from rule_engine.rule_runner import RuleRunner
 from email_manager.email_manager import EmailManager
+from email_manager.message_store import DEFAULT_MAX_BYTES
+from scheduler.account_scheduler import Account, SyncScheduler
 
-def process_rule_json(rules_file_path):
+def process_rule_json(rules_file_path, workers=1, parse_workers=None, api_endpoint=None):
     # Initialize the RuleEngine with the path to the rules file
     rule_engine = RuleEngine(rules_file_path)
 
-    # Initialize the EmailManager
-    email_manager = EmailManager('credentials.json', 'token.pickle')
+    # Initialize the EmailManager, against another Gmail API endpoint if given, e.g. a local fake
+    email_manager = EmailManager('credentials.json', 'token.pickle', workers=workers, parse_workers=parse_workers,
+                                 api_endpoint=api_endpoint)
 
-    # Sync the emails to database
-    email_manager.sync_emails()
+    # Sync the emails to database, with their bodies only if the rules look at them, in which case the
+    # bodies of the emails synced without them earlier are downloaded too
+    email_manager.sync_emails(bodies=rule_engine.needs_content())
+    if rule_engine.needs_content():
+        email_manager.fetch_bodies()
 
     # Filter the emails based on the rules
     rule_engine.filter()
@@ -18,6 +32,102 @@ def process_rule_json(rules_file_path):
     rule_engine.perform_action(email_manager)
 
 
+def process_rules_dir(rules_dir, workers=1, full=False, fetch_bodies=False, parse_workers=None,
+                      message_store_dir=None, message_store_bytes=DEFAULT_MAX_BYTES, reparse=False, outbox=False):
+    # Load every rule file of the directory, with a ledger so that only new emails are processed
+    rule_runner = RuleRunner.from_directory(rules_dir, ledger=ProcessingLedger(full=full))
+
+    # Initialize the EmailManager, keeping the raw messages downloaded in a local store if given
+    email_manager = EmailManager('credentials.json', 'token.pickle', workers=workers, parse_workers=parse_workers,
+                                 message_store_dir=message_store_dir, message_store_bytes=message_store_bytes)
+
+    # Parse the stored messages again, e.g. after a parser fix, without downloading them
+    if reparse:
+        email_manager.reparse()
+
+    # Sync the emails once, then filter and apply the actions of all the rule files together, or only
+    # enqueue their label changes to the outbox for drain_outbox to send
+    rule_runner.run(email_manager, executor=OutboxExecutor() if outbox else None)
+
+    # Download the bodies the sync left out, now that the actions are done
+    if fetch_bodies:
+        email_manager.fetch_bodies()
+
+    # Reclaim the space of the superseded messages of the store
+    if email_manager.message_store is not None:
+        email_manager.message_store.compact()
+        email_manager.message_store.close()
+
+
+def drain_outbox(qps=OutboxDrain.DEFAULT_QPS, wait=True, accounts_file=None):
+    # Send the label changes pending in the outbox, retrying those failing with 429 or 5xx
+    if accounts_file is None:
+        email_manager = EmailManager('credentials.json', 'token.pickle')
+        return OutboxDrain(email_manager, qps=qps).drain(wait=wait)
+
+    # or those of each mailbox of the accounts file, enqueued under its name, with its own token
+    return dict((account.name, OutboxDrain(SyncScheduler.build_manager(account), qps=qps,
+                                           account=account.name).drain(wait=wait))
+                for account in Account.load_all(accounts_file))
+
+
+def process_accounts(accounts_file, workers=4, full=False, outbox=False):
+    # Load the mailboxes to sync, each with its own token and rule files
+    accounts = Account.load_all(accounts_file)
+
+    # Sync them all and apply their rules, taking turns on a shared pool of threads, through the
+    # outbox of each account if asked
+    return SyncScheduler(accounts, workers=workers, full=full, outbox=outbox).run()
+
+
 if __name__ == "__main__":
-    process_rule_json('rules/mark_as_read_rule.json')
-    process_rule_json('rules/move_yt_or_mani.json')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Sync Gmail and apply the rule files.')
+    parser.add_argument('--workers', type=int, default=1, help='number of threads fetching messages during sync')
+    parser.add_argument('--parse-workers', type=int, default=None,
+                        help='number of processes parsing fetched messages, instead of the fetching threads')
+    parser.add_argument('--rules-dir', default='rules', help='directory of the rule files to apply')
+    parser.add_argument('--full', action='store_true',
+                        help='evaluate every email, not only those synced since the last run')
+    parser.add_argument('--fetch-bodies', action='store_true',
+                        help='download the bodies of emails synced without them after applying the rules')
+    parser.add_argument('--message-store',
+                        help='directory to keep the raw messages downloaded in, so that they are never downloaded again')
+    parser.add_argument('--message-store-size', type=int, default=DEFAULT_MAX_BYTES // 2 ** 20,
+                        help='size in MB the message store is kept under, by evicting the oldest messages')
+    parser.add_argument('--reparse', action='store_true',
+                        help='parse the emails again from the message store before applying the rules')
+    parser.add_argument('--outbox', action='store_true',
+                        help='enqueue the label changes of the rules to the outbox instead of sending them')
+    parser.add_argument('--drain', action='store_true',
+                        help='only send the label changes pending in the outbox, without syncing or applying rules, '
+                             'those of each mailbox of --accounts if given')
+    parser.add_argument('--drain-qps', type=float, default=OutboxDrain.DEFAULT_QPS,
+                        help='batchModify calls per second the outbox is drained at')
+    parser.add_argument('--accounts', help='JSON file of the mailboxes to sync, instead of the one of token.pickle')
+    parser.add_argument('--metrics-file',
+                        help='file to write the run metrics to, as JSON if it ends in .json, else in Prometheus format')
+    parser.add_argument('--profile', help='file to write a cProfile profile of the run to')
+    parser.add_argument('--trace-memory', action='store_true', help='trace memory allocations and log the peak')
+    parser.add_argument('--log-level', default='info', choices=['debug', 'info', 'warning', 'error'],
+                        help='level of the logs; per-message logs are at debug')
+    parser.add_argument('--log-sample-rate', type=int, default=None,
+                        help='write one in this many per-message debug logs (default 100)')
+    args = parser.parse_args()
+
+    configure(getattr(logging, args.log_level.upper()), args.log_sample_rate)
+    if args.metrics_file:
+        metrics.sinks.append(sink_for_path(args.metrics_file))
+    try:
+        with RunProfiler(args.profile, trace_memory=args.trace_memory):
+            if args.drain:
+                drain_outbox(qps=args.drain_qps, accounts_file=args.accounts)
+            elif args.accounts:
+                process_accounts(args.accounts, workers=args.workers, full=args.full, outbox=args.outbox)
+            else:
+                process_rules_dir(args.rules_dir, workers=args.workers, full=args.full,
+                                  fetch_bodies=args.fetch_bodies, parse_workers=args.parse_workers,
+                                  message_store_dir=args.message_store,
+                                  message_store_bytes=args.message_store_size * 2 ** 20, reparse=args.reparse,
+                                  outbox=args.outbox)
+    finally:
+        metrics.flush()
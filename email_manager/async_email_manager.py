@@ -0,0 +1,452 @@
+"""
+async_email_manager.py
+
+This module contains the AsyncEmailManager class, an asyncio counterpart of EmailManager that talks to
+the Gmail REST endpoints directly over aiohttp.
+
+Classes:
+    TokenBucket: Rate limits requests by Gmail quota units.
+    AsyncEmailManager: Manages the interaction with the Gmail API from an asyncio event loop.
+
+"""
+
+import asyncio
+import random
+import time
+from datetime import datetime
+from urllib.parse import urljoin
+
+import aiohttp
+from google.auth.transport.requests import Request
+
+from email_manager.email_manager import EmailManager, ModifyResult
+from instrumentation import metrics
+from logger import logger
+from models.email import Email
+from models.sync_state import SyncState
+
+
+class TokenBucket:
+    """
+    Rate limits requests by Gmail quota units. The bucket refills at `rate` units per second
+    up to `capacity`, and a request waits until the units it costs are available.
+
+    Attributes:
+        rate (float): The number of units added per second.
+        capacity (float): The largest number of units the bucket holds.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = None
+
+    async def acquire(self, units=1):
+        """
+        Waits until `units` are available and takes them from the bucket.
+        """
+        if units > self.capacity:
+            raise ValueError(f"Cannot acquire {units} units from a bucket holding {self.capacity}")
+        # created here rather than in __init__ so that the lock belongs to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= units:
+                    self._tokens -= units
+                    return
+                await asyncio.sleep((units - self._tokens) / self.rate)
+
+
+class AsyncEmailManager:
+    """
+    Manages the interaction with the Gmail API from an asyncio event loop. The public methods are
+    coroutines mirroring the EmailManager ones.
+
+    It wraps an EmailManager for everything but the requests: the credentials, the label cache,
+    parsing message resources into rows and writing them to the database. Parsing and database
+    access block, so they run on worker threads, one list page or chunk of messages at a time,
+    and the event loop only ever waits on the network.
+
+    Requests are limited to `max_in_flight` at a time and to `quota_units_per_second` Gmail quota
+    units per second, which is Gmail's per-user limit by default. Responses with status 429 or 5xx
+    are retried with jittered exponential backoff. Several managers, one per account, can run on the
+    same event loop and share one aiohttp session.
+
+    Use it as an async context manager, or call `close` when done.
+
+    Attributes:
+        email_manager (EmailManager): The manager the parsing, persistence and label cache are shared with.
+        api_endpoint (str): The Gmail API root URL, or None for the public endpoint.
+        max_in_flight (int): The largest number of requests sent concurrently.
+        quota_units_per_second (int): The number of Gmail quota units spent per second at most.
+        max_retries (int): The number of times a request failing with 429 or 5xx is retried.
+        backoff (float): The base delay in seconds of the retry backoff.
+        round_trips (int): The number of HTTP round trips made by the last sync.
+    """
+
+    RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
+    MAX_BACKOFF = 32
+
+    def __init__(self, credentials_file='../credentials.json', token_file='../token.pickle', api_endpoint=None,
+                 upsert_chunk_size=500, max_in_flight=50, quota_units_per_second=250, max_retries=5, backoff=1.0,
+                 session=None, account=None):
+        """
+        Initializes the AsyncEmailManager with the given credentials and token files.
+
+        Args:
+            credentials_file (str): The path to the file containing the credentials.
+            token_file (str): The path to the file containing the token.
+            api_endpoint (str): The Gmail API root URL, or None for the public endpoint.
+            upsert_chunk_size (int): The number of emails written to the database per statement. Messages that
+                are not listed page by page, e.g. by `fetch_bodies`, are also downloaded this many at a time.
+            max_in_flight (int): The largest number of requests sent concurrently.
+            quota_units_per_second (int): The number of Gmail quota units spent per second at most.
+            max_retries (int): The number of times a request failing with 429 or 5xx is retried.
+            backoff (float): The base delay in seconds of the retry backoff.
+            session (aiohttp.ClientSession): A session to share with other managers, or None to open one.
+            account (str): The partition key to store the emails of this mailbox under, when several
+                mailboxes share the database, or None.
+        """
+        self.email_manager = EmailManager(credentials_file, token_file, batch_size=None, api_endpoint=api_endpoint,
+                                          upsert_chunk_size=upsert_chunk_size, account=account)
+        self.api_endpoint = api_endpoint
+        self.max_in_flight = max_in_flight
+        self.quota_units_per_second = quota_units_per_second
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.round_trips = 0
+        self._session = session
+        self._owns_session = session is None
+        self._semaphore = None
+        self._bucket = TokenBucket(quota_units_per_second)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Closes the aiohttp session, unless it was passed in by the caller.
+        """
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def sync_emails(self, q=None, max_results=None, full=False, bodies=True):
+        """
+        Syncs the emails from the Gmail API and saves them to the database.
+
+        As with EmailManager.sync_emails, a mailbox synced before only syncs the changes since the
+        stored historyId, and a full sync is run on the first sync, when `full` is set, or when Gmail
+        no longer has history that far back. Unlike it, a full sync is not checkpointed and messages
+        that cannot be fetched are not kept for retrying.
+
+        Every list page is fetched while the messages of the previous page are being downloaded,
+        and all the messages of a page are requested concurrently, within the in-flight and quota
+        limits.
+
+        Args:
+            q (str): A Gmail search query restricting the synced messages. A filtered sync always lists
+                the matching messages and leaves the stored historyId alone.
+            max_results (int): The number of message IDs requested per list page.
+            full (bool): Whether to run a full sync even if an incremental one is possible.
+            bodies (bool): Whether to download the message bodies, or only the headers that are stored.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        self.round_trips = 0
+        params = {}
+        if max_results:
+            params['maxResults'] = max_results
+        if q:
+            saved = await self._sync_pages(dict(params, q=q), bodies)
+            logger.info(f"Synced {saved} emails in {self.round_trips} round trips")
+            return saved
+
+        profile = await self._request('GET', 'profile', 'getProfile')
+        account = self.email_manager._state_key(profile)
+        state = await asyncio.to_thread(SyncState.get, account)
+        changes = None
+        if state is not None and not full:
+            changes = await self._list_history(state.history_id)
+        if changes is not None:
+            added, deleted = changes
+            await asyncio.to_thread(Email.delete_by_msg_ids, deleted, self.email_manager.account)
+            saved = await self._sync_messages(sorted(added), bodies)
+        else:
+            saved = await self._sync_pages(params, bodies)
+        await asyncio.to_thread(self._save_history_id, account, str(profile['historyId']))
+
+        logger.info(f"Synced {saved} emails in {self.round_trips} round trips")
+        return saved
+
+    async def fetch_bodies(self, msg_ids=None):
+        """
+        Downloads the bodies of emails synced without them and stores their content.
+
+        Args:
+            msg_ids (iterable): The message IDs of the emails to fetch, or None for all the emails without content.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        if msg_ids is None:
+            msg_ids = await asyncio.to_thread(self._msg_ids_without_content)
+        logger.info(f"Fetching the bodies of {len(msg_ids)} emails")
+        return await self._sync_messages(msg_ids, bodies=True)
+
+    async def batch_modify(self, msg_ids, add_label_ids=None, remove_label_ids=None):
+        """
+        Adds and removes labels on many emails at once, with one messages.batchModify call per
+        `EmailManager.BATCH_MODIFY_LIMIT` message IDs.
+
+        Args:
+            msg_ids (iterable): The message IDs of the emails to modify.
+            add_label_ids (list): The IDs of the labels to add.
+            remove_label_ids (list): The IDs of the labels to remove.
+
+        Returns:
+            list: A ModifyResult per chunk of message IDs sent.
+        """
+        body = {}
+        if add_label_ids:
+            body['addLabelIds'] = list(add_label_ids)
+        if remove_label_ids:
+            body['removeLabelIds'] = list(remove_label_ids)
+
+        results = []
+        msg_ids = list(msg_ids)
+        for start in range(0, len(msg_ids), EmailManager.BATCH_MODIFY_LIMIT):
+            chunk = msg_ids[start:start + EmailManager.BATCH_MODIFY_LIMIT]
+            try:
+                await self._request('POST', 'messages/batchModify', 'messages.batchModify',
+                                    json=dict(body, ids=chunk))
+                metrics.increment('emails_modified_total', len(chunk))
+                results.append(ModifyResult(chunk, None))
+            except aiohttp.ClientResponseError as error:
+                logger.error(f'An error occurred modifying {len(chunk)} emails: {error}')
+                metrics.increment('emails_modify_failed_total', len(chunk))
+                results.append(ModifyResult(chunk, error))
+        return results
+
+    async def mark_as_read(self, msg_id):
+        """
+        Marks the email with the given message ID as read.
+
+        Args:
+            msg_id (str): The message ID of the email to mark as read.
+        """
+        try:
+            await self._request('POST', f'messages/{msg_id}/modify', 'messages.modify',
+                                json={'removeLabelIds': ['UNREAD']})
+        except aiohttp.ClientResponseError as error:
+            logger.error(f'An error occurred: {error}')
+
+    async def move_to_label(self, msg_id, new_label_name):
+        """
+        Moves the email with the given message ID to the label with the given name.
+
+        Args:
+            msg_id (str): The message ID of the email to move.
+            new_label_name (str): The name of the label to move the email to.
+        """
+        try:
+            new_label_id = await self.get_label_id(new_label_name)
+            if new_label_id is None:
+                logger.error(f"Label {new_label_name} does not exist, not moving email: {msg_id}")
+                return
+            await self._request('POST', f'messages/{msg_id}/modify', 'messages.modify',
+                                json={'addLabelIds': [new_label_id]})
+        except aiohttp.ClientResponseError as error:
+            logger.error(f'An error occurred: {error}')
+
+    async def get_label_id(self, label_name):
+        """
+        Retrieves the ID of the label with the given name, listing the labels from the Gmail API
+        only when the name is not in the label cache.
+
+        Returns:
+            The ID of the label, or None if no such label exists.
+        """
+        label_cache = self.email_manager.label_cache
+        label_id = label_cache.lookup(label_name)
+        if label_id is None:
+            label_cache.update(await self.get_labels())
+            label_id = label_cache.lookup(label_name)
+        return label_id
+
+    async def get_labels(self):
+        """
+        Retrieves the labels from the Gmail API.
+        """
+        result = await self._request('GET', 'labels', 'labels.list')
+        return result.get('labels', [])
+
+    async def _sync_pages(self, params, bodies):
+        """
+        Lists the messages matching `params` and saves them, fetching the next list page while the
+        messages of the current one are downloaded.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        saved = 0
+        page = await self._request('GET', 'messages', 'messages.list', params=params)
+        while page is not None:
+            next_page = None
+            if page.get('nextPageToken'):
+                next_page = asyncio.ensure_future(self._request(
+                    'GET', 'messages', 'messages.list', params=dict(params, pageToken=page['nextPageToken'])))
+            try:
+                saved += await self._save_messages([msg['id'] for msg in page.get('messages') or []], bodies)
+            except BaseException:
+                if next_page is not None:
+                    self._discard(next_page)
+                raise
+            page = await next_page if next_page is not None else None
+        return saved
+
+    async def _sync_messages(self, msg_ids, bodies):
+        """
+        Saves the given messages, `upsert_chunk_size` at a time.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        saved = 0
+        chunk_size = self.email_manager.upsert_chunk_size
+        for start in range(0, len(msg_ids), chunk_size):
+            saved += await self._save_messages(msg_ids[start:start + chunk_size], bodies)
+        return saved
+
+    async def _save_messages(self, msg_ids, bodies):
+        """
+        Downloads the given messages concurrently, then parses and saves them on a worker thread.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        params = None if bodies else [('format', 'metadata')] + [('metadataHeaders', header)
+                                                                  for header in EmailManager.METADATA_HEADERS]
+        tasks = [asyncio.ensure_future(self._get_message(msg_id, params)) for msg_id in msg_ids]
+        try:
+            messages = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                self._discard(task)
+            raise
+        return await asyncio.to_thread(self._persist_messages, list(filter(None, messages)), bodies)
+
+    def _persist_messages(self, messages, bodies):
+        parse = self.email_manager._parse_message if bodies else self.email_manager._parse_metadata
+        return self.email_manager._persist_emails(self.email_manager._parse_messages(messages, parse))
+
+    def _msg_ids_without_content(self):
+        return list(Email.iter_msg_ids(self.email_manager._account_clause(Email.content.is_(None))))
+
+    @staticmethod
+    def _save_history_id(account, history_id):
+        state = SyncState.get(account) or SyncState(account=account)
+        state.history_id = history_id
+        state.updated_at = datetime.now()
+        state.save()
+
+    async def _list_history(self, start_history_id):
+        """
+        Collects the mailbox changes recorded since `start_history_id`.
+
+        Returns:
+            tuple: The sets of added and deleted message IDs, or None if the history has expired and a
+            full sync is needed.
+        """
+        added, deleted = set(), set()
+        params = {'startHistoryId': start_history_id, 'historyTypes': EmailManager.HISTORY_TYPES}
+        while True:
+            try:
+                result = await self._request('GET', 'history', 'history.list', params=params)
+            except aiohttp.ClientResponseError as error:
+                if error.status == 404:
+                    logger.info(f"History from {start_history_id} has expired, falling back to a full sync")
+                    return None
+                raise
+            EmailManager._collect_history(result.get('history', []), added, deleted)
+            if not result.get('nextPageToken'):
+                break
+            params['pageToken'] = result['nextPageToken']
+
+        logger.info(f"History since {start_history_id}: {len(added)} added, {len(deleted)} deleted")
+        return added, deleted
+
+    @staticmethod
+    def _discard(future):
+        # cancels a request no longer needed, or reads the error it already failed with, which
+        # asyncio would otherwise report as never retrieved
+        if not future.cancel() and not future.cancelled():
+            future.exception()
+
+    async def _get_message(self, msg_id, params=None):
+        try:
+            return await self._request('GET', f'messages/{msg_id}', 'messages.get', params=params)
+        except aiohttp.ClientResponseError as error:
+            logger.error(f"Failed to fetch message {msg_id}: {error}")
+            return None
+
+    async def _request(self, http_method, path, api_method, params=None, json=None):
+        """
+        Sends a request to the Gmail API for the authenticated user, retrying 429 and 5xx responses.
+
+        Returns:
+            dict: The decoded JSON response.
+
+        Raises:
+            aiohttp.ClientResponseError: If the request failed with a non-retriable status, or kept failing.
+        """
+        url = urljoin(self.api_endpoint or EmailManager.API_ROOT, f'gmail/v1/users/me/{path}')
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        for attempt in range(self.max_retries + 1):
+            await self._bucket.acquire(EmailManager.QUOTA_UNITS[api_method])
+            async with self._semaphore:
+                headers = await self._auth_headers()
+                started = time.perf_counter()
+                async with self._session.request(http_method, url, params=params, json=json,
+                                                 headers=headers) as response:
+                    self.round_trips += 1
+                    metrics.observe('gmail_api_seconds', time.perf_counter() - started, method=api_method)
+                    metrics.increment('gmail_api_calls_total', method=api_method)
+                    if response.status < 300:
+                        # batchModify answers 204 without a body
+                        return await response.json(content_type=None) or {}
+                    if response.status not in self.RETRIABLE_STATUSES or attempt == self.max_retries:
+                        response.raise_for_status()
+                    retry_after = response.headers.get('Retry-After')
+
+            delay = self._backoff_delay(attempt, retry_after)
+            logger.info(f"{api_method} returned {response.status}, retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        # "full jitter": a random delay up to the exponential bound spreads out retries from many tasks
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(self.MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    async def _auth_headers(self):
+        creds = self.email_manager.creds
+        if not creds.valid:
+            await asyncio.to_thread(creds.refresh, Request())
+        headers = {}
+        creds.apply(headers)
+        return headers
@@ -0,0 +1,106 @@
+"""
+batch_fetcher.py
+
+This module contains the BatchFetcher class which fetches Gmail messages using batch HTTP requests.
+
+Classes:
+    BatchFetcher: Groups message gets into multipart batch requests.
+
+"""
+
+import time
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+from instrumentation import metrics
+from logger import logger
+
+
+class BatchFetcher:
+    """
+    Groups message gets into multipart batch requests, so that one HTTP round trip fetches
+    up to `batch_size` messages. Sub-requests that fail with a retriable status are retried
+    in a new batch; the rest of the batch is not sent again.
+
+    Attributes:
+        service: The Gmail API service object.
+        batch_uri (str): The URI batch requests are posted to.
+        batch_size (int): The number of messages fetched per batch request.
+        max_retries (int): The number of times a failed sub-request is retried.
+        backoff (float): The base delay in seconds between retries, doubled on every attempt.
+        round_trips (int): The number of batch requests sent so far.
+        failed (dict): Message IDs that could not be fetched, mapped to the last error.
+    """
+
+    MAX_BATCH_SIZE = 100  # Gmail rejects batches with more than 100 calls
+    DEFAULT_BATCH_SIZE = 50
+    RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, service, batch_uri, batch_size=DEFAULT_BATCH_SIZE, max_retries=5, backoff=1.0):
+        if not 0 < batch_size <= self.MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {self.MAX_BATCH_SIZE}, got {batch_size}")
+        self.service = service
+        self.batch_uri = batch_uri
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.round_trips = 0
+        self.failed = {}
+
+    def fetch(self, msg_ids, **get_kwargs):
+        """
+        Fetches the given messages, `batch_size` at a time.
+
+        Args:
+            msg_ids (iterable): The IDs of the messages to fetch.
+            **get_kwargs: Extra arguments for messages.get, e.g. format.
+
+        Yields:
+            dict: Each fetched message resource, in batch completion order.
+        """
+        chunk = []
+        for msg_id in msg_ids:
+            chunk.append(msg_id)
+            if len(chunk) == self.batch_size:
+                yield from self._fetch_chunk(chunk, get_kwargs)
+                chunk = []
+        if chunk:
+            yield from self._fetch_chunk(chunk, get_kwargs)
+
+    def _fetch_chunk(self, msg_ids, get_kwargs):
+        pending = list(msg_ids)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            fetched, retry = self._execute_batch(pending, get_kwargs)
+            yield from fetched
+            if not retry:
+                return
+            logger.info(f"Retrying {len(retry)} of {len(pending)} messages from the last batch")
+            pending = retry
+
+    def _execute_batch(self, msg_ids, get_kwargs):
+        fetched = []
+        retry = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                fetched.append(response)
+                self.failed.pop(request_id, None)
+                return
+            self.failed[request_id] = exception
+            metrics.increment('gmail_fetch_errors_total', status=getattr(exception, 'status_code', None))
+            if isinstance(exception, HttpError) and exception.status_code in self.RETRIABLE_STATUSES:
+                retry.append(request_id)
+            else:
+                logger.error(f"Failed to fetch message {request_id}: {exception}")
+
+        batch = BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+        messages = self.service.users().messages()
+        for msg_id in msg_ids:
+            batch.add(messages.get(userId='me', id=msg_id, **get_kwargs), request_id=msg_id)
+        with metrics.timer('gmail_api_seconds', method='batch'):
+            batch.execute()
+        self.round_trips += 1
+        return fetched, retry
@@ -0,0 +1,176 @@
+"""
+body_extractor.py
+
+This module extracts the text body of a Gmail API message resource without building a DOM.
+
+Classes:
+    HTMLTextExtractor: Streams HTML through html.parser and keeps only the text.
+
+Functions:
+    extract_body: Finds the text body of a message payload and decodes it to text.
+    find_body_part: Walks the MIME part tree for the part holding the body.
+    decode_part_data: Decodes the base64url data of a message part.
+    html_to_text: Strips HTML down to its text.
+
+"""
+
+import base64
+import codecs
+import re
+from html.parser import HTMLParser
+
+DEFAULT_MAX_CHARS = 100000
+
+CHARSET_RE = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+SPACES_RE = re.compile(r'[ \t\r\f\v\xa0]+')
+BLANK_LINES_RE = re.compile(r'\s*\n\s*')
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Collects the text of an HTML document as it is fed, dropping the markup, scripts and styles.
+    Block elements become line breaks. Once `max_chars` characters are collected, the rest of the
+    document is ignored.
+
+    Attributes:
+        max_chars (int): The number of characters to collect at most, or None for no limit.
+    """
+
+    BLOCK_TAGS = {'address', 'article', 'blockquote', 'br', 'div', 'dl', 'dt', 'dd', 'footer', 'h1', 'h2', 'h3',
+                  'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre', 'section', 'table', 'td', 'th', 'tr',
+                  'ul'}
+    SKIPPED_TAGS = {'head', 'script', 'style', 'template', 'title'}
+
+    def __init__(self, max_chars=None):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.length = 0
+        self._pieces = []
+        self._skipping = 0
+
+    @property
+    def full(self):
+        return self.max_chars is not None and self.length >= self.max_chars
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in self.BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in self.BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self._append(data)
+
+    def text(self):
+        """
+        Returns the text collected so far, with runs of whitespace collapsed.
+        """
+        text = SPACES_RE.sub(' ', ''.join(self._pieces))
+        return BLANK_LINES_RE.sub('\n', text).strip()
+
+    def _append(self, data):
+        if not self.full:
+            self._pieces.append(data)
+            self.length += len(data)
+
+
+def extract_body(payload, max_chars=DEFAULT_MAX_CHARS):
+    """
+    Finds the text body of a message payload, as returned by messages.get, and decodes it. A text/plain
+    part is preferred; otherwise the first text/html part is stripped down to its text.
+
+    Args:
+        payload (dict): The payload of the message resource.
+        max_chars (int): The number of characters kept at most, or None to keep the whole body.
+
+    Returns:
+        str: The text of the body, or an empty string if the message has none.
+    """
+    part = find_body_part(payload)
+    if part is None:
+        return ''
+    data = decode_part_data(part['body']['data'])
+    text = data.decode(_charset(part), errors='replace')
+    if part['mimeType'] == 'text/html':
+        return html_to_text(text, max_chars)
+    text = text.strip()
+    return text if max_chars is None else text[:max_chars]
+
+
+def find_body_part(payload):
+    """
+    Walks the MIME part tree of a payload, depth first and in order, without recursing.
+
+    Returns:
+        dict: The first inline text/plain part with data, else the first such text/html part, else None.
+    """
+    html_part = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get('parts')
+        if children:
+            stack.extend(reversed(children))
+            continue
+        if part.get('filename') or not part.get('body', {}).get('data'):
+            # attachments, and parts whose data has to be fetched separately
+            continue
+        mime_type = part.get('mimeType', '')
+        if mime_type == 'text/plain':
+            return part
+        if mime_type == 'text/html' and html_part is None:
+            html_part = part
+    return html_part
+
+
+def decode_part_data(data):
+    """
+    Decodes the base64url data of a message part, which Gmail sends with or without padding.
+
+    Returns:
+        bytes: The decoded data.
+    """
+    data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def html_to_text(html, max_chars=None, chunk_size=65536):
+    """
+    Strips HTML down to its text, feeding it to the parser a chunk at a time and stopping once
+    `max_chars` characters have been collected.
+
+    Returns:
+        str: The text of the document.
+    """
+    parser = HTMLTextExtractor(max_chars)
+    for start in range(0, len(html), chunk_size):
+        parser.feed(html[start:start + chunk_size])
+        if parser.full:
+            break
+    else:
+        parser.close()
+    text = parser.text()
+    return text if max_chars is None else text[:max_chars]
+
+
+def _charset(part):
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = CHARSET_RE.search(header['value'])
+            if match:
+                try:
+                    return codecs.lookup(match.group(1)).name
+                except LookupError:
+                    break
+    return 'utf-8'
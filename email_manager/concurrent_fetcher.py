@@ -0,0 +1,121 @@
+"""
+concurrent_fetcher.py
+
+This module contains the ConcurrentFetcher class which fetches Gmail messages from a pool of worker threads.
+
+Classes:
+    ConcurrentFetcher: Fetches and parses messages on worker threads, each with its own service object.
+
+"""
+
+import itertools
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from googleapiclient.errors import HttpError
+
+from email_manager.batch_fetcher import BatchFetcher
+from instrumentation import metrics
+from logger import logger
+
+
+class ConcurrentFetcher:
+    """
+    Fetches messages from a pool of worker threads. The message IDs are split into chunks of
+    `batch_size` (one batch request per chunk) or single IDs when batching is disabled, and each
+    chunk is fetched, and optionally parsed, on a worker thread.
+
+    httplib2 is not thread-safe, so every worker builds its own service object through
+    `service_factory` the first time it runs. Results are yielded back on the calling thread,
+    which stays the only thread writing to the database. At most `max_in_flight` chunks are
+    submitted ahead of the consumer, so a slow writer holds the fetchers back instead of letting
+    fetched messages pile up in memory.
+
+    Attributes:
+        service_factory (callable): Builds a new Gmail API service object.
+        batch_uri (str): The URI batch requests are posted to.
+        workers (int): The number of worker threads.
+        batch_size (int): The number of messages fetched per batch request, or None to fetch one at a time.
+        max_in_flight (int): The number of chunks that may be fetched ahead of the consumer.
+        parse (callable): Applied to each fetched message on the worker thread; None results are dropped.
+        round_trips (int): The number of HTTP requests sent so far.
+        failed (dict): Message IDs that could not be fetched, mapped to the last error.
+    """
+
+    def __init__(self, service_factory, batch_uri=None, workers=4, batch_size=BatchFetcher.DEFAULT_BATCH_SIZE,
+                 max_in_flight=None, parse=None):
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        self.service_factory = service_factory
+        self.batch_uri = batch_uri
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight or workers * 2
+        self.parse = parse
+        self.round_trips = 0
+        self.failed = {}
+        self._local = threading.local()
+
+    def fetch(self, msg_ids, **get_kwargs):
+        """
+        Fetches the given messages on the worker threads.
+
+        Args:
+            msg_ids (iterable): The IDs of the messages to fetch. Consumed lazily.
+            **get_kwargs: Extra arguments for messages.get, e.g. format.
+
+        Yields:
+            The fetched message resources, or the results of `parse`, in completion order.
+        """
+        msg_ids = iter(msg_ids)
+        chunk_size = self.batch_size or 1
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='gmail-fetch') as executor:
+            pending = set()
+            while True:
+                chunk = list(itertools.islice(msg_ids, chunk_size))
+                if not chunk:
+                    break
+                if len(pending) >= self.max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from self._collect(done)
+                pending.add(executor.submit(self._fetch_chunk, chunk, get_kwargs))
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from self._collect(done)
+
+    def _collect(self, futures):
+        for future in futures:
+            results, round_trips, failed = future.result()
+            self.round_trips += round_trips
+            self.failed.update(failed)
+            yield from results
+
+    def _service(self):
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._local.service = self.service_factory()
+        return service
+
+    def _fetch_chunk(self, msg_ids, get_kwargs):
+        service = self._service()
+        if self.batch_size:
+            fetcher = BatchFetcher(service, self.batch_uri, batch_size=self.batch_size)
+            messages = list(fetcher.fetch(msg_ids, **get_kwargs))
+            round_trips, failed = fetcher.round_trips, fetcher.failed
+        else:
+            messages, round_trips, failed = [], 0, {}
+            for msg_id in msg_ids:
+                round_trips += 1
+                try:
+                    with metrics.timer('gmail_api_seconds', method='messages.get'):
+                        message = service.users().messages().get(userId='me', id=msg_id, **get_kwargs).execute()
+                    messages.append(message)
+                except HttpError as error:
+                    logger.error(f"Failed to fetch message {msg_id}: {error}")
+                    metrics.increment('gmail_fetch_errors_total', status=error.status_code)
+                    failed[msg_id] = error
+
+        if self.parse is not None:
+            messages = [result for result in map(self.parse, messages) if result is not None]
+        return messages, round_trips, failed
@@ -5,22 +5,39 @@ This module contains the EmailManager class which is responsible for interacting
 
 Classes:
     EmailManager: Manages the interaction with the Gmail API.
+    ModifyResult: The outcome of one messages.batchModify call.
 
 """
 
-import base64
+import itertools
 import os.path
 import pickle
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-
+from sqlalchemy import and_
+
+from email_manager.batch_fetcher import BatchFetcher
+from email_manager.body_extractor import DEFAULT_MAX_CHARS
+from email_manager.concurrent_fetcher import ConcurrentFetcher
+from email_manager.header_parser import local_naive
+from email_manager.label_cache import LabelCache
+from email_manager.message_store import DEFAULT_MAX_BYTES, MessageStore
+from email_manager.parse_pool import ParsePool, parse_message
+from instrumentation import metrics
 from logger import logger
 from models.email import Email
+from models.sync_checkpoint import FailedMessage, SyncCheckpoint
+from models.sync_state import SyncState
+
+# The outcome of one messages.batchModify call: the message IDs it covered and the error, if it failed
+ModifyResult = namedtuple('ModifyResult', ['msg_ids', 'error'])
 
 
 class EmailManager:
@@ -30,20 +47,83 @@ class EmailManager:
     Attributes:
         credentials_file (str): The path to the file containing the credentials.
         token_file (str): The path to the file containing the token.
+        batch_size (int): The number of messages fetched per batch request, or None to fetch one at a time.
+        api_endpoint (str): The Gmail API root URL, or None for the public endpoint.
+        upsert_chunk_size (int): The number of emails written to the database per statement.
+        workers (int): The number of threads fetching messages concurrently during a sync.
+        create_missing_labels (bool): Whether move_to_label creates labels that do not exist yet.
+        label_cache (LabelCache): The cache of label name to ID lookups.
+        account (str): The partition key the emails of this mailbox are stored under, or None.
+        message_store (MessageStore): The local store of the raw messages downloaded, or None.
+        round_trips (int): The number of HTTP round trips made by the last sync.
+        quota_units (int): The number of Gmail quota units spent so far.
     """
 
     SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
-
-    def __init__(self, credentials_file='../credentials.json', token_file='../token.pickle'):
+    HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+    # messages.list leaves out spam and trash, so these labels coming and going count as deletes and adds
+    HIDDEN_LABELS = {'SPAM', 'TRASH'}
+    BATCH_MODIFY_LIMIT = 1000  # the most message IDs messages.batchModify accepts
+    MAX_FETCH_ATTEMPTS = 5  # syncs trying a failed message again before it is left in the dead-letter list
+    # the headers _parse_message reads, all a sync without bodies asks for
+    METADATA_HEADERS = ['Subject', 'From', 'To', 'Cc', 'Date']
+    # Gmail API quota units per method, see https://developers.google.com/gmail/api/reference/quota
+    QUOTA_UNITS = {
+        'getProfile': 1,
+        'history.list': 2,
+        'labels.list': 1,
+        'messages.batchModify': 50,
+        'messages.get': 5,
+        'messages.list': 5,
+        'messages.modify': 5,
+    }
+    API_ROOT = 'https://gmail.googleapis.com/'
+    BATCH_PATH = 'batch/gmail/v1'
+
+    def __init__(self, credentials_file='../credentials.json', token_file='../token.pickle',
+                 batch_size=BatchFetcher.DEFAULT_BATCH_SIZE, api_endpoint=None, upsert_chunk_size=500,
+                 workers=1, create_missing_labels=False, label_cache_file=None, label_cache_ttl=3600,
+                 max_body_chars=DEFAULT_MAX_CHARS, parse_workers=None, account=None, message_store_dir=None,
+                 message_store_bytes=DEFAULT_MAX_BYTES):
         """
         Initializes the EmailManager with the given credentials and token files.
 
         Args:
             credentials_file (str): The path to the file containing the credentials.
             token_file (str): The path to the file containing the token.
+            batch_size (int): The number of messages fetched per batch request, or None to fetch one at a time.
+            api_endpoint (str): The Gmail API root URL, or None for the public endpoint.
+            upsert_chunk_size (int): The number of emails written to the database per statement.
+            workers (int): The number of threads fetching messages concurrently during a sync.
+            create_missing_labels (bool): Whether move_to_label creates labels that do not exist yet.
+            label_cache_file (str): The path to persist label name to ID lookups to, or None to keep them in memory.
+            label_cache_ttl (float): The number of seconds persisted label lookups stay valid.
+            max_body_chars (int): The number of characters of each body stored at most, or None for no limit.
+            parse_workers (int): The number of processes parsing fetched messages, or None to parse them
+                on the fetching threads.
+            account (str): The partition key to store the emails of this mailbox under, when several
+                mailboxes share the database, or None.
+            message_store_dir (str): The directory to keep the raw messages downloaded in, so that they are
+                never downloaded again, or None not to keep them.
+            message_store_bytes (int): The size the message store is kept under, by evicting the oldest messages.
         """
         self.credentials_file = credentials_file
         self.token_file = token_file
+        self.batch_size = batch_size
+        self.api_endpoint = api_endpoint
+        self.upsert_chunk_size = upsert_chunk_size
+        self.workers = workers
+        self.create_missing_labels = create_missing_labels
+        self.max_body_chars = max_body_chars
+        self.parse_workers = parse_workers
+        self.account = account
+        self.message_store = MessageStore(message_store_dir, message_store_bytes) if message_store_dir else None
+        self.label_cache = LabelCache(self.get_labels, self.create_label, cache_file=label_cache_file,
+                                      ttl=label_cache_ttl)
+        self.round_trips = 0
+        self.quota_units = 0
+        self._service = None
+        self._parse_pool = None
         self.creds = self.get_credentials()
 
     def get_credentials(self):
@@ -70,48 +150,654 @@ class EmailManager:
 
         return creds
 
-    def sync_emails(self):
+    def sync_emails(self, q=None, max_results=None, full=False, bodies=True):
         """
         Syncs the emails from the Gmail API and saves them to the database.
+
+        When the mailbox has been synced before, only the messages added, deleted or moved in or
+        out of spam/trash since the stored historyId are synced. A full sync is run on the first
+        sync, when `full` is set, or when Gmail no longer has history that far back.
+
+        A full sync is a pipeline of generators: list pages feed message IDs to the fetch stage,
+        fetched messages go to the parse stage and parsed emails to the persist stage. Each stage
+        pulls from the previous one on demand, so at most one list page and one fetch batch are
+        held in memory however large the mailbox is. The number of round trips made is kept in
+        `round_trips`.
+
+        A full sync is crash-safe: once the emails of a list page are committed, the page to list
+        next is stored in a SyncCheckpoint, and an interrupted sync resumes from there on the next
+        run instead of downloading the mailbox again. Messages that could not be fetched or parsed
+        are kept in a dead-letter list (FailedMessage) with the reason, and every sync tries them
+        again, up to `MAX_FETCH_ATTEMPTS` times. A filtered sync is neither checkpointed nor retried.
+
+        Args:
+            q (str): A Gmail search query restricting the synced messages, e.g. 'after:2024/01/01 before:2024/02/01'.
+                A filtered sync always lists the matching messages and leaves the stored historyId alone.
+            max_results (int): The number of message IDs requested per list page.
+            full (bool): Whether to run a full sync even if an incremental one is possible.
+            bodies (bool): Whether to download the message bodies. Without them messages are fetched with
+                format=metadata, a fraction of the bytes and parsing, and the stored content of the emails is
+                left alone; `fetch_bodies` downloads it later if needed.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        steps = self.sync_steps(q=q, max_results=max_results, full=full, bodies=bodies)
+        with metrics.timer('sync_seconds'):
+            while True:
+                try:
+                    next(steps)
+                except StopIteration as stop:
+                    return stop.value
+
+    def sync_steps(self, q=None, max_results=None, full=False, bodies=True, chunk_size=None):
+        """
+        Runs the sync of `sync_emails` one step at a time, so that a scheduler can interleave the syncs
+        of several mailboxes. Each step fetches and saves the next `chunk_size` messages; listing the
+        mailbox or its history happens along the way. Advance it with next() until it stops, from one
+        thread at a time.
+
+        Args:
+            q (str): A Gmail search query restricting the synced messages, as for `sync_emails`.
+            max_results (int): The number of message IDs requested per list page.
+            full (bool): Whether to run a full sync even if an incremental one is possible.
+            bodies (bool): Whether to download the message bodies.
+            chunk_size (int): The number of messages fetched per step, or None to sync in a single step,
+                except for a full sync which takes one step per list page.
+
+        Yields:
+            int: The number of emails saved by the step. The quota spent shows in `quota_units`.
+
+        Returns:
+            int: The number of emails saved, as the value of the StopIteration.
+        """
+        # every chunk of the sync is parsed on the same processes
+        with self._sharing_parse_pool():
+            return (yield from self._sync_steps(q, max_results, full, bodies, chunk_size))
+
+    def _sync_steps(self, q, max_results, full, bodies, chunk_size):
+        service = self.service
+        self.round_trips = 0
+
+        if q:
+            msg_ids = self._list_message_ids(service, q=q, max_results=max_results)
+            saved = yield from self._save_in_steps(service, msg_ids, bodies, chunk_size)
+            logger.info(f"Synced {saved} emails in {self.round_trips} round trips")
+            return saved
+
+        with metrics.timer('gmail_api_seconds', method='getProfile'):
+            profile = service.users().getProfile(userId='me').execute()
+        self._spend('getProfile')
+        account = self._state_key(profile)
+        state = SyncState.get(account)
+        checkpoint = SyncCheckpoint.get(account)
+        history_id = str(profile['historyId'])
+
+        saved = yield from self._retry_failed(service, account, bodies, chunk_size)
+        changes = None
+        if checkpoint is None and state is not None and not full:
+            changes = self._list_history(service, state.history_id)
+        if changes is not None:
+            added, deleted = changes
+            Email.delete_by_msg_ids(deleted, self.account)
+            FailedMessage.resolve(account, deleted)
+            if self.message_store is not None:
+                self.message_store.discard(deleted)
+            saved += yield from self._save_in_steps(service, sorted(added), bodies, chunk_size, account=account)
+        else:
+            # an interrupted full sync resumes with the history it started from
+            if checkpoint is not None:
+                history_id = checkpoint.history_id
+            saved += yield from self._backfill(service, account, history_id, checkpoint, max_results, bodies,
+                                               chunk_size)
+
+        # read again, the steps may have run on other threads, each with its own session
+        state = SyncState.get(account) or SyncState(account=account)
+        state.history_id = history_id
+        state.updated_at = datetime.now()
+        state.save()
+
+        logger.info(f"Synced {saved} emails in {self.round_trips} round trips")
+        return saved
+
+    def _backfill(self, service, account, history_id, checkpoint=None, max_results=None, bodies=True,
+                  chunk_size=None):
+        """
+        Runs a full sync of the mailbox, `chunk_size` messages or one list page per step. After each
+        step the position reached in the listing is committed to the account's SyncCheckpoint, which
+        is deleted once the listing is done.
+
+        Args:
+            service: The Gmail API service object.
+            account (str): The key the sync state of the mailbox is stored under, see _state_key.
+            history_id (str): The historyId of the mailbox when the sync started.
+            checkpoint (SyncCheckpoint): Where an interrupted sync stopped, or None to start from the first page.
+            max_results (int): The number of message IDs requested per list page.
+            bodies (bool): Whether to download the message bodies.
+            chunk_size (int): The number of messages fetched per step, or None for a step per list page.
+
+        Yields:
+            int: The number of emails saved by each step.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        page_token = last_msg_id = None
+        if checkpoint is not None:
+            page_token, last_msg_id = checkpoint.page_token, checkpoint.last_msg_id
+            logger.info(f"Resuming the full sync of {account} from page {page_token or 'one'} after {last_msg_id}")
+        else:
+            SyncCheckpoint.store(account, history_id, None, None)
+
+        saved = 0
+        pages = self._list_pages(service, max_results=max_results, page_token=page_token)
+        for msg_ids, (page_token, last_msg_id) in self._checkpointed_chunks(pages, last_msg_id, chunk_size):
+            count = self._save_chunk(service, msg_ids, bodies, account=account)
+            if page_token is not None or last_msg_id is not None:
+                SyncCheckpoint.store(account, history_id, page_token, last_msg_id)
+            saved += count
+            yield count
+        SyncCheckpoint.clear(account)
+        return saved
+
+    @staticmethod
+    def _checkpointed_chunks(pages, last_msg_id=None, chunk_size=None):
+        """
+        Splits listed pages into chunks of `chunk_size` message IDs, or a chunk per page, skipping the
+        IDs of the first page up to `last_msg_id`.
+
+        Yields:
+            tuple: The message IDs of a chunk, and where to resume once it is saved: the page token to
+            list and the last message ID of that page already saved. (None, None) is the end of the listing.
+        """
+        chunk = []
+        for page_token, msg_ids, next_page_token in pages:
+            if last_msg_id in msg_ids:
+                msg_ids = msg_ids[msg_ids.index(last_msg_id) + 1:]
+            last_msg_id = None
+            for position, msg_id in enumerate(msg_ids, 1):
+                chunk.append(msg_id)
+                if len(chunk) == chunk_size:
+                    yield chunk, (page_token, msg_id) if position < len(msg_ids) else (next_page_token, None)
+                    chunk = []
+            if chunk and (chunk_size is None or next_page_token is None):
+                yield chunk, (next_page_token, None)
+                chunk = []
+
+    def _retry_failed(self, service, account, bodies=True, chunk_size=None):
+        """
+        Fetches again the messages of the dead-letter list that have not used up their attempts.
+
+        Yields:
+            int: The number of emails saved by each step.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        msg_ids = FailedMessage.retriable_ids(account, self.MAX_FETCH_ATTEMPTS)
+        if not msg_ids:
+            return 0
+        logger.info(f"Retrying {len(msg_ids)} messages that failed to sync before")
+        return (yield from self._save_in_steps(service, msg_ids, bodies, chunk_size, account=account))
+
+    def _save_in_steps(self, service, msg_ids, bodies=True, chunk_size=None, account=None):
+        """
+        Fetches and saves the given messages, `chunk_size` per step or all in one step.
+
+        Yields:
+            int: The number of emails saved by each step.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        if chunk_size is None:
+            saved = self._save_chunk(service, msg_ids, bodies, account=account)
+            yield saved
+            return saved
+
+        saved = 0
+        msg_ids = iter(msg_ids)
+        while True:
+            chunk = list(itertools.islice(msg_ids, chunk_size))
+            if not chunk:
+                return saved
+            count = self._save_chunk(service, chunk, bodies, account=account)
+            saved += count
+            yield count
+
+    def _save_chunk(self, service, msg_ids, bodies=True, account=None):
+        """
+        Fetches and saves the given messages. With an account, the messages that could not be fetched
+        or parsed are added to its dead-letter list, and the ones saved are taken off it.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        if account is None:
+            return self._persist_emails(self._fetch_emails(service, msg_ids, bodies=bodies))
+
+        msg_ids = list(msg_ids)
+        failed, saved_ids = {}, set()
+        saved = self._persist_emails(self._collect_msg_ids(self._fetch_emails(service, msg_ids, bodies=bodies,
+                                                                              failed=failed), saved_ids))
+        errors = dict((msg_id, failed.get(msg_id, 'could not be parsed'))
+                      for msg_id in msg_ids if msg_id not in saved_ids)
+        if errors:
+            logger.error(f"Failed to sync {len(errors)} of {len(msg_ids)} messages, they will be retried")
+            metrics.increment('messages_failed_total', len(errors))
+            FailedMessage.record(account, errors)
+        FailedMessage.resolve(account, saved_ids)
+        return saved
+
+    @staticmethod
+    def _collect_msg_ids(rows, msg_ids):
+        """
+        Passes email rows through, adding the message ID of each to `msg_ids` as they are consumed.
+        """
+        for row in rows:
+            msg_ids.add(row['msg_id'])
+            yield row
+
+    def fetch_bodies(self, msg_ids=None):
+        """
+        Downloads the bodies of emails synced without them and stores their content. Run it after a
+        sync without bodies, e.g. in the background once the rules have been applied.
+
+        Args:
+            msg_ids (iterable): The message IDs of the emails to fetch, or None for all the emails without content.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        if msg_ids is None:
+            # read them all up front, the upserts below would cut a streaming query short
+            msg_ids = list(Email.iter_msg_ids(self._account_clause(Email.content.is_(None))))
+        logger.info(f"Fetching the bodies of {len(msg_ids)} emails")
+        with self._sharing_parse_pool():
+            return self._persist_emails(self._fetch_emails(self.service, msg_ids))
+
+    def reparse(self, msg_ids=None):
+        """
+        Parses the emails again from the message store, without downloading them, e.g. after a parser
+        fix. Emails whose message is not in the store are left alone.
+
+        Args:
+            msg_ids (iterable): The message IDs of the emails to parse again, or None for all the emails.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        if self.message_store is None:
+            raise ValueError("Reparsing needs a message store")
+        # read them all up front, the upserts below would cut a streaming query short
+        msg_ids = list(Email.iter_msg_ids(self._account_clause(Email.msg_id.isnot(None))) if msg_ids is None
+                       else msg_ids)
+        messages = self.message_store.scan(msg_ids)
+        logger.info(f"Parsing again {len(msg_ids)} emails from the message store")
+        if self.parse_workers:
+            with self._sharing_parse_pool() as pool:
+                return self._persist_emails(map(self._parsed_row, pool.parse(messages)))
+        return self._persist_emails(self._parse_messages(messages))
+
+    @contextmanager
+    def _sharing_parse_pool(self):
+        """
+        Starts the ParsePool the messages are parsed on, when there are parse workers, and stops it on
+        exit. Nested uses share the pool of the outermost one, so that its processes are started once
+        for all the chunks of a sync rather than once per chunk.
+
+        Yields:
+            ParsePool: The pool, or None without parse workers.
         """
-        service = build('gmail', 'v1', credentials=self.creds)
-        result = service.users().messages().list(userId='me').execute()
-        messages = result.get('messages')
+        if self._parse_pool is not None or not self.parse_workers:
+            yield self._parse_pool
+            return
+        self._parse_pool = ParsePool(workers=self.parse_workers, max_body_chars=self.max_body_chars)
+        try:
+            yield self._parse_pool
+        finally:
+            self._parse_pool.close()
+            self._parse_pool = None
+
+    def get_content(self, msg_id):
+        """
+        Retrieves the content of an email, downloading its body first if it was synced without it.
+
+        Returns:
+            The content of the email, or None if it is not in the database or could not be fetched.
+        """
+        email = Email.get_by_msg_id(msg_id, self.account)
+        if email is not None and email.content is None:
+            self.fetch_bodies([msg_id])
+            email = Email.get_by_msg_id(msg_id, self.account)
+        return email.content if email is not None else None
+
+    def _list_history(self, service, start_history_id):
+        """
+        Collects the mailbox changes recorded since `start_history_id`.
 
-        email_list = []
-        for msg in messages:
-            txt = service.users().messages().get(userId='me', id=msg['id']).execute()
+        Returns:
+            tuple: The sets of added and deleted message IDs, or None if the history has expired and a
+            full sync is needed.
+        """
+        added, deleted = set(), set()
+        params = {'userId': 'me', 'startHistoryId': start_history_id, 'historyTypes': self.HISTORY_TYPES}
+        while True:
             try:
-                payload = txt['payload']
-                headers = payload['headers']
+                with metrics.timer('gmail_api_seconds', method='history.list'):
+                    result = service.users().history().list(**params).execute()
+            except HttpError as error:
+                if error.status_code == 404:
+                    logger.info(f"History from {start_history_id} has expired, falling back to a full sync")
+                    return None
+                raise
+            self._spend('history.list')
+            self._collect_history(result.get('history', []), added, deleted)
+
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                break
+            params['pageToken'] = page_token
+
+        logger.info(f"History since {start_history_id}: {len(added)} added, {len(deleted)} deleted")
+        return added, deleted
+
+    @classmethod
+    def _collect_history(cls, records, added, deleted):
+        """
+        Adds the message IDs added and deleted by the given history records to the `added` and `deleted`
+        sets, the latest change of a message winning.
+        """
+        for record in records:
+            for change in record.get('messagesAdded', []):
+                added.add(change['message']['id'])
+                deleted.discard(change['message']['id'])
+            for change in record.get('messagesDeleted', []):
+                deleted.add(change['message']['id'])
+                added.discard(change['message']['id'])
+            for change in record.get('labelsAdded', []):
+                if cls.HIDDEN_LABELS & set(change['labelIds']):
+                    deleted.add(change['message']['id'])
+                    added.discard(change['message']['id'])
+            for change in record.get('labelsRemoved', []):
+                if cls.HIDDEN_LABELS & set(change['labelIds']):
+                    added.add(change['message']['id'])
+                    deleted.discard(change['message']['id'])
+
+    def _list_message_ids(self, service, q=None, max_results=None):
+        """
+        Walks every page of messages.list, requesting the next page only once the previous
+        one has been consumed.
 
-                subject = next(d['value'] for d in headers if d['name'] == 'Subject')
-                sender = next(d['value'] for d in headers if d['name'] == 'From')
-                recipient = next(d['value'] for d in headers if d['name'] == 'To')
-                cc = next((d['value'] for d in headers if d['name'] == 'Cc'), None)
-                date_received = next(d['value'] for d in headers if d['name'] == 'Date')
+        Yields:
+            str: The ID of each message in the mailbox that matches `q`.
+        """
+        for _, msg_ids, _ in self._list_pages(service, q=q, max_results=max_results):
+            yield from msg_ids
 
-                parts = payload.get('parts')[0]
-                data = parts['body']['data'].replace("-", "+").replace("_", "/")
-                decoded_data = base64.b64decode(data)
+    def _list_pages(self, service, q=None, max_results=None, page_token=None):
+        """
+        Walks the pages of messages.list, from the page of `page_token` or the first one.
 
-                soup = BeautifulSoup(decoded_data, "lxml")
-                body = soup.body()
+        Yields:
+            tuple: The token the page was requested with (None for the first page), the message IDs
+            on it and the token of the next page (None for the last page).
+        """
+        params = {'userId': 'me'}
+        if q:
+            params['q'] = q
+        if max_results:
+            params['maxResults'] = max_results
+
+        while True:
+            if page_token:
+                params['pageToken'] = page_token
+            with metrics.timer('gmail_api_seconds', method='messages.list'):
+                result = service.users().messages().list(**params).execute()
+            self._spend('messages.list')
+            next_page_token = result.get('nextPageToken')
+            yield page_token, [msg['id'] for msg in result.get('messages') or []], next_page_token
+            if not next_page_token:
+                return
+            page_token = next_page_token
+
+    def _fetch_emails(self, service, msg_ids, bodies=True, failed=None):
+        """
+        Fetches and parses the given messages, with their bodies or only the headers that are stored.
+        With more than one worker, both happen on the ConcurrentFetcher threads and the parsed rows
+        come back to this thread for writing. With parse workers, parsing moves to a ParsePool of
+        processes instead, and only the rows are built on this thread.
 
-                email = self._init_email(msg_id=msg['id'], subject=subject, sender=sender, content=body, recipient=recipient, cc=cc,
-                              date_received=date_received, synced_at=datetime.now())
+        With a message store, messages fetched with their bodies are kept in it, and the ones already
+        stored are read from it instead of being downloaded, once the others are fetched.
 
-                email.save()
+        Messages that cannot be fetched are skipped; when `failed` is given, they are added to it
+        with the error once the messages have been consumed.
 
-                logger.info(f"Subject: {subject}")
-                logger.info(f"From: {sender}")
-                logger.info(f"recipient: {recipient}")
-                logger.info(f"cc: {cc}")
-                logger.info(f"date_received: {date_received}")
-                logger.info(f"msg_id: {msg['id']}")
+        Yields:
+            dict: The email row built from each message.
+        """
+        get_kwargs = {} if bodies else {'format': 'metadata', 'metadataHeaders': self.METADATA_HEADERS}
+        parse = self._parse_message if bodies else self._parse_metadata
+        store = self.message_store if bodies else None
+        stored = []
+        if store is not None:
+            msg_ids = self._skip_stored(msg_ids, stored)
+        msg_ids = self._charge_each(msg_ids, 'messages.get')
+        fetcher = None
+        if self.workers > 1:
+            thread_parse = None if self.parse_workers else parse
+            if store is not None and thread_parse is not None:
+                thread_parse = self._storing(thread_parse)
+            fetcher = ConcurrentFetcher(self._build_service, self.batch_uri, workers=self.workers,
+                                        batch_size=self.batch_size, parse=thread_parse)
+            messages = fetcher.fetch(msg_ids, **get_kwargs)
+        else:
+            messages = self._fetch_messages(service, msg_ids, failed=failed, **get_kwargs)
+        if store is not None and (fetcher is None or self.parse_workers):
+            messages = self._store_each(messages)
+        # read once the fetched messages are consumed, by which time every stored ID has been skipped
+        stored_messages = self._read_stored(stored) if store is not None else ()
+
+        if self.parse_workers:
+            with self._sharing_parse_pool() as pool:
+                parsed_bytes = pool.parsed_bytes
+                messages = itertools.chain(messages, stored_messages)
+                yield from map(self._parsed_row, pool.parse(messages, with_body=bodies))
+            logger.info(f"Parsed {pool.parsed_bytes - parsed_bytes} bytes of messages on {self.parse_workers} "
+                        f"processes")
+        elif fetcher is not None:
+            yield from messages
+            yield from self._parse_messages(stored_messages, parse)
+        else:
+            yield from self._parse_messages(itertools.chain(messages, stored_messages), parse)
+        if fetcher is not None:
+            self.round_trips += fetcher.round_trips
+            if failed is not None:
+                failed.update(fetcher.failed)
+
+    def _skip_stored(self, msg_ids, stored):
+        """
+        Passes through the message IDs that are not in the message store, adding the others to `stored`.
+        """
+        for msg_id in msg_ids:
+            if msg_id in self.message_store:
+                stored.append(msg_id)
+            else:
+                yield msg_id
+
+    def _read_stored(self, msg_ids):
+        """
+        Reads messages from the message store, in the order they lie on disk.
+
+        Yields:
+            dict: Each message resource.
+        """
+        if msg_ids:
+            metrics.increment('message_store_hits_total', len(msg_ids))
+            logger.info(f"Reading {len(msg_ids)} messages from the message store")
+        yield from self.message_store.scan(msg_ids)
+
+    def _store_each(self, messages):
+        """
+        Passes fetched message resources through, putting each in the message store.
+        """
+        for txt in messages:
+            self.message_store.put(txt)
+            yield txt
+
+    def _storing(self, parse):
+        """
+        Wraps a function of a fetched message resource so that the message is put in the message
+        store first. Safe to call from the fetcher threads.
+        """
+        def store_and_parse(txt):
+            self.message_store.put(txt)
+            return parse(txt)
+        return store_and_parse
+
+    def _fetch_messages(self, service, msg_ids, failed=None, **get_kwargs):
+        """
+        Fetches the given messages, `batch_size` at a time through batch requests, or one
+        request per message when batching is disabled. Messages that cannot be fetched are
+        skipped, and added to `failed` with the error when it is given.
+
+        Yields:
+            dict: Each fetched message resource.
+        """
+        failed = {} if failed is None else failed
+        if self.batch_size:
+            fetcher = BatchFetcher(service, self.batch_uri, batch_size=self.batch_size)
+            for txt in fetcher.fetch(msg_ids, **get_kwargs):
+                yield txt
+            self.round_trips += fetcher.round_trips
+            failed.update(fetcher.failed)
+        else:
+            for msg_id in msg_ids:
+                self.round_trips += 1
+                try:
+                    with metrics.timer('gmail_api_seconds', method='messages.get'):
+                        txt = service.users().messages().get(userId='me', id=msg_id, **get_kwargs).execute()
+                except HttpError as error:
+                    logger.error(f"Failed to fetch message {msg_id}: {error}")
+                    metrics.increment('gmail_fetch_errors_total', status=error.status_code)
+                    failed[msg_id] = error
+                    continue
+                yield txt
+
+    def _spend(self, api_method):
+        """
+        Counts a round trip to the given Gmail API method and the quota units it costs.
+        """
+        self.round_trips += 1
+        self._count_call(api_method)
+
+    def _count_call(self, api_method):
+        """
+        Counts a call to the given Gmail API method and the quota units it costs, in `quota_units` and
+        in the metrics.
+        """
+        units = self.QUOTA_UNITS[api_method]
+        self.quota_units += units
+        metrics.increment('gmail_api_calls_total', method=api_method)
+        metrics.increment('gmail_quota_units_total', units, method=api_method)
 
-            except Exception as e:
-                logger.error(f"An error occurred: {e}")
+    def _charge_each(self, msg_ids, api_method):
+        """
+        Passes the message IDs through, counting the quota units of calling the given method on each
+        as they are consumed. Batch requests cost the units of each request they hold.
+        """
+        for msg_id in msg_ids:
+            self._count_call(api_method)
+            yield msg_id
+
+    def _state_key(self, profile):
+        """
+        Returns the key the sync state of this mailbox is stored under: its account, the partition key of
+        its emails, or the email address of its profile when it has none.
+        """
+        return self.account if self.account is not None else profile['emailAddress']
+
+    def _account_clause(self, criterion):
+        """
+        Restricts a condition on the emails table to the emails of this mailbox, when it has an account.
+        """
+        return and_(criterion, Email.account == self.account) if self.account is not None else criterion
+
+    def _parse_messages(self, messages, parse=None):
+        """
+        Parses fetched message resources, skipping the ones that cannot be parsed.
+
+        Yields:
+            dict: The email row built from each message.
+        """
+        parse = parse or self._parse_message
+        for txt in messages:
+            email = parse(txt)
+            if email is not None:
+                yield email
+
+    def _persist_emails(self, emails):
+        """
+        Upserts the given email rows into the database, `upsert_chunk_size` rows per statement.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        inserted, updated = Email.bulk_upsert(emails, chunk_size=self.upsert_chunk_size)
+        logger.info(f"Saved emails: {inserted} inserted, {updated} updated")
+        return inserted + updated
+
+    def _parse_message(self, txt, with_body=True):
+        """
+        Parses a message resource from the Gmail API into an email row.
+
+        Args:
+            txt (dict): The message resource returned by messages.get.
+            with_body (bool): Whether to parse the body into the content; without it the row has no content.
+
+        Returns:
+            The column values of the email, or None if the message could not be parsed.
+        """
+        with metrics.timer('message_parse_seconds'):
+            parsed = parse_message(txt, with_body, self.max_body_chars)
+        return self._parsed_row(parsed) if parsed is not None else None
+
+    def _parse_metadata(self, txt):
+        """
+        Parses a message resource fetched with format=metadata into an email row without content.
+        """
+        return self._parse_message(txt, with_body=False)
+
+    @property
+    def batch_uri(self):
+        """
+        The URI that batch requests are posted to.
+        """
+        return urljoin(self.api_endpoint or self.API_ROOT, self.BATCH_PATH)
+
+    @property
+    def service(self):
+        """
+        The Gmail API service object, built on first use and reused by every call after that.
+
+        Reusing it skips loading the discovery document again, and keeps the underlying httplib2
+        connection to Gmail alive between requests instead of opening a new TLS connection each time.
+        The service object is not thread-safe; worker threads build their own with `_build_service`.
+        """
+        if self._service is None:
+            self._service = self._build_service()
+        return self._service
+
+    def _build_service(self):
+        """
+        Builds a new Gmail API service object from the discovery document bundled with
+        google-api-python-client, pointed at `api_endpoint` when one is set.
+        """
+        if self.api_endpoint:
+            return build('gmail', 'v1', credentials=self.creds, static_discovery=True,
+                         client_options={'api_endpoint': self.api_endpoint})
+        return build('gmail', 'v1', credentials=self.creds, static_discovery=True)
 
     def mark_as_read(self, msg_id):
         """
@@ -121,8 +807,7 @@ class EmailManager:
             msg_id (str): The message ID of the email to mark as read.
         """
         try:
-            service = build('gmail', 'v1', credentials=self.creds)
-            service.users().messages().modify(
+            self.service.users().messages().modify(
                 userId='me',
                 id=msg_id,
                 body={'removeLabelIds': ['UNREAD']}
@@ -130,18 +815,56 @@ class EmailManager:
         except HttpError as error:
             logger.error(f'An error occurred: {error}')
 
+    def batch_modify(self, msg_ids, add_label_ids=None, remove_label_ids=None):
+        """
+        Adds and removes labels on many emails at once, with one messages.batchModify call per
+        `BATCH_MODIFY_LIMIT` message IDs.
+
+        Args:
+            msg_ids (iterable): The message IDs of the emails to modify. Consumed one chunk at a time.
+            add_label_ids (list): The IDs of the labels to add.
+            remove_label_ids (list): The IDs of the labels to remove.
+
+        Returns:
+            list: A ModifyResult per chunk of message IDs sent.
+        """
+        body = {}
+        if add_label_ids:
+            body['addLabelIds'] = list(add_label_ids)
+        if remove_label_ids:
+            body['removeLabelIds'] = list(remove_label_ids)
+
+        results = []
+        msg_ids = iter(msg_ids)
+        while True:
+            chunk = list(itertools.islice(msg_ids, self.BATCH_MODIFY_LIMIT))
+            if not chunk:
+                return results
+            try:
+                with metrics.timer('gmail_api_seconds', method='messages.batchModify'):
+                    self.service.users().messages().batchModify(userId='me', body=dict(body, ids=chunk)).execute()
+                self._count_call('messages.batchModify')
+                metrics.increment('emails_modified_total', len(chunk))
+                results.append(ModifyResult(chunk, None))
+            except HttpError as error:
+                logger.error(f'An error occurred modifying {len(chunk)} emails: {error}')
+                metrics.increment('emails_modify_failed_total', len(chunk))
+                results.append(ModifyResult(chunk, error))
+
     def move_to_label(self, msg_id, new_label_name):
         """
-        Moves the email with the given message ID to the label with the given label ID.
+        Moves the email with the given message ID to the label with the given name.
 
         Args:
             msg_id (str): The message ID of the email to move.
-            new_label_id (str): The ID of the label to move the email to.
+            new_label_name (str): The name of the label to move the email to.
         """
         try:
             new_label_id = self.get_label_id(new_label_name)
-            service = build('gmail', 'v1', credentials=self.creds)
-            service.users().messages().modify(
+            if new_label_id is None:
+                logger.error(f"Label {new_label_name} does not exist, not moving email: {msg_id}")
+                return
+            self.service.users().messages().modify(
                 userId='me',
                 id=msg_id,
                 body={'addLabelIds': [new_label_id]}
@@ -151,7 +874,9 @@ class EmailManager:
 
     def get_label_id(self, label_name):
         """
-        Retrieves the ID of the label with the given name from the Gmail API.
+        Retrieves the ID of the label with the given name. The labels are listed from the Gmail API
+        once and cached; a name missing from the cache refreshes it once, and the label is created
+        when `create_missing_labels` is set.
 
         Args:
             label_name (str): The name of the label.
@@ -159,23 +884,32 @@ class EmailManager:
         Returns:
             The ID of the label, or None if no such label exists.
         """
+        return self.label_cache.get_id(label_name, create=self.create_missing_labels)
+
+    def create_label(self, label_name):
+        """
+        Creates a label with the given name.
+
+        Args:
+            label_name (str): The name of the label.
+
+        Returns:
+            The created label, or None if it could not be created.
+        """
         try:
-            labels = self.get_labels()
-            for label in labels:
-                if label['name'] == label_name:
-                    return label['id']
+            return self.service.users().labels().create(
+                userId='me',
+                body={'name': label_name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}
+            ).execute()
         except HttpError as error:
             logger.error(f'An error occurred: {error}')
 
-        return None
-
     def get_labels(self):
         """
         Retrieves and logs the labels from the Gmail API.
         """
         try:
-            service = build('gmail', 'v1', credentials=self.creds)
-            result = service.users().labels().list(userId='me').execute()
+            result = self.service.users().labels().list(userId='me').execute()
             labels = result.get('labels', [])
 
             for label in labels:
@@ -184,19 +918,35 @@ class EmailManager:
         except HttpError as error:
             logger.error(f'An error occurred: {error}')
 
-    def _init_email(self, msg_id, subject, sender, content, recipient, cc, date_received, synced_at):
+    def _parsed_row(self, parsed):
+        """
+        Builds the email row of a ParsedMessage.
+        """
+        metrics.increment('messages_parsed_total')
+        metrics.increment('gmail_message_bytes_total', parsed.size)
+        headers = parsed.headers
+        return self._email_row(msg_id=parsed.msg_id, subject=headers.subject, sender=headers.sender,
+                               content=parsed.content, recipient=headers.recipient, cc=headers.cc,
+                               date_received=local_naive(headers.date_received), synced_at=datetime.now())
+
+    def _email_row(self, msg_id, subject, sender, content, recipient, cc, date_received, synced_at):
         """
-        Upserts an Email object with the given attributes based on msg_id.
+        Builds the column values of an email row, ready for Email.bulk_upsert. A content of None
+        leaves the content column out, so that upserting the row keeps the content already stored.
         Returns:
-            The initialized/existing Email object.
+            dict: The column values, keyed by column name.
         """
-        email = Email.get_by_msg_id(msg_id) or Email()
-        email.msg_id = msg_id
-        email.subject = subject
-        email.sender = sender
-        email.content = str(content)
-        email.recipient = recipient
-        email.cc = cc
-        email.date_received = date_received
-        email.synced_at = synced_at
-        return email
+        row = {
+            'msg_id': msg_id,
+            'subject': subject,
+            'sender': sender,
+            'recipient': recipient,
+            'cc': cc,
+            'date_received': date_received,
+            'synced_at': synced_at,
+        }
+        if content is not None:
+            row['content'] = str(content)
+        if self.account is not None:
+            row['account'] = self.account
+        return row
@@ -0,0 +1,128 @@
+"""
+header_parser.py
+
+This module parses the headers of a Gmail API message resource in a single pass.
+
+Classes:
+    EmailHeaders: The headers an email row is built from.
+
+Functions:
+    index_headers: Builds a case-insensitive index of a header list.
+    decode_words: Decodes the RFC 2047 encoded words of a header value.
+    parse_date: Parses a Date header into a timezone-aware datetime.
+    local_naive: Converts a timezone-aware datetime to the naive local time the database stores.
+
+"""
+
+from datetime import datetime, timezone
+from email.errors import HeaderParseError
+from email.header import decode_header, make_header
+from email.utils import parsedate_to_datetime
+
+# headers that may legitimately be repeated, whose values are joined rather than the first one kept
+ADDRESS_HEADERS = {'from', 'to', 'cc'}
+
+
+class EmailHeaders:
+    """
+    The headers of an email, decoded. Any header the message lacks is None.
+
+    Attributes:
+        subject (str): The subject.
+        sender (str): The From header.
+        recipient (str): The To header.
+        cc (str): The Cc header.
+        date_received (datetime): The Date header, timezone-aware.
+    """
+
+    __slots__ = ('subject', 'sender', 'recipient', 'cc', 'date_received')
+
+    def __init__(self, subject=None, sender=None, recipient=None, cc=None, date_received=None):
+        self.subject = subject
+        self.sender = sender
+        self.recipient = recipient
+        self.cc = cc
+        self.date_received = date_received
+
+    def __eq__(self, other):
+        return isinstance(other, EmailHeaders) and all(getattr(self, name) == getattr(other, name)
+                                                       for name in self.__slots__)
+
+    def __repr__(self):
+        return 'EmailHeaders(' + ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__) + ')'
+
+    @classmethod
+    def from_headers(cls, headers, internal_date=None):
+        """
+        Parses the header list of a message payload.
+
+        Args:
+            headers (list): The headers of the payload, as dicts with a name and a value.
+            internal_date (str): The internalDate of the message, in milliseconds since the epoch, used
+                when the Date header is missing or cannot be parsed.
+
+        Returns:
+            EmailHeaders: The parsed headers.
+        """
+        index = index_headers(headers)
+        date_received = parse_date(index.get('date'))
+        if date_received is None and internal_date:
+            date_received = datetime.fromtimestamp(int(internal_date) / 1000, timezone.utc)
+        return cls(subject=decode_words(index.get('subject')), sender=decode_words(index.get('from')),
+                   recipient=decode_words(index.get('to')), cc=decode_words(index.get('cc')),
+                   date_received=date_received)
+
+
+def index_headers(headers):
+    """
+    Builds a case-insensitive index of a header list in one pass. Repeated address headers are joined
+    with a comma; for any other header the first occurrence wins.
+
+    Returns:
+        dict: The header values, keyed by lowercase header name.
+    """
+    index = {}
+    for header in headers:
+        name = header['name'].lower()
+        if name not in index:
+            index[name] = header['value']
+        elif name in ADDRESS_HEADERS:
+            index[name] = f"{index[name]}, {header['value']}"
+    return index
+
+
+def decode_words(value):
+    """
+    Decodes the RFC 2047 encoded words of a header value, e.g. =?utf-8?q?Caf=C3=A9?=. Values that
+    cannot be decoded are returned as they are.
+    """
+    if value is None or '=?' not in value:
+        return value
+    try:
+        return str(make_header(decode_header(value)))
+    except (HeaderParseError, LookupError, UnicodeDecodeError):
+        return value
+
+
+def parse_date(value):
+    """
+    Parses a Date header. A date without a timezone is taken to be in UTC.
+
+    Returns:
+        datetime: The timezone-aware date, or None if the value is missing or cannot be parsed.
+    """
+    if not value:
+        return None
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    return date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)
+
+
+def local_naive(value):
+    """
+    Converts a timezone-aware datetime to naive local time, which is how the emails table stores dates
+    and what rules compare them against.
+    """
+    return value.astimezone().replace(tzinfo=None) if value is not None else None
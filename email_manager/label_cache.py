@@ -0,0 +1,134 @@
+"""
+label_cache.py
+
+This module contains the LabelCache class which maps Gmail label names to label IDs.
+
+Classes:
+    LabelCache: Caches label name to ID lookups in memory and, optionally, in a file.
+
+"""
+
+import json
+import os.path
+import time
+
+from logger import logger
+
+
+class LabelCache:
+    """
+    Caches label name to ID lookups. The labels are listed once and kept in memory for the rest
+    of the run; with a `cache_file` they are also written to disk and reused by later runs until
+    they are older than `ttl` seconds. Their age counts from the last time all the labels were listed;
+    adding a created label keeps it.
+
+    A name missing from the cache triggers one refresh, since the label may have been created since
+    the labels were listed. If it is still missing it can be created on demand; otherwise it is
+    remembered as missing, so that looking it up again does not list the labels again.
+
+    Attributes:
+        list_labels (callable): Returns the labels of the mailbox, as returned by labels.list, or None on failure.
+        create_label (callable): Creates a label from its name and returns it, or None if labels are never created.
+        cache_file (str): The path to the file the labels are persisted to, or None to keep them in memory only.
+        ttl (float): The number of seconds a persisted cache stays valid.
+    """
+
+    def __init__(self, list_labels, create_label=None, cache_file=None, ttl=3600):
+        self.list_labels = list_labels
+        self.create_label = create_label
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._ids = None
+        self._missing = set()
+        # when the labels cached were listed, 0 when they never were
+        self._listed_at = 0
+
+    def get_id(self, name, create=False):
+        """
+        Retrieves the ID of the label with the given name.
+
+        Args:
+            name (str): The name of the label.
+            create (bool): Whether to create the label if it does not exist.
+
+        Returns:
+            The ID of the label, or None if no such label exists.
+        """
+        label_id = self.lookup(name)
+        if label_id is None and name not in self._missing:
+            labels = self.list_labels()
+            # None means listing failed, which is no reason to forget the labels already cached
+            if labels is not None:
+                self.update(labels)
+                label_id = self.lookup(name)
+        if label_id is None and create and self.create_label is not None:
+            logger.info(f"Creating missing label: {name}")
+            label = self.create_label(name)
+            if label:
+                self.add(label)
+                label_id = label['id']
+        if label_id is None:
+            self._missing.add(name)
+        return label_id
+
+    def lookup(self, name):
+        """
+        Looks the label up in the cache only, loading the persisted cache on first use.
+
+        Returns:
+            The ID of the label, or None if it is not cached.
+        """
+        if self._ids is None:
+            self._ids = self._load()
+        return self._ids.get(name)
+
+    def update(self, labels):
+        """
+        Replaces the cached labels with the given ones.
+
+        Args:
+            labels (list): The labels, as returned by labels.list.
+        """
+        self._ids = dict((label['name'], label['id']) for label in labels)
+        self._listed_at = time.time()
+        self._save()
+
+    def add(self, label):
+        """
+        Adds a single label to the cache, without extending the time the persisted cache stays valid.
+        """
+        if self._ids is None:
+            self._ids = self._load()
+        self._ids[label['name']] = label['id']
+        self._missing.discard(label['name'])
+        self._save()
+
+    def invalidate(self):
+        """
+        Drops the cached labels, in memory and on disk.
+        """
+        self._ids = {}
+        self._missing = set()
+        self._listed_at = 0
+        if self.cache_file and os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ignoring unreadable label cache {self.cache_file}: {e}")
+            return {}
+        if time.time() - data.get('updated_at', 0) > self.ttl:
+            return {}
+        self._listed_at = data['updated_at']
+        return data.get('labels', {})
+
+    def _save(self):
+        if not self.cache_file:
+            return
+        with open(self.cache_file, 'w') as f:
+            json.dump({'updated_at': self._listed_at, 'labels': self._ids}, f)
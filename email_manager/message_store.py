@@ -0,0 +1,413 @@
+"""
+message_store.py
+
+This module contains the MessageStore class, a local on-disk store of the raw Gmail messages synced, so
+that they can be parsed again without downloading them.
+
+Classes:
+    MessageStore: Keeps compressed message resources in append-only segment files, with an mmap'd index.
+
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from instrumentation import metrics
+from logger import logger
+
+DEFAULT_MAX_BYTES = 2 ** 31
+DEFAULT_SEGMENT_BYTES = 2 ** 26
+# fields of a message resource that change over its life; the rest of it never does
+VOLATILE_FIELDS = ('labelIds', 'historyId')
+
+
+class MessageStore:
+    """
+    Stores message resources, as returned by messages.get, on disk keyed by message ID. Gmail messages
+    never change except for their labels, so a message stored once can be parsed again at any time,
+    after a parser fix or when rules start looking at bodies, without going to the network.
+
+    Messages are stored as zlib-compressed JSON, without their labels, in append-only segment files of
+    about `segment_bytes` each. Every record carries the message ID and the digest of its content, so a
+    message stored again unchanged is not written twice, and a record damaged on disk is detected when
+    read. The index is a file of fixed-size slots, message ID to digest and location, mapped in memory;
+    a message stored again or discarded gets a new slot, and the latest slot of a message wins. The
+    index is rebuilt from the segments if it is lost, which brings back the discarded messages whose
+    records have not been compacted away yet.
+
+    When the segments grow past `max_bytes`, the oldest ones are deleted with the messages in them,
+    which are downloaded again the next time they are needed. `compact` rewrites the segments mostly
+    made of superseded records and drops the dead slots of the index.
+
+    A store is safe to use from several threads, but not from several processes at once.
+
+    Attributes:
+        directory (str): The directory holding the segment and index files.
+        max_bytes (int): The size the segments are kept under, by deleting the oldest ones.
+        segment_bytes (int): The size at which a segment is closed and a new one started.
+        compression_level (int): The zlib compression level of the stored messages.
+    """
+
+    INDEX_FILE = 'index'
+    SEGMENT_PATTERN = re.compile(r'^segment-(\d{6})$')
+    MAGIC = b'GMSTORE1'
+    HEADER = struct.Struct('<8sQ')  # magic, number of slots used
+    # message ID, content digest, segment (0 for a discarded message), offset and length of the data
+    SLOT = struct.Struct('<32s16sIQI')
+    # the header of each record in a segment, followed by its compressed data
+    RECORD = struct.Struct('<32s16sI')  # message ID, content digest, length of the data
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 compression_level=6):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.compression_level = compression_level
+        self._lock = threading.RLock()
+        self._slots = {}
+        self._live_bytes = {}
+        self._readers = {}
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = dict((int(match.group(1)), os.path.getsize(os.path.join(directory, name)))
+                           for match, name in ((self.SEGMENT_PATTERN.match(name), name)
+                                               for name in os.listdir(directory)) if match)
+        self._open_index()
+        self._active = max(self._sizes, default=0)
+        self._writer = None
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._slots
+
+    def __iter__(self):
+        return iter(list(self._slots))
+
+    @property
+    def size(self):
+        """
+        The number of bytes of the segments.
+        """
+        return sum(self._sizes.values())
+
+    def put(self, message):
+        """
+        Stores a message resource, unless it is stored already with the same content.
+
+        Args:
+            message (dict): The message resource returned by messages.get, in the full format.
+
+        Returns:
+            bool: Whether the message was written.
+        """
+        msg_id = message['id']
+        raw = json.dumps(dict((field, value) for field, value in message.items() if field not in VOLATILE_FIELDS),
+                         separators=(',', ':'), sort_keys=True).encode()
+        digest = hashlib.blake2b(raw, digest_size=16).digest()
+        key = self._key(msg_id)
+        with self._lock:
+            slot = self._slots.get(msg_id)
+            if slot is not None and self._read_slot(slot)[1] == digest:
+                return False
+            data = zlib.compress(raw, self.compression_level)
+            segment, offset = self._append(self.RECORD.pack(key, digest, len(data)) + data)
+            self._set(msg_id, key, digest, segment, offset, len(data))
+            self._evict()
+        metrics.increment('message_store_bytes_written_total', self.RECORD.size + len(data))
+        return True
+
+    def get(self, msg_id):
+        """
+        Reads a stored message.
+
+        Returns:
+            dict: The message resource, without its labels, or None if it is not stored or its record is damaged.
+        """
+        with self._lock:
+            slot = self._slots.get(msg_id)
+            if slot is None:
+                return None
+            _, digest, segment, offset, length = self._read_slot(slot)
+            data = os.pread(self._reader(segment), length, offset)
+        metrics.increment('message_store_bytes_read_total', length)
+        try:
+            raw = zlib.decompress(data)
+        except zlib.error:
+            raw = None
+        if raw is None or hashlib.blake2b(raw, digest_size=16).digest() != digest:
+            logger.error(f"The stored record of message {msg_id} is damaged, discarding it")
+            self.discard([msg_id])
+            return None
+        return json.loads(raw)
+
+    def scan(self, msg_ids=None):
+        """
+        Reads stored messages in the order they lie on disk, which makes reading many of them a
+        sequential read of the segments.
+
+        Args:
+            msg_ids (iterable): The message IDs of the messages to read, or None for all the stored messages.
+                Those not stored are skipped.
+
+        Yields:
+            dict: Each message resource, without its labels.
+        """
+        with self._lock:
+            msg_ids = self._slots if msg_ids is None else [msg_id for msg_id in msg_ids if msg_id in self._slots]
+            located = sorted((self._read_slot(self._slots[msg_id])[2:4], msg_id) for msg_id in msg_ids)
+        for _, msg_id in located:
+            message = self.get(msg_id)
+            if message is not None:
+                yield message
+
+    def discard(self, msg_ids):
+        """
+        Removes the given messages from the store, e.g. once they are deleted from the mailbox. Their
+        records stay in the segments until these are compacted or evicted.
+
+        Returns:
+            int: The number of messages removed.
+        """
+        discarded = 0
+        with self._lock:
+            for msg_id in msg_ids:
+                if msg_id in self._slots:
+                    self._set(msg_id, self._key(msg_id), bytes(16), 0, 0, 0)
+                    discarded += 1
+        return discarded
+
+    def compact(self, min_garbage=0.5):
+        """
+        Rewrites the closed segments in which at least `min_garbage` of the bytes belong to superseded or
+        discarded messages, copying their live records to the active segment, and rewrites the index
+        with only the slots in use.
+
+        Returns:
+            int: The number of bytes freed.
+        """
+        with self._lock:
+            victims = set(segment for segment, size in self._sizes.items()
+                          if segment != self._active and size
+                          and 1 - self._live_bytes.get(segment, 0) / size >= min_garbage)
+            if not victims and self._count <= 2 * len(self._slots):
+                return 0
+
+            size = self.size
+            slots = dict((msg_id, self._read_slot(slot)) for msg_id, slot in self._slots.items())
+            for msg_id, (key, digest, segment, offset, length) in sorted(slots.items(), key=lambda item: item[1][2:4]):
+                if segment in victims:
+                    record = os.pread(self._reader(segment), self.RECORD.size + length, offset - self.RECORD.size)
+                    segment, offset = self._append(record)
+                    slots[msg_id] = (key, digest, segment, offset, length)
+            self._writer_flush()
+            self._write_index(slots.values())
+            for segment in victims:
+                self._remove_segment(segment)
+            freed = size - self.size
+        logger.info(f"Compacted the message store: {len(victims)} segments rewritten, {freed} bytes freed")
+        return freed
+
+    def close(self):
+        """
+        Closes the files of the store. Closing it again does nothing.
+        """
+        with self._lock:
+            if self._index.closed:
+                return
+            self._writer_flush()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for fd in self._readers.values():
+                os.close(fd)
+            self._readers.clear()
+            self._index.flush()
+            self._index.close()
+            self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _key(msg_id):
+        key = msg_id.encode()
+        if len(key) > 32:
+            raise ValueError(f"Message IDs are stored on 32 bytes at most, got {msg_id!r}")
+        return key
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f'segment-{segment:06d}')
+
+    def _append(self, record):
+        """
+        Appends a record to the active segment, starting a new segment when it is full.
+
+        Returns:
+            tuple: The segment and the offset of the record's data in it.
+        """
+        if self._writer is None or self._sizes[self._active] + len(record) > self.segment_bytes:
+            if self._writer is not None:
+                self._writer.close()
+            # a record larger than a segment gets a segment of its own
+            if not self._active or self._sizes[self._active] and \
+                    self._sizes[self._active] + len(record) > self.segment_bytes:
+                self._active += 1
+                self._sizes[self._active] = 0
+            self._writer = open(self._segment_path(self._active), 'ab', buffering=0)
+        offset = self._sizes[self._active]
+        self._writer.write(record)
+        self._sizes[self._active] += len(record)
+        return self._active, offset + self.RECORD.size
+
+    def _writer_flush(self):
+        # the writer is unbuffered, this only makes the segment durable
+        if self._writer is not None:
+            os.fsync(self._writer.fileno())
+
+    def _reader(self, segment):
+        fd = self._readers.get(segment)
+        if fd is None:
+            fd = self._readers[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return fd
+
+    def _remove_segment(self, segment):
+        fd = self._readers.pop(segment, None)
+        if fd is not None:
+            os.close(fd)
+        os.remove(self._segment_path(segment))
+        del self._sizes[segment]
+        self._live_bytes.pop(segment, None)
+
+    def _evict(self):
+        """
+        Deletes the oldest segments, and the messages in them, until the segments fit in `max_bytes`.
+        """
+        evicted = set()
+        while self.size > self.max_bytes and len(self._sizes) > 1:
+            segment = min(self._sizes)
+            self._remove_segment(segment)
+            evicted.add(segment)
+        if evicted:
+            msg_ids = [msg_id for msg_id, slot in self._slots.items() if self._read_slot(slot)[2] in evicted]
+            for msg_id in msg_ids:
+                del self._slots[msg_id]
+            logger.info(f"Evicted {len(evicted)} segments of the message store, with {len(msg_ids)} messages")
+            metrics.increment('message_store_evicted_total', len(msg_ids))
+
+    def _open_index(self):
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        lost = not os.path.exists(path)
+        if lost:
+            with open(path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, 0))
+        self._index_file = open(path, 'r+b')
+        self._map_index(1024)
+        magic, self._count = self.HEADER.unpack_from(self._index, 0)
+        if (lost and self._sizes) or magic != self.MAGIC \
+                or self.HEADER.size + self._count * self.SLOT.size > len(self._index):
+            logger.warning(f"The index of the message store in {self.directory} is missing or damaged, rebuilding it")
+            self._rebuild_index()
+            return
+
+        for slot in range(self._count):
+            key, _, segment, offset, length = self._read_slot(slot)
+            msg_id = key.rstrip(b'\0').decode()
+            self._unlink(msg_id)
+            # slots pointing past the end of a segment were written before a crash lost the record
+            if segment and offset + length <= self._sizes.get(segment, 0):
+                self._slots[msg_id] = slot
+                self._live_bytes[segment] = self._live_bytes.get(segment, 0) + self.RECORD.size + length
+
+    def _rebuild_index(self):
+        """
+        Writes the index again from the records of the segments, the latest record of a message winning.
+        """
+        slots = {}
+        for segment in sorted(self._sizes):
+            with open(self._segment_path(segment), 'rb') as f:
+                offset = 0
+                while True:
+                    header = f.read(self.RECORD.size)
+                    if len(header) < self.RECORD.size:
+                        break
+                    key, digest, length = self.RECORD.unpack(header)
+                    offset += self.RECORD.size
+                    if offset + length > self._sizes[segment]:
+                        break
+                    f.seek(length, os.SEEK_CUR)
+                    slots[key] = (key, digest, segment, offset, length)
+                    offset += length
+        self._write_index(slots.values())
+
+    def _write_index(self, slots):
+        """
+        Replaces the index with one made of the given slots, atomically.
+        """
+        slots = list(slots)
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(slots)))
+            for slot in slots:
+                f.write(self.SLOT.pack(*slot))
+            f.flush()
+            os.fsync(f.fileno())
+        if getattr(self, '_index', None) is not None:
+            self._index.close()
+            self._index_file.close()
+        os.replace(path + '.tmp', path)
+        self._index_file = open(path, 'r+b')
+        self._map_index(len(slots) + 1024)
+        self._count = len(slots)
+        self._slots, self._live_bytes = {}, {}
+        for slot, (key, _, segment, _, length) in enumerate(slots):
+            self._slots[key.rstrip(b'\0').decode()] = slot
+            self._live_bytes[segment] = self._live_bytes.get(segment, 0) + self.RECORD.size + length
+
+    def _map_index(self, capacity):
+        """
+        Maps the index file in memory, growing it to hold at least `capacity` slots.
+        """
+        size = self.HEADER.size + capacity * self.SLOT.size
+        self._index_file.seek(0, os.SEEK_END)
+        if self._index_file.tell() < size:
+            self._index_file.truncate(size)
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+
+    def _read_slot(self, slot):
+        return self.SLOT.unpack_from(self._index, self.HEADER.size + slot * self.SLOT.size)
+
+    def _set(self, msg_id, key, digest, segment, offset, length):
+        """
+        Writes the next slot of the index, and makes it the slot of the message.
+        """
+        if self.HEADER.size + (self._count + 1) * self.SLOT.size > len(self._index):
+            self._index.close()
+            self._map_index(2 * self._count)
+        self.SLOT.pack_into(self._index, self.HEADER.size + self._count * self.SLOT.size,
+                            key, digest, segment, offset, length)
+        self._unlink(msg_id)
+        if segment:
+            self._slots[msg_id] = self._count
+            self._live_bytes[segment] = self._live_bytes.get(segment, 0) + self.RECORD.size + length
+        self._count += 1
+        self.HEADER.pack_into(self._index, 0, self.MAGIC, self._count)
+
+    def _unlink(self, msg_id):
+        """
+        Forgets the slot of a message, and counts its record as garbage.
+        """
+        slot = self._slots.pop(msg_id, None)
+        if slot is not None:
+            _, _, segment, _, length = self._read_slot(slot)
+            if segment in self._live_bytes:
+                self._live_bytes[segment] -= self.RECORD.size + length
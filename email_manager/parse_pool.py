@@ -0,0 +1,152 @@
+"""
+parse_pool.py
+
+This module parses fetched Gmail messages, optionally on a pool of worker processes.
+
+Classes:
+    ParsedMessage: The compact record a message resource is parsed into.
+    ParsePool: Parses messages on worker processes, in chunks, with a bounded number in flight.
+
+Functions:
+    parse_message: Parses a message resource into a ParsedMessage.
+    parse_chunk: Parses a chunk of message resources; what the worker processes run.
+
+"""
+
+import itertools
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from email_manager.body_extractor import DEFAULT_MAX_CHARS, extract_body
+from email_manager.header_parser import EmailHeaders
+from logger import configure, debug_sampled, logger, sample_rate
+
+# headers is an EmailHeaders, content is None when the body was not parsed, size is Gmail's sizeEstimate
+ParsedMessage = namedtuple('ParsedMessage', ['msg_id', 'headers', 'content', 'size'])
+
+
+def parse_message(txt, with_body=True, max_body_chars=DEFAULT_MAX_CHARS):
+    """
+    Parses a message resource from the Gmail API.
+
+    Args:
+        txt (dict): The message resource returned by messages.get.
+        with_body (bool): Whether to extract the body; without it the content is None.
+        max_body_chars (int): The number of characters of the body kept at most, or None for no limit.
+
+    Returns:
+        ParsedMessage: The parsed message, or None if the message could not be parsed.
+    """
+    try:
+        payload = txt['payload']
+        headers = EmailHeaders.from_headers(payload.get('headers', []), txt.get('internalDate'))
+        content = extract_body(payload, max_body_chars) if with_body else None
+        debug_sampled('parsed', "Parsed %s: %s", txt['id'], headers)
+        return ParsedMessage(txt['id'], headers, content, txt.get('sizeEstimate', 0))
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        return None
+
+
+def parse_chunk(messages, with_body=True, max_body_chars=DEFAULT_MAX_CHARS):
+    """
+    Parses a chunk of message resources, dropping the ones that cannot be parsed.
+
+    Returns:
+        list: The ParsedMessage of each message.
+    """
+    return [parsed for parsed in (parse_message(txt, with_body, max_body_chars) for txt in messages)
+            if parsed is not None]
+
+
+def _init_worker(level, debug_sample_rate):
+    # spawned workers import the logger afresh, at its default level
+    configure(level, debug_sample_rate)
+
+
+class ParsePool:
+    """
+    Parses messages on a pool of worker processes, so that decoding and HTML stripping use more than
+    one core. Messages are sent to the workers `chunk_size` at a time to amortize the cost of pickling
+    them across, and only the compact ParsedMessage records come back; writing to the database stays
+    with the caller. At most `max_in_flight` chunks are submitted ahead of the consumer, which bounds
+    the memory held by the parent however fast messages are fetched.
+
+    The worker processes are started by the first parse and reused by the next ones, as starting them
+    costs more than parsing a list page of messages; close the pool, or use it as a context manager,
+    to stop them. Workers are started with the spawn method, which is safe alongside the fetcher
+    threads, and log at the level of the parent's logger. Being separate processes, they do not report to the parent's
+    metrics; the parent counts the parsed messages and bytes as they come back.
+
+    Attributes:
+        workers (int): The number of worker processes.
+        chunk_size (int): The number of messages sent to a worker at a time.
+        max_in_flight (int): The number of chunks that may be parsed ahead of the consumer.
+        max_body_chars (int): The number of characters of each body kept at most, or None for no limit.
+        parsed_bytes (int): The sizeEstimate of the messages parsed so far.
+    """
+
+    def __init__(self, workers=4, chunk_size=100, max_in_flight=None, max_body_chars=DEFAULT_MAX_CHARS):
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight or workers * 2
+        self.max_body_chars = max_body_chars
+        self.parsed_bytes = 0
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stops the worker processes, once the chunks submitted are parsed. A later parse starts new ones.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_worker, initargs=(logger.level, sample_rate()))
+        return self._executor
+
+    def parse(self, messages, with_body=True):
+        """
+        Parses the given messages on the worker processes.
+
+        Args:
+            messages (iterable): The message resources to parse. Consumed lazily.
+            with_body (bool): Whether to extract the bodies.
+
+        Yields:
+            ParsedMessage: The parsed messages, in completion order.
+        """
+        messages = iter(messages)
+        executor = self._start()
+        pending = set()
+        while True:
+            chunk = list(itertools.islice(messages, self.chunk_size))
+            if not chunk:
+                break
+            if len(pending) >= self.max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from self._collect(done)
+            pending.add(executor.submit(parse_chunk, chunk, with_body, self.max_body_chars))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from self._collect(done)
+
+    def _collect(self, futures):
+        for future in futures:
+            for parsed in future.result():
+                self.parsed_bytes += parsed.size
+                yield parsed
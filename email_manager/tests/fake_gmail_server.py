@@ -0,0 +1,366 @@
+"""
+fake_gmail_server.py
+
+A small in-process HTTP server that speaks enough of the Gmail REST API for the
+EmailManager tests to run against a real transport instead of mocks.
+
+Classes:
+    FakeGmailServer: Serves a fake mailbox over HTTP on localhost.
+
+Functions:
+    make_message: Builds a Gmail API message resource with the given headers.
+
+"""
+
+import base64
+import json
+import random
+import re
+import threading
+import time
+from collections.abc import Mapping
+import uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def make_message(msg_id, subject='Hello', sender='sender@example.com', recipient='me@example.com', cc=None,
+                 date='Sat, 23 Mar 2024 10:00:00 +0000', body='<html><body><p>Hello</p></body></html>'):
+    """
+    Builds a Gmail API message resource in the shape returned by messages.get.
+
+    Returns:
+        dict: The message resource.
+    """
+    headers = [
+        {'name': 'Subject', 'value': subject},
+        {'name': 'From', 'value': sender},
+        {'name': 'To', 'value': recipient},
+        {'name': 'Date', 'value': date},
+    ]
+    if cc is not None:
+        headers.append({'name': 'Cc', 'value': cc})
+    data = base64.urlsafe_b64encode(body.encode()).decode()
+    return {
+        'id': msg_id,
+        'threadId': msg_id,
+        'labelIds': ['INBOX', 'UNREAD'],
+        # roughly the size of the raw message, which is what Gmail estimates
+        'sizeEstimate': len(body) + sum(len(h['name']) + len(h['value']) + 4 for h in headers),
+        'payload': {
+            'mimeType': 'multipart/alternative',
+            'headers': headers,
+            'parts': [{'mimeType': 'text/html', 'body': {'size': len(body), 'data': data}}],
+        },
+    }
+
+
+class FakeGmailServer:
+    """
+    Serves a fake mailbox over HTTP on localhost.
+
+    Use it as a context manager; `url` is the value to pass as the EmailManager api_endpoint.
+
+    The mailbox is a dict built from the given messages, or the given mapping itself, which lets a
+    benchmark serve a large mailbox whose messages are generated on demand. Messages are added and
+    deleted through add_message and delete_message, and label changes store a new resource.
+
+    Attributes:
+        messages (Mapping): The mailbox, message ID to message resource.
+        page_size (int): The default number of message IDs per list page.
+        history_id (int): The current mailbox historyId.
+        history (list): The history records, oldest first, in the shape returned by history.list.
+        min_history_id (int): The oldest startHistoryId history.list still accepts.
+        labels (list): The mailbox labels, in the shape returned by labels.list.
+        fail_once (set): Message IDs whose first get returns 503, to exercise retries.
+        error_rate (float): The fraction of message gets answered with 503 at random.
+        quota_units_per_second (float): The per-user quota, in Gmail quota units; calls beyond it are
+            answered with 429. None for no quota.
+        latency (float): Seconds every HTTP request is held before it is answered.
+        errors_injected (int): Number of gets answered with 503 because of `error_rate`.
+        quota_rejections (int): Number of calls answered with 429 because of the quota.
+        http_requests (int): Number of HTTP requests the server has received.
+        bytes_sent (int): Number of response body bytes the server has sent.
+        peak_concurrency (int): The largest number of HTTP requests handled at the same time.
+        batch_sizes (list): Number of sub-requests in each batch request received.
+    """
+
+    ROUTES = [
+        ('GET', re.compile(r'^/gmail/v1/users/(?P<user>[^/]+)/messages$'), '_list_messages'),
+        ('GET', re.compile(r'^/gmail/v1/users/(?P<user>[^/]+)/messages/(?P<msg_id>[^/]+)$'), '_get_message'),
+        ('GET', re.compile(r'^/gmail/v1/users/(?P<user>[^/]+)/profile$'), '_get_profile'),
+        ('GET', re.compile(r'^/gmail/v1/users/(?P<user>[^/]+)/history$'), '_list_history'),
+        ('POST', re.compile(r'^/gmail/v1/users/(?P<user>[^/]+)/messages/batchModify$'), '_batch_modify'),
+        ('POST', re.compile(r'^/gmail/v1/users/(?P<user>[^/]+)/messages/(?P<msg_id>[^/]+)/modify$'), '_modify_message'),
+        ('GET', re.compile(r'^/gmail/v1/users/(?P<user>[^/]+)/labels$'), '_list_labels'),
+    ]
+    # Gmail API quota units of each route, see https://developers.google.com/gmail/api/reference/quota
+    QUOTA_UNITS = {
+        '_list_messages': 5,
+        '_get_message': 5,
+        '_get_profile': 1,
+        '_list_history': 2,
+        '_batch_modify': 50,
+        '_modify_message': 5,
+        '_list_labels': 1,
+    }
+
+    def __init__(self, messages=None, page_size=100, email_address='me@example.com', error_rate=0,
+                 quota_units_per_second=None, seed=0):
+        if isinstance(messages, Mapping):
+            self.messages = messages
+        else:
+            self.messages = dict((m['id'], m) for m in messages or [])
+        self.page_size = page_size
+        self.email_address = email_address
+        self.history_id = 1000
+        self.history = []
+        self.min_history_id = 0
+        self.labels = [{'id': 'INBOX', 'name': 'INBOX', 'type': 'system'},
+                       {'id': 'UNREAD', 'name': 'UNREAD', 'type': 'system'}]
+        self.fail_once = set()
+        self.error_rate = error_rate
+        self.quota_units_per_second = quota_units_per_second
+        self.latency = 0
+        self.errors_injected = 0
+        self.quota_rejections = 0
+        self._random = random.Random(seed)
+        self._quota = None
+        self._quota_updated = None
+        self._sorted_ids = None
+        self.http_requests = 0
+        self.bytes_sent = 0
+        self.peak_concurrency = 0
+        self._active = 0
+        self.batch_sizes = []
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def __enter__(self):
+        # the default listen backlog of 5 drops connections when many clients connect at once
+        httpd_class = type('HTTPServer', (ThreadingHTTPServer,), {'request_queue_size': 128})
+        self._httpd = httpd_class(('127.0.0.1', 0), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def add_message(self, message):
+        """
+        Adds a message to the mailbox and records a messageAdded history entry.
+        """
+        self.messages[message['id']] = message
+        self._sorted_ids = None
+        self._record('messagesAdded', {'message': {'id': message['id']}})
+
+    def delete_message(self, msg_id):
+        """
+        Deletes a message from the mailbox and records a messageDeleted history entry.
+        """
+        self.messages.pop(msg_id)
+        self._sorted_ids = None
+        self._record('messagesDeleted', {'message': {'id': msg_id}})
+
+    def add_labels(self, msg_id, label_ids):
+        """
+        Adds labels to a message and records a labelAdded history entry.
+        """
+        message = self.messages[msg_id]
+        self.messages[msg_id] = dict(message, labelIds=sorted(set(message['labelIds']) | set(label_ids)))
+        self._record('labelsAdded', {'message': {'id': msg_id}, 'labelIds': list(label_ids)})
+
+    def _record(self, history_type, change):
+        self.history_id += 1
+        self.history.append({'id': str(self.history_id), history_type: [change]})
+
+    def dispatch(self, method, path, query, body):
+        """
+        Routes a single API call to its handler.
+
+        Returns:
+            tuple: The HTTP status code and the JSON-serializable response body.
+        """
+        for route_method, pattern, handler in self.ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                if not self._charge_quota(self.QUOTA_UNITS[handler]):
+                    return 429, {'error': {'code': 429, 'message': 'User-rate limit exceeded.'}}
+                return getattr(self, handler)(query, body, **match.groupdict())
+        return 404, {'error': {'code': 404, 'message': f'No route for {method} {path}'}}
+
+    def _charge_quota(self, units):
+        # a token bucket holding one second of quota; the call is rejected when it is short of units
+        if self.quota_units_per_second is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self._quota is None:
+                self._quota = self.quota_units_per_second
+            else:
+                self._quota = min(self.quota_units_per_second,
+                                  self._quota + (now - self._quota_updated) * self.quota_units_per_second)
+            self._quota_updated = now
+            if self._quota < units:
+                self.quota_rejections += 1
+                return False
+            self._quota -= units
+            return True
+
+    def _list_messages(self, query, body, user):
+        # q is matched as a plain substring of any header value, which is enough to shard a test mailbox
+        q = query.get('q', [None])[0]
+        if q is None:
+            with self._lock:
+                if self._sorted_ids is None:
+                    self._sorted_ids = sorted(self.messages)
+                ids = self._sorted_ids
+        else:
+            ids = sorted(msg_id for msg_id, msg in self.messages.items()
+                         if any(q in h['value'] for h in msg['payload']['headers']))
+        start = int(query.get('pageToken', ['0'])[0])
+        size = int(query.get('maxResults', [self.page_size])[0])
+        page = ids[start:start + size]
+        result = {'messages': [{'id': i, 'threadId': i} for i in page], 'resultSizeEstimate': len(ids)}
+        if start + size < len(ids):
+            result['nextPageToken'] = str(start + size)
+        return 200, result
+
+    def _get_message(self, query, body, user, msg_id):
+        with self._lock:
+            if msg_id in self.fail_once:
+                self.fail_once.discard(msg_id)
+                return 503, {'error': {'code': 503, 'message': 'Backend Error'}}
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors_injected += 1
+                return 503, {'error': {'code': 503, 'message': 'Backend Error'}}
+        if msg_id not in self.messages:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        message = self.messages[msg_id]
+        if query.get('format', ['full'])[0] == 'metadata':
+            # no body, and only the headers asked for when metadataHeaders is given
+            names = set(name.lower() for name in query.get('metadataHeaders', []))
+            payload = dict((key, value) for key, value in message['payload'].items() if key not in ('parts', 'body'))
+            if names:
+                payload['headers'] = [header for header in payload['headers'] if header['name'].lower() in names]
+            message = dict(message, payload=payload)
+        return 200, message
+
+    def _get_profile(self, query, body, user):
+        return 200, {'emailAddress': self.email_address, 'messagesTotal': len(self.messages),
+                     'historyId': str(self.history_id)}
+
+    def _list_history(self, query, body, user):
+        start_history_id = int(query['startHistoryId'][0])
+        if start_history_id < self.min_history_id:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        records = [r for r in self.history if int(r['id']) > start_history_id]
+        start = int(query.get('pageToken', ['0'])[0])
+        size = int(query.get('maxResults', [self.page_size])[0])
+        result = {'history': records[start:start + size], 'historyId': str(self.history_id)}
+        if start + size < len(records):
+            result['nextPageToken'] = str(start + size)
+        return 200, result
+
+    def _modify_message(self, query, body, user, msg_id):
+        if msg_id not in self.messages:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        change = json.loads(body or b'{}')
+        message = self.messages[msg_id]
+        label_ids = set(message['labelIds']) | set(change.get('addLabelIds', []))
+        label_ids -= set(change.get('removeLabelIds', []))
+        message = self.messages[msg_id] = dict(message, labelIds=sorted(label_ids))
+        return 200, {'id': msg_id, 'threadId': message['threadId'], 'labelIds': message['labelIds']}
+
+    def _batch_modify(self, query, body, user):
+        change = json.loads(body or b'{}')
+        if len(change.get('ids', [])) > 1000:
+            return 400, {'error': {'code': 400, 'message': 'Too many ids'}}
+        for msg_id in change.get('ids', []):
+            if msg_id in self.messages:
+                self._modify_message(query, body, user, msg_id)
+        return 204, {}
+
+    def _list_labels(self, query, body, user):
+        return 200, {'labels': self.labels}
+
+    def _batch(self, content_type, body):
+        message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request_line, _, rest = part.get_payload().partition('\n')
+            method, target, _ = request_line.split(' ', 2)
+            sub_body = rest.split('\n\n', 1)[1] if '\n\n' in rest else ''
+            url = urlparse(target)
+            status, result = self.dispatch(method, url.path, parse_qs(url.query), sub_body)
+            parts.append(
+                f'--{boundary}\r\n'
+                f'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{part["Content-ID"][1:]}\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status < 300 else "Error"}\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+                f'{json.dumps(result)}\r\n'
+            )
+        with self._lock:
+            self.batch_sizes.append(len(parts))
+        return f'multipart/mixed; boundary={boundary}', (''.join(parts) + f'--{boundary}--\r\n').encode()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _handle(self, method):
+                with server._lock:
+                    server.http_requests += 1
+                    server._active += 1
+                    server.peak_concurrency = max(server.peak_concurrency, server._active)
+                try:
+                    time.sleep(server.latency)
+                    self._respond(method)
+                finally:
+                    with server._lock:
+                        server._active -= 1
+
+            def _respond(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                url = urlparse(self.path)
+                if method == 'POST' and url.path.startswith('/batch'):
+                    content_type, payload = server._batch(self.headers['Content-Type'], body)
+                    status = 200
+                else:
+                    status, result = server.dispatch(method, url.path, parse_qs(url.query), body)
+                    content_type = 'application/json; charset=UTF-8'
+                    payload = json.dumps(result).encode() if status != 204 else b''
+                with server._lock:
+                    server.bytes_sent += len(payload)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+        return Handler
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from google.auth.credentials import AnonymousCredentials
+from sqlalchemy import create_engine
+
+from email_manager.async_email_manager import AsyncEmailManager, TokenBucket
+from email_manager.email_manager import EmailManager
+from email_manager.tests.fake_gmail_server import FakeGmailServer, make_message
+from models.email import Base, Email, session
+from models.sync_state import SyncState
+
+
+class TestTokenBucket(unittest.IsolatedAsyncioTestCase):
+    async def test_acquire_waits_for_refill(self):
+        bucket = TokenBucket(rate=100, capacity=10)
+
+        started = time.perf_counter()
+        for _ in range(6):
+            await bucket.acquire(5)
+
+        # 10 units are available up front, the other 20 take 0.2s to refill
+        self.assertGreaterEqual(time.perf_counter() - started, 0.18)
+
+    async def test_acquire_more_than_capacity_raises(self):
+        with self.assertRaises(ValueError):
+            await TokenBucket(rate=10).acquire(11)
+
+
+class TestAsyncEmailManager(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        # a file database, as the database is accessed from worker threads, each with its own connection
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir.name, 'emails.db')}")
+        self.addCleanup(engine.dispose)
+        Base.metadata.create_all(engine)
+        session.close()
+        for patcher in (patch.object(session.registry(), 'bind', engine),
+                        patch.dict(session.session_factory.kw, {'bind': engine})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(session.close)
+
+        self.server = FakeGmailServer([make_message(f'msg{i:03d}') for i in range(120)], page_size=50).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.upserted = []
+        upsert_patcher = patch.object(Email, 'bulk_upsert', side_effect=self._bulk_upsert)
+        upsert_patcher.start()
+        self.addCleanup(upsert_patcher.stop)
+
+    def _bulk_upsert(self, rows, chunk_size):
+        rows = list(rows)
+        self.upserted.extend(rows)
+        return len(rows), 0
+
+    def email_manager(self, **kwargs):
+        kwargs.setdefault('quota_units_per_second', 10000)
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            return AsyncEmailManager(api_endpoint=self.server.url, backoff=0, **kwargs)
+
+    async def test_sync_emails(self):
+        async with self.email_manager() as email_manager:
+            saved = await email_manager.sync_emails()
+
+        self.assertEqual(saved, 120)
+        self.assertEqual(sorted(row['msg_id'] for row in self.upserted), sorted(self.server.messages))
+        # getProfile, 3 list pages and 120 gets
+        self.assertEqual(email_manager.round_trips, 124)
+
+    async def test_second_sync_only_fetches_changes(self):
+        async with self.email_manager() as email_manager:
+            await email_manager.sync_emails()
+            self.assertEqual(SyncState.get('me@example.com').history_id, '1000')
+            self.server.add_message(make_message('msg200'))
+            self.server.delete_message('msg001')
+            self.upserted.clear()
+
+            with patch.object(Email, 'delete_by_msg_ids') as delete_by_msg_ids:
+                saved = await email_manager.sync_emails()
+
+        self.assertEqual(saved, 1)
+        self.assertEqual([row['msg_id'] for row in self.upserted], ['msg200'])
+        delete_by_msg_ids.assert_called_once_with({'msg001'}, None)
+        # getProfile, history.list and one get
+        self.assertEqual(email_manager.round_trips, 3)
+        self.assertEqual(SyncState.get('me@example.com').history_id, '1002')
+
+    async def test_expired_history_falls_back_to_full_sync(self):
+        async with self.email_manager() as email_manager:
+            await email_manager.sync_emails()
+            self.server.min_history_id = 2000
+            self.upserted.clear()
+            saved = await email_manager.sync_emails()
+
+        self.assertEqual(saved, 120)
+
+    async def test_full_sync_lists_the_mailbox_again(self):
+        async with self.email_manager() as email_manager:
+            await email_manager.sync_emails()
+            self.upserted.clear()
+            saved = await email_manager.sync_emails(full=True)
+
+        self.assertEqual(saved, 120)
+
+    async def test_failed_sync_leaves_no_request_running(self):
+        async with self.email_manager() as email_manager:
+            with patch.object(email_manager, '_persist_messages', side_effect=RuntimeError('disk full')), \
+                    self.assertRaises(RuntimeError):
+                await email_manager.sync_emails()
+            # let the cancelled list request finish
+            await asyncio.sleep(0)
+
+        self.assertEqual(asyncio.all_tasks(), {asyncio.current_task()})
+
+    async def test_fetch_bodies(self):
+        async with self.email_manager() as email_manager:
+            with patch.object(Email, 'iter_msg_ids', return_value=iter(['msg001', 'msg002'])):
+                saved = await email_manager.fetch_bodies()
+
+        self.assertEqual(saved, 2)
+        self.assertTrue(all('content' in row for row in self.upserted))
+
+    async def test_batch_modify(self):
+        self.server.labels.append({'id': 'Label_1', 'name': 'Receipts', 'type': 'user'})
+        async with self.email_manager() as email_manager:
+            label_id = await email_manager.get_label_id('Receipts')
+            results = await email_manager.batch_modify(['msg001', 'msg002'], add_label_ids=[label_id],
+                                                       remove_label_ids=['UNREAD'])
+
+        self.assertEqual([(result.msg_ids, result.error) for result in results], [(['msg001', 'msg002'], None)])
+        self.assertIn('Label_1', self.server.messages['msg002']['labelIds'])
+        self.assertNotIn('UNREAD', self.server.messages['msg002']['labelIds'])
+
+    async def test_sync_emails_without_bodies(self):
+        async with self.email_manager() as email_manager:
+            saved = await email_manager.sync_emails(bodies=False)
+
+        self.assertEqual(saved, 120)
+        self.assertTrue(all('content' not in row and row['subject'] == 'Hello' for row in self.upserted))
+
+    async def test_sync_emails_limits_requests_in_flight(self):
+        self.server.latency = 0.01
+        async with self.email_manager(max_in_flight=5) as email_manager:
+            await email_manager.sync_emails()
+
+        self.assertLessEqual(self.server.peak_concurrency, 5)
+        self.assertGreater(self.server.peak_concurrency, 1)
+
+    async def test_sync_emails_retries_server_errors(self):
+        self.server.fail_once = {'msg003', 'msg042'}
+        async with self.email_manager() as email_manager:
+            saved = await email_manager.sync_emails()
+
+        self.assertEqual(saved, 120)
+        self.assertEqual(email_manager.round_trips, 126)
+
+    async def test_accounts_share_one_event_loop(self):
+        async with self.email_manager() as first, self.email_manager() as second:
+            saved = await asyncio.gather(first.sync_emails(), second.sync_emails(q='sender@example.com'))
+
+        self.assertEqual(saved, [120, 120])
+
+    async def test_sync_emails_stays_within_quota(self):
+        async with self.email_manager(quota_units_per_second=500) as email_manager:
+            started = time.perf_counter()
+            await email_manager.sync_emails()
+
+        # a getProfile and 123 requests at 5 units each, 500 of them available up front, at 500 units per second
+        self.assertGreaterEqual(time.perf_counter() - started, 0.2)
+
+    async def test_mark_as_read(self):
+        async with self.email_manager() as email_manager:
+            await email_manager.mark_as_read('msg001')
+
+        self.assertNotIn('UNREAD', self.server.messages['msg001']['labelIds'])
+
+    async def test_move_to_label(self):
+        self.server.labels.append({'id': 'Label_1', 'name': 'Receipts', 'type': 'user'})
+        async with self.email_manager() as email_manager:
+            await email_manager.move_to_label('msg001', 'Receipts')
+
+        self.assertIn('Label_1', self.server.messages['msg001']['labelIds'])
+
+
+if __name__ == '__main__':
+    unittest.main()
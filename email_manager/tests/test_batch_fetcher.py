@@ -0,0 +1,89 @@
+import unittest
+from unittest.mock import patch
+
+from google.auth.credentials import AnonymousCredentials
+
+from benchmarks.synthetic_mailbox import SyntheticMailbox
+from email_manager.batch_fetcher import BatchFetcher
+from email_manager.email_manager import EmailManager
+from email_manager.tests.fake_gmail_server import FakeGmailServer, make_message
+from models.email import Email
+
+
+class TestBatchFetcher(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGmailServer([make_message(f'msg{i:03d}') for i in range(120)]).__enter__()
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            self.email_manager = EmailManager(api_endpoint=self.server.url)
+        self.service = self.email_manager._build_service()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+
+    def test_fetch_groups_gets_into_batches(self):
+        fetcher = BatchFetcher(self.service, self.email_manager.batch_uri, batch_size=50)
+
+        fetched = list(fetcher.fetch(sorted(self.server.messages)))
+
+        self.assertEqual(sorted(m['id'] for m in fetched), sorted(self.server.messages))
+        self.assertEqual(fetcher.round_trips, 3)
+        self.assertEqual(self.server.batch_sizes, [50, 50, 20])
+
+    def test_fetch_retries_only_failed_sub_requests(self):
+        self.server.fail_once = {'msg003', 'msg007'}
+        fetcher = BatchFetcher(self.service, self.email_manager.batch_uri, batch_size=10, backoff=0)
+
+        fetched = list(fetcher.fetch(['msg%03d' % i for i in range(10)]))
+
+        self.assertEqual(len(fetched), 10)
+        self.assertEqual(self.server.batch_sizes, [10, 2])
+        self.assertEqual(fetcher.round_trips, 2)
+        self.assertEqual(fetcher.failed, {})
+
+    def test_fetch_records_non_retriable_failures(self):
+        fetcher = BatchFetcher(self.service, self.email_manager.batch_uri, batch_size=10, backoff=0)
+
+        fetched = list(fetcher.fetch(['msg000', 'missing']))
+
+        self.assertEqual([m['id'] for m in fetched], ['msg000'])
+        self.assertEqual(list(fetcher.failed), ['missing'])
+        self.assertEqual(fetcher.round_trips, 1)
+
+    def test_fetch_recovers_from_injected_errors_and_quota_rejections(self):
+        with FakeGmailServer(SyntheticMailbox(200), error_rate=0.05, quota_units_per_second=600) as server:
+            with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+                email_manager = EmailManager(api_endpoint=server.url)
+            fetcher = BatchFetcher(email_manager._build_service(), email_manager.batch_uri, batch_size=100,
+                                   backoff=0.1)
+
+            fetched = list(fetcher.fetch(list(server.messages)))
+
+        self.assertEqual(len(fetched), 200)
+        self.assertEqual(fetcher.failed, {})
+        self.assertGreater(server.errors_injected, 0)
+        self.assertGreater(server.quota_rejections, 0)
+
+    def test_batch_size_is_capped_at_gmail_limit(self):
+        with self.assertRaises(ValueError):
+            BatchFetcher(self.service, self.email_manager.batch_uri, batch_size=101)
+
+    @patch('email_manager.email_manager.FailedMessage')
+    @patch('email_manager.email_manager.SyncCheckpoint')
+    @patch('email_manager.email_manager.SyncState')
+    @patch.object(Email, 'bulk_upsert', side_effect=lambda rows, chunk_size: (len(list(rows)), 0))
+    def test_sync_emails_reports_round_trips(self, mock_bulk_upsert, mock_sync_state, mock_sync_checkpoint,
+                                             mock_failed_message):
+        mock_sync_checkpoint.get.return_value = None
+        mock_failed_message.retriable_ids.return_value = []
+        mock_sync_state.get.return_value = None
+        self.email_manager.batch_size = 50
+
+        saved = self.email_manager.sync_emails()
+
+        self.assertEqual(saved, 120)
+        # getProfile + 2 list pages + 3 batches
+        self.assertEqual(self.email_manager.round_trips, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
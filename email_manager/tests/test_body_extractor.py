@@ -0,0 +1,74 @@
+import base64
+import unittest
+
+from email_manager.body_extractor import decode_part_data, extract_body, find_body_part, html_to_text
+
+
+def encode(text, charset='utf-8'):
+    # Gmail sends base64url without padding
+    return base64.urlsafe_b64encode(text.encode(charset)).decode().rstrip('=')
+
+
+def text_part(mime_type, text, charset=None, filename=''):
+    headers = [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}] if charset else []
+    return {'mimeType': mime_type, 'filename': filename, 'headers': headers,
+            'body': {'size': len(text), 'data': encode(text, charset or 'utf-8')}}
+
+
+class TestBodyExtractor(unittest.TestCase):
+    def test_single_part_message(self):
+        payload = text_part('text/plain', 'Just text\n')
+
+        self.assertEqual(extract_body(payload), 'Just text')
+
+    def test_plain_text_is_preferred(self):
+        payload = {'mimeType': 'multipart/alternative', 'parts': [
+            text_part('text/html', '<p>The html version</p>'),
+            text_part('text/plain', 'The plain version'),
+        ]}
+
+        self.assertEqual(extract_body(payload), 'The plain version')
+
+    def test_nested_multipart_message(self):
+        payload = {'mimeType': 'multipart/mixed', 'parts': [
+            {'mimeType': 'multipart/related', 'parts': [
+                {'mimeType': 'multipart/alternative', 'parts': [text_part('text/html', '<p>Nested</p>')]},
+                {'mimeType': 'image/png', 'filename': 'logo.png', 'body': {'attachmentId': 'att1', 'size': 10}},
+            ]},
+            text_part('text/plain', 'an attachment', filename='notes.txt'),
+        ]}
+
+        self.assertEqual(extract_body(payload), 'Nested')
+
+    def test_html_is_stripped_to_text(self):
+        html = ('<html><head><title>Title</title><style>p {color: red}</style></head>'
+                '<body><p>Hello &amp; welcome</p><script>alert(1)</script><div>Second   line</div></body></html>')
+
+        self.assertEqual(html_to_text(html), 'Hello & welcome\nSecond line')
+
+    def test_charset_is_honoured(self):
+        payload = text_part('text/plain', 'Café', charset='iso-8859-1')
+
+        self.assertEqual(extract_body(payload), 'Café')
+
+    def test_body_is_capped(self):
+        self.assertEqual(extract_body(text_part('text/plain', 'a' * 50), max_chars=10), 'a' * 10)
+        html = '<p>' + 'b' * 100000 + '</p>' + '<p>more</p>' * 10000
+        self.assertEqual(html_to_text(html, max_chars=10, chunk_size=1000), 'b' * 10)
+
+    def test_message_without_text(self):
+        payload = {'mimeType': 'multipart/mixed', 'parts': [
+            {'mimeType': 'application/pdf', 'filename': 'a.pdf', 'body': {'attachmentId': 'att1', 'size': 10}},
+        ]}
+
+        self.assertIsNone(find_body_part(payload))
+        self.assertEqual(extract_body(payload), '')
+
+    def test_urlsafe_characters_are_decoded(self):
+        data = bytes(range(250, 256)) * 3
+
+        self.assertEqual(decode_part_data(base64.urlsafe_b64encode(data).decode().rstrip('=')), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
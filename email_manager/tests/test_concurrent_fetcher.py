@@ -0,0 +1,92 @@
+import threading
+import time
+import unittest
+
+from email_manager.concurrent_fetcher import ConcurrentFetcher
+
+
+class FakeService:
+    """
+    Stands in for a Gmail service object, answering messages.get after a fixed delay and
+    remembering which thread built it.
+    """
+
+    def __init__(self, latency, calls):
+        self.latency = latency
+        self.calls = calls
+        self.thread = threading.current_thread()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id):
+        self.msg_id = id
+        return self
+
+    def execute(self):
+        assert threading.current_thread() is self.thread, 'service object shared between threads'
+        self.calls.append(self.msg_id)
+        time.sleep(self.latency)
+        return {'id': self.msg_id}
+
+
+class TestConcurrentFetcher(unittest.TestCase):
+    LATENCY = 0.02
+
+    def setUp(self):
+        self.services = []
+        self.calls = []
+        self.msg_ids = [f'msg{i:03d}' for i in range(40)]
+
+    def service_factory(self):
+        service = FakeService(self.LATENCY, self.calls)
+        self.services.append(service)
+        return service
+
+    def fetch(self, workers, **kwargs):
+        fetcher = ConcurrentFetcher(self.service_factory, workers=workers, batch_size=None, **kwargs)
+        started = time.perf_counter()
+        results = list(fetcher.fetch(self.msg_ids))
+        return fetcher, results, time.perf_counter() - started
+
+    def test_fetches_every_message_once(self):
+        fetcher, results, _ = self.fetch(workers=4)
+
+        self.assertEqual(sorted(r['id'] for r in results), self.msg_ids)
+        self.assertEqual(fetcher.round_trips, 40)
+
+    def test_each_worker_builds_its_own_service(self):
+        self.fetch(workers=4)
+
+        self.assertLessEqual(len(self.services), 4)
+        self.assertEqual(len(set(s.thread for s in self.services)), len(self.services))
+
+    def test_workers_speed_up_simulated_latency(self):
+        _, _, serial = self.fetch(workers=1)
+        _, _, concurrent = self.fetch(workers=8)
+
+        # 40 gets at 20ms: ~0.8s serially, ~0.1s over 8 workers
+        self.assertLess(concurrent, serial / 3)
+
+    def test_parse_runs_on_workers_and_drops_none(self):
+        fetcher, results, _ = self.fetch(workers=4, parse=lambda msg: None if msg['id'].endswith('0') else msg['id'])
+
+        self.assertEqual(len(results), 36)
+
+    def test_consumer_backpressure_bounds_in_flight_chunks(self):
+        fetcher = ConcurrentFetcher(self.service_factory, workers=2, batch_size=None, max_in_flight=2)
+        results = fetcher.fetch(self.msg_ids)
+
+        next(results)
+        time.sleep(self.LATENCY * 10)
+
+        # the consumer is paused, so no more than max_in_flight gets have been sent
+        self.assertLessEqual(len(self.calls), fetcher.max_in_flight)
+        results.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
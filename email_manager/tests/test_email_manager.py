@@ -1,6 +1,26 @@
+import os
+import tempfile
 import unittest
-from unittest.mock import patch, MagicMock
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from unittest.mock import ANY, patch, MagicMock
+
+from alembic import command
+from alembic.config import Config
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.errors import HttpError
+from sqlalchemy import create_engine
+
 from email_manager.email_manager import EmailManager
+from email_manager.header_parser import local_naive
+from email_manager.tests.fake_gmail_server import FakeGmailServer, make_message
+from instrumentation import metrics
+from models.email import Base, Email, session
+from models.sync_checkpoint import FailedMessage, SyncCheckpoint
+from models.sync_state import SyncState
+
+# the Date header of make_message, as stored
+DATE_RECEIVED = local_naive(datetime(2024, 3, 23, 10, tzinfo=timezone.utc))
 
 
 class TestEmailManager(unittest.TestCase):
@@ -8,23 +28,109 @@ class TestEmailManager(unittest.TestCase):
     def setUp(self, mock_get_credentials):
         self.email_manager = EmailManager()
 
+    @patch('email_manager.email_manager.FailedMessage')
+    @patch('email_manager.email_manager.SyncCheckpoint')
+    @patch('email_manager.email_manager.SyncState')
     @patch('email_manager.email_manager.build')
-    def test_sync_emails(self, mock_build):
+    def test_sync_emails(self, mock_build, mock_sync_state, mock_sync_checkpoint, mock_failed_message):
         # Setup
+        mock_sync_checkpoint.get.return_value = None
+        mock_failed_message.retriable_ids.return_value = []
         mock_service = MagicMock()
         mock_build.return_value = mock_service
         mock_service.users.return_value.messages.return_value.list.return_value.execute.return_value = {'messages': []}
+        mock_sync_state.get.return_value = None
 
         # Call
         self.email_manager.sync_emails()
 
         # Assert
-        mock_build.assert_called_once_with('gmail', 'v1', credentials='dummy_credentials')
-        mock_service.users.assert_called_once()
+        mock_build.assert_called_once_with('gmail', 'v1', credentials='dummy_credentials', static_discovery=True)
+        mock_service.users.return_value.getProfile.assert_called_once_with(userId='me')
         mock_service.users.return_value.messages.assert_called_once()
         mock_service.users.return_value.messages.return_value.list.assert_called_once_with(userId='me')
         mock_service.users.return_value.messages.return_value.list.return_value.execute.assert_called_once()
 
+    @patch('email_manager.email_manager.build')
+    def test_sync_emails_follows_next_page_token(self, mock_build):
+        # Setup
+        mock_service = MagicMock()
+        mock_build.return_value = mock_service
+        mock_list = mock_service.users.return_value.messages.return_value.list
+        mock_list.return_value.execute.side_effect = [{'messages': [], 'nextPageToken': 'page2'}, {'messages': []}]
+
+        # Call
+        self.email_manager.sync_emails(q='after:2024/01/01 before:2024/02/01', max_results=500)
+
+        # Assert
+        self.assertEqual(mock_list.call_args_list[0].kwargs,
+                         {'userId': 'me', 'q': 'after:2024/01/01 before:2024/02/01', 'maxResults': 500})
+        self.assertEqual(mock_list.call_args_list[1].kwargs,
+                         {'userId': 'me', 'q': 'after:2024/01/01 before:2024/02/01', 'maxResults': 500,
+                          'pageToken': 'page2'})
+        self.assertEqual(self.email_manager.round_trips, 2)
+
+    @patch('email_manager.email_manager.FailedMessage')
+    @patch('email_manager.email_manager.SyncCheckpoint')
+    @patch('email_manager.email_manager.SyncState')
+    @patch.object(Email, 'bulk_upsert', side_effect=lambda rows, chunk_size: (len(list(rows)), 0))
+    def test_sync_emails_streams_every_page(self, mock_bulk_upsert, mock_sync_state, mock_sync_checkpoint,
+                                            mock_failed_message):
+        mock_sync_checkpoint.get.return_value = None
+        mock_failed_message.retriable_ids.return_value = []
+        mock_sync_state.get.return_value = None
+        messages = [make_message(f'msg{i:03d}') for i in range(250)]
+        with FakeGmailServer(messages, page_size=100) as server, \
+                patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            email_manager = EmailManager(api_endpoint=server.url, batch_size=50)
+
+            saved = email_manager.sync_emails()
+
+        self.assertEqual(saved, 250)
+        # getProfile + 3 list pages + 5 batches of 50
+        self.assertEqual(email_manager.round_trips, 9)
+
+    @patch('email_manager.email_manager.FailedMessage')
+    @patch('email_manager.email_manager.SyncCheckpoint')
+    @patch('email_manager.email_manager.SyncState')
+    @patch.object(Email, 'bulk_upsert', side_effect=lambda rows, chunk_size: (len(list(rows)), 0))
+    def test_sync_emails_with_workers(self, mock_bulk_upsert, mock_sync_state, mock_sync_checkpoint,
+                                      mock_failed_message):
+        mock_sync_checkpoint.get.return_value = None
+        mock_failed_message.retriable_ids.return_value = []
+        mock_sync_state.get.return_value = None
+        messages = [make_message(f'msg{i:03d}') for i in range(250)]
+        with FakeGmailServer(messages, page_size=100) as server, \
+                patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            email_manager = EmailManager(api_endpoint=server.url, batch_size=20, workers=4)
+
+            saved = email_manager.sync_emails()
+
+        self.assertEqual(saved, 250)
+        # getProfile + 3 list pages + 13 batches of up to 20
+        self.assertEqual(email_manager.round_trips, 17)
+
+    def test_list_message_ids_is_lazy(self):
+        messages = [make_message(f'msg{i:03d}') for i in range(250)]
+        with FakeGmailServer(messages, page_size=100) as server, \
+                patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            email_manager = EmailManager(api_endpoint=server.url)
+            msg_ids = email_manager._list_message_ids(email_manager._build_service())
+
+            self.assertEqual(next(msg_ids), 'msg000')
+            self.assertEqual(server.http_requests, 1)
+            self.assertEqual(len(list(msg_ids)), 249)
+            self.assertEqual(server.http_requests, 3)
+
+    def test_sync_emails_filters_by_query(self):
+        messages = [make_message(f'msg{i:03d}', subject='jan' if i % 2 else 'feb') for i in range(10)]
+        with FakeGmailServer(messages) as server, \
+                patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            email_manager = EmailManager(api_endpoint=server.url)
+            msg_ids = list(email_manager._list_message_ids(email_manager._build_service(), q='jan'))
+
+        self.assertEqual(msg_ids, ['msg001', 'msg003', 'msg005', 'msg007', 'msg009'])
+
     @patch('email_manager.email_manager.build')
     def test_mark_as_read(self, mock_build):
         # Setup
@@ -35,7 +141,7 @@ class TestEmailManager(unittest.TestCase):
         self.email_manager.mark_as_read('message_id')
 
         # Assert
-        mock_build.assert_called_once_with('gmail', 'v1', credentials='dummy_credentials')
+        mock_build.assert_called_once_with('gmail', 'v1', credentials='dummy_credentials', static_discovery=True)
         mock_service.users.assert_called_once()
         mock_service.users.return_value.messages.assert_called_once()
         mock_service.users.return_value.messages.return_value.modify.assert_called_once_with(userId='me',
@@ -47,18 +153,98 @@ class TestEmailManager(unittest.TestCase):
         # Setup
         mock_service = MagicMock()
         mock_build.return_value = mock_service
+        mock_service.users.return_value.labels.return_value.list.return_value.execute.return_value = {
+            'labels': [{'id': 'new_label_id', 'name': 'new_label_id'}]}
 
         # Call
         self.email_manager.move_to_label('message_id', 'new_label_id')
 
         # Assert
-        mock_build.assert_called_once_with('gmail', 'v1', credentials='dummy_credentials')
-        mock_service.users.assert_called_once()
+        mock_build.assert_called_once_with('gmail', 'v1', credentials='dummy_credentials', static_discovery=True)
+        mock_service.users.return_value.labels.return_value.list.assert_called_once_with(userId='me')
         mock_service.users.return_value.messages.assert_called_once()
         mock_service.users.return_value.messages.return_value.modify.assert_called_once_with(userId='me',
                                                                                              id='message_id', body={
                 'addLabelIds': ['new_label_id']})
 
+    @patch('email_manager.email_manager.build')
+    def test_service_is_built_once(self, mock_build):
+        # Call
+        self.email_manager.mark_as_read('message_1')
+        self.email_manager.mark_as_read('message_2')
+        self.email_manager.get_labels()
+
+        # Assert
+        mock_build.assert_called_once_with('gmail', 'v1', credentials='dummy_credentials', static_discovery=True)
+        self.assertEqual(mock_build.return_value.users.return_value.messages.return_value.modify.call_count, 2)
+
+    @patch('email_manager.email_manager.build')
+    def test_move_to_label_lists_labels_once(self, mock_build):
+        # Setup
+        mock_labels = mock_build.return_value.users.return_value.labels.return_value
+        mock_labels.list.return_value.execute.return_value = {'labels': [{'id': 'Label_1', 'name': 'Receipts'}]}
+
+        # Call
+        for i in range(10):
+            self.email_manager.move_to_label(f'message_{i}', 'Receipts')
+
+        # Assert
+        mock_labels.list.assert_called_once_with(userId='me')
+        mock_modify = mock_build.return_value.users.return_value.messages.return_value.modify
+        self.assertEqual(mock_modify.call_count, 10)
+        mock_modify.assert_called_with(userId='me', id='message_9', body={'addLabelIds': ['Label_1']})
+
+    @patch('email_manager.email_manager.build')
+    def test_move_to_missing_label(self, mock_build):
+        # Setup
+        mock_labels = mock_build.return_value.users.return_value.labels.return_value
+        mock_labels.list.return_value.execute.return_value = {'labels': []}
+
+        # Call
+        self.email_manager.move_to_label('message_1', 'Receipts')
+        self.email_manager.move_to_label('message_2', 'Receipts')
+
+        # Assert
+        mock_labels.list.assert_called_once_with(userId='me')
+        mock_labels.create.assert_not_called()
+        mock_build.return_value.users.return_value.messages.return_value.modify.assert_not_called()
+
+    @patch('email_manager.email_manager.build')
+    def test_move_to_label_creates_missing_label(self, mock_build):
+        # Setup
+        self.email_manager.create_missing_labels = True
+        mock_labels = mock_build.return_value.users.return_value.labels.return_value
+        mock_labels.list.return_value.execute.return_value = {'labels': []}
+        mock_labels.create.return_value.execute.return_value = {'id': 'Label_9', 'name': 'Receipts'}
+
+        # Call
+        self.email_manager.move_to_label('message_1', 'Receipts')
+        self.email_manager.move_to_label('message_2', 'Receipts')
+
+        # Assert
+        mock_labels.list.assert_called_once_with(userId='me')
+        mock_labels.create.assert_called_once_with(userId='me', body={
+            'name': 'Receipts', 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'})
+        mock_build.return_value.users.return_value.messages.return_value.modify.assert_called_with(
+            userId='me', id='message_2', body={'addLabelIds': ['Label_9']})
+
+    @patch('email_manager.email_manager.build')
+    def test_batch_modify_chunks_message_ids(self, mock_build):
+        # Setup
+        mock_batch_modify = mock_build.return_value.users.return_value.messages.return_value.batchModify
+        mock_batch_modify.return_value.execute.side_effect = [{}, HttpError(MagicMock(status=500), b''), {}]
+        msg_ids = [f'message_{i}' for i in range(2500)]
+
+        # Call
+        results = self.email_manager.batch_modify(msg_ids, add_label_ids=['Label_1'], remove_label_ids=['UNREAD'])
+
+        # Assert
+        self.assertEqual(mock_batch_modify.call_count, 3)
+        mock_batch_modify.assert_called_with(userId='me', body={
+            'ids': msg_ids[2000:], 'addLabelIds': ['Label_1'], 'removeLabelIds': ['UNREAD']})
+        self.assertEqual([len(result.msg_ids) for result in results], [1000, 1000, 500])
+        self.assertEqual([result.error is None for result in results], [True, False, True])
+
     @patch('email_manager.email_manager.build')
     def test_get_labels(self, mock_build):
         # Setup
@@ -70,12 +256,380 @@ class TestEmailManager(unittest.TestCase):
         self.email_manager.get_labels()
 
         # Assert
-        mock_build.assert_called_once_with('gmail', 'v1', credentials='dummy_credentials')
+        mock_build.assert_called_once_with('gmail', 'v1', credentials='dummy_credentials', static_discovery=True)
         mock_service.users.assert_called_once()
         mock_service.users.return_value.labels.assert_called_once()
         mock_service.users.return_value.labels.return_value.list.assert_called_once_with(userId='me')
         mock_service.users.return_value.labels.return_value.list.return_value.execute.assert_called_once()
 
 
+class TestSyncIntoMigratedSchema(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        database_url = f"sqlite:///{os.path.join(tmp_dir.name, 'emails.db')}"
+        # the schema the migrations build, whose constraints differ from the models'
+        config = Config()
+        config.set_main_option('script_location', os.path.join(os.path.dirname(__file__), '..', '..', 'alembic'))
+        with patch.dict(os.environ, {'DATABASE_URL': database_url}):
+            command.upgrade(config, 'head')
+
+        engine = create_engine(database_url)
+        self.addCleanup(engine.dispose)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+    def test_messages_missing_headers_are_saved(self):
+        # no Cc, and no To or Subject either, like Bcc-only mail
+        bcc_only = make_message('msg002')
+        bcc_only['payload']['headers'] = [header for header in bcc_only['payload']['headers']
+                                          if header['name'] not in ('To', 'Subject')]
+        with FakeGmailServer([make_message('msg001'), bcc_only]) as server, \
+                patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            saved = EmailManager(api_endpoint=server.url).sync_emails()
+
+        self.assertEqual(saved, 2)
+        email = session.query(Email).filter_by(msg_id='msg002').one()
+        self.assertEqual((email.subject, email.sender, email.recipient, email.cc),
+                         (None, 'sender@example.com', None, None))
+
+
+class TestIncrementalSync(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+        self.server = FakeGmailServer([make_message(f'msg{i:03d}') for i in range(120)]).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            self.email_manager = EmailManager(api_endpoint=self.server.url)
+
+        # records the rows written, which the tests assert on
+        self.upserted = []
+        upsert_patcher = patch.object(Email, 'bulk_upsert', side_effect=self._bulk_upsert)
+        upsert_patcher.start()
+        self.addCleanup(upsert_patcher.stop)
+
+    def _bulk_upsert(self, rows, chunk_size):
+        rows = list(rows)
+        self.upserted.extend(rows)
+        return len(rows), 0
+
+    def test_first_sync_is_full_and_stores_history_id(self):
+        saved = self.email_manager.sync_emails()
+
+        self.assertEqual(saved, 120)
+        self.assertEqual(SyncState.get('me@example.com').history_id, '1000')
+
+    def test_sync_with_parse_workers(self):
+        self.email_manager.sync_emails()
+        rows = sorted(self.upserted, key=lambda row: row['msg_id'])
+        self.upserted.clear()
+        self.email_manager.workers = 2
+        self.email_manager.parse_workers = 2
+
+        saved = self.email_manager.sync_emails(full=True)
+
+        self.assertEqual(saved, 120)
+        self.assertEqual([dict(row, synced_at=None) for row in sorted(self.upserted, key=lambda row: row['msg_id'])],
+                         [dict(row, synced_at=None) for row in rows])
+
+    def test_parse_workers_are_started_once_per_sync(self):
+        self.email_manager.parse_workers = 2
+
+        # two list pages, parsed on the same processes
+        with patch('email_manager.parse_pool.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as executor:
+            saved = self.email_manager.sync_emails(max_results=60)
+
+        self.assertEqual(saved, 120)
+        executor.assert_called_once()
+        self.assertIsNone(self.email_manager._parse_pool)
+
+    def test_second_sync_only_fetches_changes(self):
+        self.email_manager.sync_emails()
+        session.add(Email(msg_id='msg005', date_received=datetime(2024, 3, 23), synced_at=datetime(2024, 3, 23)))
+        session.commit()
+        self.server.add_message(make_message('new001'))
+        self.server.delete_message('msg005')
+        self.server.add_labels('msg006', ['STARRED'])
+        self.server.batch_sizes = []
+
+        saved = self.email_manager.sync_emails()
+
+        self.assertEqual(saved, 1)
+        self.assertEqual(self.upserted[-1], {'msg_id': 'new001', 'subject': 'Hello', 'sender': 'sender@example.com',
+                                             'content': ANY, 'recipient': 'me@example.com', 'cc': None,
+                                             'date_received': DATE_RECEIVED, 'synced_at': ANY})
+        self.assertIsNone(Email.get_by_msg_id('msg005'))
+        # getProfile + history.list + one batch holding only the added message
+        self.assertEqual(self.email_manager.round_trips, 3)
+        self.assertEqual(self.server.batch_sizes, [1])
+        self.assertEqual(SyncState.get('me@example.com').history_id, '1003')
+
+    def test_trashed_messages_are_deleted(self):
+        self.email_manager.sync_emails()
+        session.add(Email(msg_id='msg007', date_received=datetime(2024, 3, 23), synced_at=datetime(2024, 3, 23)))
+        session.commit()
+        self.server.add_labels('msg007', ['TRASH'])
+
+        saved = self.email_manager.sync_emails()
+
+        self.assertEqual(saved, 0)
+        self.assertIsNone(Email.get_by_msg_id('msg007'))
+
+    def test_expired_history_falls_back_to_full_sync(self):
+        self.email_manager.sync_emails()
+        self.server.add_message(make_message('new001'))
+        self.server.min_history_id = 1001
+
+        saved = self.email_manager.sync_emails()
+
+        self.assertEqual(saved, 121)
+        self.assertEqual(SyncState.get('me@example.com').history_id, '1001')
+
+
+class TestResumableSync(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+        self.server = FakeGmailServer([make_message(f'msg{i:03d}') for i in range(120)], page_size=50).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            self.email_manager = EmailManager(api_endpoint=self.server.url)
+
+    def test_interrupted_backfill_resumes_where_it_stopped(self):
+        steps = self.email_manager.sync_steps(chunk_size=20)
+        self.assertEqual([next(steps) for _ in range(3)], [20, 20, 20])
+        steps.close()
+        checkpoint = SyncCheckpoint.get('me@example.com')
+        self.assertEqual((checkpoint.page_token, checkpoint.last_msg_id), ('50', 'msg059'))
+        self.server.add_message(make_message('new001'))
+        self.server.batch_sizes = []
+
+        saved = self.email_manager.sync_emails()
+
+        self.assertEqual(saved, 61)
+        self.assertEqual(sum(self.server.batch_sizes), 61)
+        self.assertEqual(session.query(Email).count(), 121)
+        self.assertIsNone(SyncCheckpoint.get('me@example.com'))
+        # the history from the start of the interrupted sync, whatever changed since gets synced next
+        self.assertEqual(SyncState.get('me@example.com').history_id, '1000')
+
+    def test_only_failed_messages_are_retried(self):
+        self.email_manager.batch_size = None
+        self.server.fail_once = {'msg003', 'msg077'}
+
+        saved = self.email_manager.sync_emails()
+
+        self.assertEqual(saved, 118)
+        failed = session.query(FailedMessage).order_by(FailedMessage.msg_id).all()
+        self.assertEqual([(f.msg_id, f.attempts) for f in failed], [('msg003', 1), ('msg077', 1)])
+        self.assertIn('503', failed[0].error)
+        requests = self.server.http_requests
+
+        saved = self.email_manager.sync_emails()
+
+        self.assertEqual(saved, 2)
+        # getProfile, the two messages and history.list
+        self.assertEqual(self.server.http_requests - requests, 4)
+        self.assertEqual(session.query(FailedMessage).count(), 0)
+        self.assertEqual(session.query(Email).count(), 120)
+
+    def test_sync_reports_metrics(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+        self.email_manager.sync_emails()
+
+        self.assertEqual([metrics.counter('gmail_api_calls_total', method=method)
+                          for method in ('getProfile', 'messages.list', 'messages.get')], [1, 3, 120])
+        self.assertEqual(metrics.counter('gmail_quota_units_total', method='messages.get'), 600)
+        self.assertEqual(metrics.timing('gmail_api_seconds', method='batch')[0], 3)
+        self.assertEqual(metrics.counter('messages_parsed_total'), 120)
+        self.assertGreater(metrics.counter('gmail_message_bytes_total'), 0)
+        self.assertEqual(metrics.timing('message_parse_seconds')[0], 120)
+        self.assertEqual(metrics.counter('db_rows_upserted_total', result='inserted'), 120)
+        # one upsert per page of 50
+        self.assertEqual(metrics.timing('db_seconds', statement='upsert')[0], 3)
+        self.assertEqual(metrics.timing('sync_seconds')[0], 1)
+
+    def test_unparseable_messages_stop_being_retried(self):
+        del self.server.messages['msg010']['payload']
+
+        for _ in range(EmailManager.MAX_FETCH_ATTEMPTS + 1):
+            self.email_manager.sync_emails()
+
+        failed = session.query(FailedMessage).one()
+        self.assertEqual((failed.msg_id, failed.error), ('msg010', 'could not be parsed'))
+        self.assertEqual(failed.attempts, EmailManager.MAX_FETCH_ATTEMPTS)
+
+
+class TestSyncWithoutBodies(unittest.TestCase):
+    BODY = '<html><body>' + '<p>The quarterly report is attached.</p>' * 500 + '</body></html>'
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+        self.server = FakeGmailServer([make_message(f'msg{i:03d}', body=self.BODY) for i in range(40)]).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            self.email_manager = EmailManager(api_endpoint=self.server.url)
+
+        # records the rows written, which the tests assert on
+        self.upserted = []
+        upsert_patcher = patch.object(Email, 'bulk_upsert', side_effect=self._bulk_upsert)
+        upsert_patcher.start()
+        self.addCleanup(upsert_patcher.stop)
+
+    def _bulk_upsert(self, rows, chunk_size):
+        rows = list(rows)
+        self.upserted.extend(rows)
+        for row in rows:
+            email = Email.get_by_msg_id(row['msg_id'])
+            if email is not None and 'content' in row:
+                email.content = row['content']
+        session.commit()
+        return len(rows), 0
+
+    def add_email(self, msg_id, content=None):
+        session.add(Email(msg_id=msg_id, content=content, date_received=datetime(2024, 3, 23),
+                          synced_at=datetime(2024, 3, 23)))
+        session.commit()
+
+    def test_sync_without_bodies_leaves_content_out(self):
+        saved = self.email_manager.sync_emails(bodies=False)
+
+        self.assertEqual(saved, 40)
+        self.assertEqual(self.upserted[0], {'msg_id': 'msg000', 'subject': 'Hello', 'sender': 'sender@example.com',
+                                            'recipient': 'me@example.com', 'cc': None,
+                                            'date_received': DATE_RECEIVED, 'synced_at': ANY})
+
+    def test_sync_without_bodies_with_workers(self):
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            email_manager = EmailManager(api_endpoint=self.server.url, batch_size=10, workers=4)
+
+        saved = email_manager.sync_emails(bodies=False)
+
+        self.assertEqual(saved, 40)
+        self.assertTrue(all('content' not in row for row in self.upserted))
+
+    def test_sync_without_bodies_transfers_a_fraction_of_the_bytes(self):
+        self.email_manager.sync_emails(full=True)
+        with_bodies, self.server.bytes_sent = self.server.bytes_sent, 0
+
+        self.email_manager.sync_emails(full=True, bodies=False)
+
+        self.assertLess(self.server.bytes_sent * 10, with_bodies)
+
+    def test_fetch_bodies_only_fetches_emails_without_content(self):
+        self.add_email('msg001')
+        self.add_email('msg002', content='<p>Hello</p>')
+        self.add_email('msg003')
+
+        saved = self.email_manager.fetch_bodies()
+
+        self.assertEqual(saved, 2)
+        self.assertEqual([row['msg_id'] for row in self.upserted], ['msg001', 'msg003'])
+        self.assertIn('quarterly report', self.upserted[0]['content'])
+
+    def test_get_content_fetches_the_body_on_demand(self):
+        self.add_email('msg001')
+        self.add_email('msg002', content='<p>Stored</p>')
+
+        self.assertIn('quarterly report', self.email_manager.get_content('msg001'))
+        requests = self.server.http_requests
+        self.assertEqual(self.email_manager.get_content('msg002'), '<p>Stored</p>')
+        self.assertIsNone(self.email_manager.get_content('missing'))
+        self.assertEqual(self.server.http_requests, requests)
+
+
+class TestSyncWithMessageStore(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.server = FakeGmailServer([make_message(f'msg{i:03d}') for i in range(60)], page_size=25).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.email_manager = self.make_manager(os.path.join(self.tmp_dir, 'messages'))
+
+    def make_manager(self, message_store_dir, **kwargs):
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            email_manager = EmailManager(api_endpoint=self.server.url, message_store_dir=message_store_dir, **kwargs)
+        self.addCleanup(email_manager.message_store.close)
+        return email_manager
+
+    def test_stored_messages_are_not_downloaded_again(self):
+        self.email_manager.sync_emails()
+        self.assertEqual(len(self.email_manager.message_store), 60)
+        self.server.add_message(make_message('new001'))
+        self.server.batch_sizes = []
+
+        saved = self.email_manager.sync_emails(full=True)
+
+        self.assertEqual(saved, 61)
+        self.assertEqual(self.server.batch_sizes, [1])
+        self.assertEqual(session.query(Email).count(), 61)
+
+    def test_messages_fetched_on_threads_are_stored(self):
+        email_manager = self.make_manager(os.path.join(self.tmp_dir, 'threads'), workers=4, batch_size=10)
+
+        email_manager.sync_emails()
+
+        self.assertEqual(sorted(email_manager.message_store), sorted(self.server.messages))
+
+    def test_sync_without_bodies_stores_nothing(self):
+        self.email_manager.sync_emails(bodies=False)
+
+        self.assertEqual(len(self.email_manager.message_store), 0)
+
+    def test_reparse_reads_the_store_only(self):
+        self.email_manager.sync_emails()
+        session.query(Email).update({Email.subject: 'parsed by an older version'})
+        session.commit()
+        requests = self.server.http_requests
+
+        saved = self.email_manager.reparse()
+
+        self.assertEqual(saved, 60)
+        self.assertEqual(self.server.http_requests, requests)
+        self.assertEqual(set(subject for (subject,) in session.query(Email.subject)), {'Hello'})
+
+    def test_deleted_messages_are_discarded(self):
+        self.email_manager.sync_emails()
+        self.server.delete_message('msg007')
+
+        self.email_manager.sync_emails()
+
+        self.assertNotIn('msg007', self.email_manager.message_store)
+
+
 if __name__ == '__main__':
     unittest.main()
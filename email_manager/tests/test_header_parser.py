@@ -0,0 +1,64 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from email_manager.header_parser import EmailHeaders, decode_words, index_headers, local_naive, parse_date
+
+
+def headers(*pairs):
+    return [{'name': name, 'value': value} for name, value in pairs]
+
+
+class TestHeaderParser(unittest.TestCase):
+    def test_headers_are_parsed(self):
+        parsed = EmailHeaders.from_headers(headers(
+            ('Subject', 'Hello'), ('From', 'sender@example.com'), ('To', 'me@example.com'),
+            ('Cc', 'cc@example.com'), ('Date', 'Sat, 23 Mar 2024 10:00:00 +0100'), ('X-Mailer', 'Test')))
+
+        self.assertEqual(parsed, EmailHeaders(
+            subject='Hello', sender='sender@example.com', recipient='me@example.com', cc='cc@example.com',
+            date_received=datetime(2024, 3, 23, 10, tzinfo=timezone(timedelta(hours=1)))))
+
+    def test_names_are_case_insensitive(self):
+        parsed = EmailHeaders.from_headers(headers(('SUBJECT', 'Hello'), ('from', 'sender@example.com')))
+
+        self.assertEqual((parsed.subject, parsed.sender), ('Hello', 'sender@example.com'))
+
+    def test_missing_headers_are_none(self):
+        parsed = EmailHeaders.from_headers(headers(('From', 'sender@example.com')))
+
+        self.assertEqual(parsed, EmailHeaders(sender='sender@example.com'))
+
+    def test_duplicate_headers(self):
+        index = index_headers(headers(('Subject', 'First'), ('Subject', 'Second'), ('To', 'a@example.com'),
+                                      ('To', 'b@example.com')))
+
+        self.assertEqual(index, {'subject': 'First', 'to': 'a@example.com, b@example.com'})
+
+    def test_encoded_words_are_decoded(self):
+        self.assertEqual(decode_words('=?utf-8?q?Caf=C3=A9?= au lait'), 'Café au lait')
+        self.assertEqual(decode_words('=?iso-8859-1?b?Q2Fm6Q==?='), 'Café')
+        self.assertEqual(decode_words('=?unknown-charset?q?abc?='), '=?unknown-charset?q?abc?=')
+
+    def test_dates(self):
+        self.assertEqual(parse_date('Sat, 23 Mar 2024 10:00:00 -0000'), datetime(2024, 3, 23, 10, tzinfo=timezone.utc))
+        self.assertIsNone(parse_date('yesterday'))
+        self.assertIsNone(parse_date(None))
+
+    def test_internal_date_is_the_fallback(self):
+        parsed = EmailHeaders.from_headers(headers(('Date', 'not a date')), internal_date='1711188000000')
+
+        self.assertEqual(parsed.date_received, datetime(2024, 3, 23, 10, tzinfo=timezone.utc))
+
+    def test_local_naive(self):
+        date = datetime(2024, 3, 23, 10, tzinfo=timezone.utc)
+
+        self.assertEqual(local_naive(date), date.astimezone().replace(tzinfo=None))
+        self.assertIsNone(local_naive(None))
+
+    def test_record_has_no_dict(self):
+        with self.assertRaises(AttributeError):
+            EmailHeaders().unknown = 1
+
+
+if __name__ == '__main__':
+    unittest.main()
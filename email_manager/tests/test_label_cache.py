@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from email_manager.label_cache import LabelCache
+
+
+class TestLabelCache(unittest.TestCase):
+    def setUp(self):
+        self.list_labels = MagicMock(return_value=[{'id': 'Label_1', 'name': 'Receipts'}])
+        self.cache_file = os.path.join(tempfile.mkdtemp(), 'labels.json')
+        self.addCleanup(lambda: os.path.exists(self.cache_file) and os.remove(self.cache_file))
+
+    def test_labels_are_listed_once(self):
+        cache = LabelCache(self.list_labels)
+
+        ids = [cache.get_id('Receipts') for _ in range(5)]
+
+        self.assertEqual(ids, ['Label_1'] * 5)
+        self.list_labels.assert_called_once()
+
+    def test_miss_refreshes_once(self):
+        cache = LabelCache(self.list_labels)
+        cache.get_id('Receipts')
+        self.list_labels.return_value = [{'id': 'Label_1', 'name': 'Receipts'}, {'id': 'Label_2', 'name': 'Travel'}]
+
+        self.assertEqual(cache.get_id('Travel'), 'Label_2')
+        self.assertIsNone(cache.get_id('Unknown'))
+        self.assertIsNone(cache.get_id('Unknown'))
+        self.assertEqual(self.list_labels.call_count, 3)
+
+    def test_failed_refresh_keeps_cached_labels(self):
+        cache = LabelCache(self.list_labels)
+        cache.get_id('Receipts')
+        self.list_labels.return_value = None
+
+        cache.get_id('Unknown')
+
+        self.assertEqual(cache.get_id('Receipts'), 'Label_1')
+
+    def test_persisted_cache_is_reused_within_ttl(self):
+        LabelCache(self.list_labels, cache_file=self.cache_file).get_id('Receipts')
+
+        cache = LabelCache(MagicMock(), cache_file=self.cache_file)
+
+        self.assertEqual(cache.get_id('Receipts'), 'Label_1')
+        cache.list_labels.assert_not_called()
+
+    def test_persisted_cache_expires(self):
+        with open(self.cache_file, 'w') as f:
+            json.dump({'updated_at': time.time() - 120, 'labels': {'Receipts': 'Stale_1'}}, f)
+
+        cache = LabelCache(self.list_labels, cache_file=self.cache_file, ttl=60)
+
+        self.assertEqual(cache.get_id('Receipts'), 'Label_1')
+        self.list_labels.assert_called_once()
+
+    def test_added_label_keeps_the_cache_age(self):
+        listed_at = time.time() - 50
+        with open(self.cache_file, 'w') as f:
+            json.dump({'updated_at': listed_at, 'labels': {'Receipts': 'Label_1'}}, f)
+        cache = LabelCache(self.list_labels, cache_file=self.cache_file, ttl=60)
+
+        cache.add({'id': 'Label_2', 'name': 'Travel'})
+
+        with open(self.cache_file) as f:
+            self.assertEqual(json.load(f), {'updated_at': listed_at,
+                                            'labels': {'Receipts': 'Label_1', 'Travel': 'Label_2'}})
+        # only listing all the labels again restarts it
+        cache.update(self.list_labels())
+        with open(self.cache_file) as f:
+            self.assertGreater(json.load(f)['updated_at'], listed_at)
+
+    def test_invalidate_removes_persisted_cache(self):
+        cache = LabelCache(self.list_labels, cache_file=self.cache_file)
+        cache.get_id('Receipts')
+
+        cache.invalidate()
+
+        self.assertFalse(os.path.exists(self.cache_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
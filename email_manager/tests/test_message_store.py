@@ -0,0 +1,111 @@
+import os
+import random
+import tempfile
+import unittest
+
+from email_manager.tests.fake_gmail_server import make_message
+from ..message_store import MessageStore
+
+
+class TestMessageStore(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+
+    def open(self, **kwargs):
+        store = MessageStore(self.directory, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def test_messages_are_read_back_without_their_labels(self):
+        store = self.open()
+        message = make_message('msg001', body='<p>Hello</p>')
+
+        self.assertTrue(store.put(message))
+
+        stored = store.get('msg001')
+        self.assertEqual(stored['payload'], message['payload'])
+        self.assertNotIn('labelIds', stored)
+        self.assertIsNone(store.get('missing'))
+
+    def test_unchanged_messages_are_not_written_again(self):
+        store = self.open()
+        store.put(make_message('msg001'))
+        size = store.size
+
+        self.assertFalse(store.put(dict(make_message('msg001'), labelIds=['INBOX', 'Label_1'])))
+        self.assertTrue(store.put(make_message('msg001', subject='Edited')))
+
+        self.assertEqual(store.get('msg001')['payload']['headers'][0]['value'], 'Edited')
+        self.assertGreater(store.size, size)
+
+    def test_messages_persist_across_instances(self):
+        store = self.open()
+        for i in range(10):
+            store.put(make_message(f'msg{i:03d}'))
+        store.discard(['msg003'])
+        store.close()
+
+        store = self.open()
+
+        self.assertEqual(len(store), 9)
+        self.assertNotIn('msg003', store)
+        self.assertEqual(store.get('msg005')['id'], 'msg005')
+
+    def test_oldest_segments_are_evicted_past_max_bytes(self):
+        store = self.open(segment_bytes=4000, max_bytes=12000)
+
+        for i in range(100):
+            store.put(make_message(f'msg{i:03d}', body=random.Random(i).randbytes(1000).hex()))
+
+        self.assertLessEqual(store.size, 12000)
+        self.assertNotIn('msg000', store)
+        self.assertIn('msg099', store)
+        self.assertTrue(all(store.get(msg_id) is not None for msg_id in store))
+
+    def test_compaction_rewrites_segments_of_superseded_records(self):
+        store = self.open(segment_bytes=2000)
+        for i in range(40):
+            store.put(make_message(f'msg{i:03d}'))
+        store.discard([f'msg{i:03d}' for i in range(30)])
+        size = store.size
+
+        freed = store.compact()
+
+        self.assertGreater(freed, 0)
+        self.assertEqual(store.size, size - freed)
+        self.assertEqual(sorted(store), [f'msg{i:03d}' for i in range(30, 40)])
+        self.assertEqual([message['id'] for message in store.scan()], [f'msg{i:03d}' for i in range(30, 40)])
+        store.close()
+        self.assertEqual(len(self.open()), 10)
+
+    def test_lost_index_is_rebuilt_from_the_segments(self):
+        store = self.open(segment_bytes=2000)
+        for i in range(20):
+            store.put(make_message(f'msg{i:03d}'))
+        store.close()
+        os.remove(os.path.join(self.directory, MessageStore.INDEX_FILE))
+
+        store = self.open()
+
+        self.assertEqual(len(store), 20)
+        self.assertEqual(store.get('msg019')['id'], 'msg019')
+
+    def test_damaged_records_are_discarded(self):
+        store = self.open()
+        store.put(make_message('msg001'))
+        store.close()
+        with open(os.path.join(self.directory, 'segment-000001'), 'r+b') as f:
+            f.seek(-10, os.SEEK_END)
+            f.write(b'garbage')
+
+        store = self.open()
+
+        with self.assertLogs('logger', level='ERROR'):
+            self.assertIsNone(store.get('msg001'))
+        self.assertNotIn('msg001', store)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import logging
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from email_manager.parse_pool import ParsePool, parse_chunk, parse_message
+from email_manager.tests.fake_gmail_server import make_message
+from logger import logger
+
+
+class TestParsePool(unittest.TestCase):
+    def test_parse_message(self):
+        txt = dict(make_message('msg001', subject='Hi', body='<p>Hello</p>'), sizeEstimate=1234)
+
+        parsed = parse_message(txt)
+
+        self.assertEqual((parsed.msg_id, parsed.headers.subject, parsed.content, parsed.size),
+                         ('msg001', 'Hi', 'Hello', 1234))
+        self.assertEqual(parsed.headers.date_received, datetime(2024, 3, 23, 10, tzinfo=timezone.utc))
+        self.assertIsNone(parse_message(txt, with_body=False).content)
+
+    def test_per_message_logs_are_sampled_debug_logs(self):
+        messages = [make_message(f'msg{i:03d}') for i in range(10)]
+        with self.assertNoLogs(logger, level=logging.INFO):
+            parse_chunk(messages)
+
+        with patch.object(logger, 'level', logging.DEBUG), patch('logger.DEBUG_SAMPLE_RATE', 4), \
+                self.assertLogs(logger, level=logging.DEBUG) as logs:
+            parse_chunk(messages)
+
+        self.assertEqual(len([line for line in logs.output if 'Parsed' in line]), 3)
+
+    def test_unparseable_messages_are_dropped(self):
+        parsed = parse_chunk([make_message('msg001'), {'id': 'broken'}, make_message('msg002')])
+
+        self.assertEqual([message.msg_id for message in parsed], ['msg001', 'msg002'])
+
+    def test_pool_parses_like_a_single_process(self):
+        messages = [make_message(f'msg{i:03d}', body=f'<p>Body {i}</p>') for i in range(50)]
+
+        with ParsePool(workers=2, chunk_size=8) as pool:
+            parsed = sorted(pool.parse(messages))
+
+        self.assertEqual(parsed, parse_chunk(messages))
+
+    def test_workers_are_reused_across_parses(self):
+        messages = [make_message(f'msg{i:03d}') for i in range(30)]
+
+        with patch('email_manager.parse_pool.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as executor, \
+                ParsePool(workers=2, chunk_size=8) as pool:
+            # one parse per list page, as a sync does
+            parsed = [sorted(pool.parse(messages[start:start + 10])) for start in range(0, 30, 10)]
+
+        executor.assert_called_once()
+        self.assertEqual([message for page in parsed for message in page], parse_chunk(messages))
+
+    def test_messages_are_pulled_a_window_at_a_time(self):
+        pulled = []
+
+        def messages():
+            for i in range(200):
+                pulled.append(i)
+                yield make_message(f'msg{i:03d}')
+
+        pool = ParsePool(workers=1, chunk_size=10, max_in_flight=2)
+        self.addCleanup(pool.close)
+        parsed = pool.parse(messages())
+        next(parsed)
+
+        # two chunks in flight and the one waiting to be submitted
+        self.assertLessEqual(len(pulled), 30)
+        self.assertEqual(len(list(parsed)), 199)
+
+    def test_workers_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            ParsePool(workers=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
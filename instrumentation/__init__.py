@@ -0,0 +1,7 @@
+from .profiler import RunProfiler
+from .registry import Metrics
+from .registry import metrics
+from .sinks import InMemorySink
+from .sinks import JsonSink
+from .sinks import PrometheusTextSink
+from .sinks import sink_for_path
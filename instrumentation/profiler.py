@@ -0,0 +1,65 @@
+"""
+profiler.py
+
+This module contains the RunProfiler class which profiles a whole sync or rule run on demand.
+
+Classes:
+    RunProfiler: Profiles the block it wraps with cProfile and/or tracemalloc.
+
+"""
+
+import cProfile
+import pstats
+import tracemalloc
+
+from instrumentation.registry import metrics
+from logger import logger
+
+
+class RunProfiler:
+    """
+    Profiles the block it wraps. With a profile file, the block runs under cProfile and the stats are
+    dumped to the file for pstats or snakeviz. With trace_memory, Python allocations are traced with
+    tracemalloc; the peak goes to the `run_peak_traced_bytes` gauge and the lines that allocated most
+    are logged. Both slow the run down, so neither is on by default.
+
+    Attributes:
+        profile_file (str): The file to dump the cProfile stats to, or None not to profile.
+        trace_memory (bool): Whether to trace memory allocations.
+        top (int): The number of allocating lines logged when tracing memory.
+        stats (pstats.Stats): The cProfile stats of the last run, if profiled.
+        peak_bytes (int): The peak of traced memory of the last run, if traced.
+    """
+
+    def __init__(self, profile_file=None, trace_memory=False, top=10):
+        self.profile_file = profile_file
+        self.trace_memory = trace_memory
+        self.top = top
+        self.stats = None
+        self.peak_bytes = None
+        self._profiler = None
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profile_file:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_file)
+            self.stats = pstats.Stats(self._profiler).sort_stats('cumulative')
+            logger.info(f"Profile written to {self.profile_file}")
+            self._profiler = None
+        if self.trace_memory:
+            _, self.peak_bytes = tracemalloc.get_traced_memory()
+            top_lines = tracemalloc.take_snapshot().statistics('lineno')[:self.top]
+            tracemalloc.stop()
+            metrics.set('run_peak_traced_bytes', self.peak_bytes)
+            logger.info(f"Peak traced memory: {self.peak_bytes / 2 ** 20:.1f} MiB")
+            for stat in top_lines:
+                logger.info(f"  {stat}")
+        return False
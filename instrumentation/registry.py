@@ -0,0 +1,176 @@
+"""
+registry.py
+
+This module contains the Metrics registry the hot paths of syncs and rule runs report to, and the
+process-wide instance of it.
+
+Classes:
+    Metrics: Thread-safe counters, gauges and timers, labelled like Prometheus series.
+
+"""
+
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Collects counters, gauges and timers. A series is a metric name and its labels, e.g.
+    `gmail_api_calls_total{method="messages.get"}`. Recording takes a lock and a dict lookup, cheap
+    enough to do per message; reading a series takes the lock too, so it never sees a timer half updated. The collected values are handed to the sinks by `flush`.
+
+    Besides their count, total and longest timing, timers keep a uniform sample of up to
+    `RESERVOIR_SIZE` timings (reservoir sampling), from which the p50 and p99 are estimated in
+    constant memory however many timings are recorded.
+
+    Attributes:
+        sinks (list): The sinks `flush` writes to, each with a write(snapshot) method.
+    """
+
+    RESERVOIR_SIZE = 1024
+    QUANTILES = (0.5, 0.99)
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self._counters = {}
+        self._gauges = {}
+        # each timer is [count, total seconds, longest seconds, sampled timings]
+        self._timers = {}
+        self._random = random.Random(0)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds `value` to a counter.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge to `value`.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records one timing of `seconds` on a timer.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                timer = self._timers[key] = [0, 0.0, 0.0, []]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            samples = timer[3]
+            if len(samples) < self.RESERVOIR_SIZE:
+                samples.append(seconds)
+            else:
+                position = self._random.randrange(timer[0])
+                if position < self.RESERVOIR_SIZE:
+                    samples[position] = seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Times the block it wraps on a timer, whether it raises or not.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter(self, name, **labels):
+        """
+        Returns the value of a counter, 0 if it was never incremented.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def timing(self, name, **labels):
+        """
+        Returns the number of timings recorded on a timer and their total in seconds.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            count, total, _, _ = self._timers.get(key, (0, 0.0, 0.0, []))
+        return count, total
+
+    def percentile(self, name, quantile, **labels):
+        """
+        Estimates a quantile of a timer, e.g. 0.99 for the p99, from its sampled timings.
+
+        Returns:
+            float: The quantile in seconds, or None if the timer has no timings.
+        """
+        with self._lock:
+            _, _, _, samples = self._timers.get(self._key(name, labels), (0, 0.0, 0.0, []))
+            return self._quantile(sorted(samples), quantile)
+
+    @staticmethod
+    def _quantile(ordered, quantile):
+        # nearest rank
+        if not ordered:
+            return None
+        return ordered[max(0, math.ceil(quantile * len(ordered)) - 1)]
+
+    def snapshot(self):
+        """
+        Copies the current values of every series.
+
+        Returns:
+            dict: The 'counters', 'gauges' and 'timers', each a list of series sorted by name and labels.
+            A series is a dict of its name, its labels and its value, or the count, sum, max, p50 and p99
+            of a timer.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            timers = sorted((key, timer[:3] + [sorted(timer[3])]) for key, timer in self._timers.items())
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in counters],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in gauges],
+            'timers': [dict({'name': name, 'labels': dict(labels), 'count': count, 'sum': total, 'max': longest},
+                            **dict((f'p{quantile * 100:g}', self._quantile(ordered, quantile))
+                                   for quantile in self.QUANTILES))
+                       for (name, labels), (count, total, longest, ordered) in timers],
+        }
+
+    def flush(self):
+        """
+        Writes a snapshot of the metrics to every sink.
+
+        Returns:
+            dict: The snapshot written.
+        """
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.write(snapshot)
+        return snapshot
+
+    def reset(self):
+        """
+        Drops every series recorded so far; the sinks are kept.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._timers.clear()
+
+
+# the registry the email manager, the models and the rule engines report to
+metrics = Metrics()
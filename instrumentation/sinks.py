@@ -0,0 +1,120 @@
+"""
+sinks.py
+
+This module contains the sinks a Metrics registry writes its snapshots to.
+
+Classes:
+    InMemorySink: Keeps every snapshot it is given, for tests and benchmarks.
+    PrometheusTextSink: Writes the last snapshot in the Prometheus text exposition format.
+    JsonSink: Writes the last snapshot as a JSON document.
+
+Functions:
+    sink_for_path: Picks the sink writing to a file from the file extension.
+
+"""
+
+import itertools
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+
+
+class InMemorySink:
+    """
+    Keeps every snapshot it is given.
+
+    Attributes:
+        snapshots (list): The snapshots written so far, oldest first.
+    """
+
+    def __init__(self):
+        self.snapshots = []
+
+    def write(self, snapshot):
+        self.snapshots.append(snapshot)
+
+    @property
+    def last(self):
+        """
+        The last snapshot written, or None.
+        """
+        return self.snapshots[-1] if self.snapshots else None
+
+
+class _FileSink(ABC):
+    # replaces the file in one rename, so a reader never sees half a snapshot
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, snapshot):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render(snapshot))
+        os.replace(tmp_path, self.path)
+
+    @abstractmethod
+    def render(self, snapshot):
+        # the contents of the file for a snapshot
+        pass
+
+
+class PrometheusTextSink(_FileSink):
+    """
+    Writes the last snapshot in the Prometheus text exposition format, e.g. for the node exporter
+    textfile collector. Counters and gauges are written as they are; a timer is written as a summary,
+    its 0.5 and 0.99 quantiles, `<name>_count` and `<name>_sum`, plus a `<name>_max` gauge.
+
+    Attributes:
+        path (str): The file to write.
+    """
+
+    def render(self, snapshot):
+        lines = []
+        for kind in ('counters', 'gauges'):
+            metric_type = 'counter' if kind == 'counters' else 'gauge'
+            for name, series in itertools.groupby(snapshot[kind], key=lambda s: s['name']):
+                lines.append(f'# TYPE {name} {metric_type}')
+                lines.extend(f"{name}{self._labels(s['labels'])} {s['value']}" for s in series)
+        for name, series in itertools.groupby(snapshot['timers'], key=lambda s: s['name']):
+            series = list(series)
+            lines.append(f'# TYPE {name} summary')
+            for s in series:
+                for quantile in ('0.5', '0.99'):
+                    value = s[f'p{float(quantile) * 100:g}']
+                    if value is not None:
+                        lines.append(f"{name}{self._labels(dict(s['labels'], quantile=quantile))} {value}")
+                lines.append(f"{name}_count{self._labels(s['labels'])} {s['count']}")
+                lines.append(f"{name}_sum{self._labels(s['labels'])} {s['sum']}")
+            lines.append(f'# TYPE {name}_max gauge')
+            lines.extend(f"{name}_max{self._labels(s['labels'])} {s['max']}" for s in series)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        pairs = []
+        for key, value in labels.items():
+            value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+        return '{' + ','.join(pairs) + '}'
+
+
+class JsonSink(_FileSink):
+    """
+    Writes the last snapshot as a JSON document, with the time it was written.
+
+    Attributes:
+        path (str): The file to write.
+    """
+
+    def render(self, snapshot):
+        return json.dumps(dict(snapshot, written_at=time.time()), indent=2)
+
+
+def sink_for_path(path):
+    """
+    Returns the sink writing to the given file: JSON for a .json file, the Prometheus text format otherwise.
+    """
+    return JsonSink(path) if path.endswith('.json') else PrometheusTextSink(path)
@@ -0,0 +1,34 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ..profiler import RunProfiler
+from ..registry import Metrics
+
+
+class TestRunProfiler(unittest.TestCase):
+    def test_profile_and_memory_peak(self):
+        metrics = Metrics()
+        profile_file = os.path.join(tempfile.mkdtemp(), 'run.prof')
+
+        with patch('instrumentation.profiler.metrics', metrics):
+            with RunProfiler(profile_file, trace_memory=True) as profiler:
+                blob = [bytes(1024) for _ in range(1024)]
+                del blob
+
+        self.assertTrue(os.path.getsize(profile_file) > 0)
+        self.assertGreater(profiler.peak_bytes, 2 ** 20)
+        self.assertEqual(metrics.snapshot()['gauges'], [{'name': 'run_peak_traced_bytes', 'labels': {},
+                                                         'value': profiler.peak_bytes}])
+
+    def test_nothing_is_profiled_by_default(self):
+        with RunProfiler() as profiler:
+            pass
+
+        self.assertIsNone(profiler.stats)
+        self.assertIsNone(profiler.peak_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
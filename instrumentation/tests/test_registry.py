@@ -0,0 +1,86 @@
+import threading
+import unittest
+
+from ..registry import Metrics
+from ..sinks import InMemorySink
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_series_are_told_apart_by_labels(self):
+        self.metrics.increment('gmail_api_calls_total', method='messages.get')
+        self.metrics.increment('gmail_api_calls_total', 2, method='messages.get')
+        self.metrics.increment('gmail_api_calls_total', method='messages.list')
+
+        self.assertEqual(self.metrics.counter('gmail_api_calls_total', method='messages.get'), 3)
+        self.assertEqual(self.metrics.counter('gmail_api_calls_total', method='messages.list'), 1)
+        self.assertEqual(self.metrics.counter('gmail_api_calls_total', method='history.list'), 0)
+
+    def test_timer_records_failing_blocks(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('db_seconds', statement='upsert'):
+                raise ValueError
+        self.metrics.observe('db_seconds', 0.5, statement='upsert')
+
+        count, total = self.metrics.timing('db_seconds', statement='upsert')
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(total, 0.5)
+
+    def test_percentiles_are_estimated_from_a_bounded_sample(self):
+        for i in range(10000):
+            self.metrics.observe('gmail_api_seconds', i / 10000, method='batch')
+
+        self.assertAlmostEqual(self.metrics.percentile('gmail_api_seconds', 0.5, method='batch'), 0.5, delta=0.05)
+        self.assertAlmostEqual(self.metrics.percentile('gmail_api_seconds', 0.99, method='batch'), 0.99, delta=0.02)
+        self.assertIsNone(self.metrics.percentile('gmail_api_seconds', 0.5, method='messages.get'))
+        self.assertEqual(len(self.metrics._timers[self.metrics._key('gmail_api_seconds', {'method': 'batch'})][3]),
+                         Metrics.RESERVOIR_SIZE)
+
+    def test_increments_from_many_threads_add_up(self):
+        def work():
+            for _ in range(1000):
+                self.metrics.increment('messages_parsed_total')
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.metrics.counter('messages_parsed_total'), 8000)
+
+    def test_reads_wait_for_the_lock(self):
+        self.metrics.observe('db_seconds', 0.5)
+        values = []
+        with self.metrics._lock:
+            reader = threading.Thread(target=lambda: values.append((self.metrics.counter('messages_parsed_total'),
+                                                                    self.metrics.timing('db_seconds'))))
+            reader.start()
+            reader.join(0.05)
+            self.assertTrue(reader.is_alive())
+        reader.join()
+
+        self.assertEqual(values, [(0, (1, 0.5))])
+
+    def test_flush_writes_a_snapshot_to_every_sink(self):
+        sinks = [InMemorySink(), InMemorySink()]
+        self.metrics.sinks.extend(sinks)
+        self.metrics.increment('emails_modified_total', 5)
+        self.metrics.set('run_peak_traced_bytes', 1024)
+        self.metrics.observe('sync_seconds', 2.0)
+
+        self.metrics.flush()
+
+        self.assertEqual(sinks[0].last, sinks[1].last)
+        self.assertEqual(sinks[0].last, {
+            'counters': [{'name': 'emails_modified_total', 'labels': {}, 'value': 5}],
+            'gauges': [{'name': 'run_peak_traced_bytes', 'labels': {}, 'value': 1024}],
+            'timers': [{'name': 'sync_seconds', 'labels': {}, 'count': 1, 'sum': 2.0, 'max': 2.0, 'p50': 2.0,
+                        'p99': 2.0}],
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
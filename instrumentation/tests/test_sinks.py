@@ -0,0 +1,68 @@
+import json
+import os
+import tempfile
+import unittest
+
+from ..registry import Metrics
+from ..sinks import JsonSink, PrometheusTextSink, _FileSink, sink_for_path
+
+
+class TestSinks(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.metrics = Metrics()
+        self.metrics.increment('gmail_api_calls_total', 3, method='messages.get')
+        self.metrics.increment('gmail_api_calls_total', method='messages.list')
+        self.metrics.observe('db_seconds', 0.25, statement='upsert')
+        self.metrics.observe('db_seconds', 0.75, statement='upsert')
+
+    def test_prometheus_text(self):
+        path = os.path.join(self.tmp_dir, 'gmail.prom')
+        self.metrics.sinks.append(PrometheusTextSink(path))
+
+        self.metrics.flush()
+
+        with open(path) as f:
+            self.assertEqual(f.read().splitlines(), [
+                '# TYPE gmail_api_calls_total counter',
+                'gmail_api_calls_total{method="messages.get"} 3',
+                'gmail_api_calls_total{method="messages.list"} 1',
+                '# TYPE db_seconds summary',
+                'db_seconds{statement="upsert",quantile="0.5"} 0.25',
+                'db_seconds{statement="upsert",quantile="0.99"} 0.75',
+                'db_seconds_count{statement="upsert"} 2',
+                'db_seconds_sum{statement="upsert"} 1.0',
+                '# TYPE db_seconds_max gauge',
+                'db_seconds_max{statement="upsert"} 0.75',
+            ])
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_prometheus_label_values_are_escaped(self):
+        self.assertEqual(PrometheusTextSink._labels({'rules_file': 'rules\\"odd".json'}),
+                         '{rules_file="rules\\\\\\"odd\\".json"}')
+
+    def test_json(self):
+        path = os.path.join(self.tmp_dir, 'metrics.json')
+        self.metrics.sinks.append(sink_for_path(path))
+
+        self.metrics.flush()
+
+        with open(path) as f:
+            document = json.load(f)
+        self.assertEqual(document['counters'][0], {'name': 'gmail_api_calls_total',
+                                                   'labels': {'method': 'messages.get'}, 'value': 3})
+        self.assertIn('written_at', document)
+
+    def test_sink_for_path(self):
+        self.assertIsInstance(sink_for_path('metrics.json'), JsonSink)
+        self.assertIsInstance(sink_for_path('gmail.prom'), PrometheusTextSink)
+
+    def test_file_sinks_must_render(self):
+        with self.assertRaises(TypeError):
+            _FileSink(os.path.join(self.tmp_dir, 'metrics.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
+import itertools
 import logging
+from collections import defaultdict
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -13,3 +15,34 @@ ch.setFormatter(formatter)
 
 # add the handlers to the logger
 logger.addHandler(ch)
+
+# per-message logs go out at DEBUG, and only one in DEBUG_SAMPLE_RATE of them
+DEBUG_SAMPLE_RATE = 100
+_samples = defaultdict(itertools.count)
+
+
+def configure(level=logging.INFO, sample_rate=None):
+    """
+    Sets the level of the logger and its console handler, and the sampling of per-message debug logs.
+    """
+    global DEBUG_SAMPLE_RATE
+    logger.setLevel(level)
+    ch.setLevel(level)
+    if sample_rate is not None:
+        DEBUG_SAMPLE_RATE = max(1, sample_rate)
+
+
+def sample_rate():
+    """
+    Returns the number of per-message debug logs out of which one is written.
+    """
+    return DEBUG_SAMPLE_RATE
+
+
+def debug_sampled(key, msg, *args):
+    """
+    Logs `msg % args` at DEBUG for one in every DEBUG_SAMPLE_RATE calls with the same key. Nothing is
+    formatted unless DEBUG is enabled, so a disabled call costs one level check.
+    """
+    if logger.isEnabledFor(logging.DEBUG) and next(_samples[key]) % DEBUG_SAMPLE_RATE == 0:
+        logger.debug(msg, *args)
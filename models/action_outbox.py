@@ -0,0 +1,101 @@
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index, func, insert
+
+from models.email import Base, session
+
+
+# a label change planned by the rules for one email, kept until the drain has sent it to Gmail:
+# pending until batchModify succeeds, then done, or failed once the drain gives up on it
+class OutboxEntry(Base):
+    __tablename__ = 'action_outbox'
+    __table_args__ = (
+        Index('ix_action_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    account = Column(String)
+    msg_id = Column(String)
+    # comma-separated label IDs
+    add_label_ids = Column(String)
+    remove_label_ids = Column(String)
+    status = Column(String)
+    attempts = Column(Integer)
+    error = Column(Text)
+    enqueued_at = Column(DateTime)
+    next_attempt_at = Column(DateTime)
+    done_at = Column(DateTime)
+
+    def label_changes(self):
+        return ([label_id for label_id in self.add_label_ids.split(',') if label_id],
+                [label_id for label_id in self.remove_label_ids.split(',') if label_id])
+
+    @classmethod
+    def _account_filter(cls, query, account):
+        return query.filter(cls.account.is_(None) if account is None else cls.account == account)
+
+    @classmethod
+    def enqueue(cls, changes, account=None, enqueued_at=None, chunk_size=500):
+        # changes maps (label IDs to add, label IDs to remove) to the message IDs getting them
+        enqueued_at = enqueued_at or datetime.now()
+        rows = [{'account': account, 'msg_id': msg_id, 'add_label_ids': ','.join(add_label_ids),
+                 'remove_label_ids': ','.join(remove_label_ids), 'status': cls.PENDING, 'attempts': 0,
+                 'enqueued_at': enqueued_at, 'next_attempt_at': enqueued_at}
+                for (add_label_ids, remove_label_ids), msg_ids in changes.items() for msg_id in msg_ids]
+        for start in range(0, len(rows), chunk_size):
+            session.execute(insert(cls), rows[start:start + chunk_size])
+        session.commit()
+        return len(rows)
+
+    @classmethod
+    def due(cls, account, now, limit):
+        # the pending entries whose attempt is due, in the order they were enqueued
+        query = cls._account_filter(session.query(cls), account)
+        return query.filter(cls.status == cls.PENDING, cls.next_attempt_at <= now).order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def pending_for(cls, account, msg_ids, chunk_size=500):
+        # every pending entry of the given emails, due or waiting for a retry, in the order they were enqueued
+        msg_ids = sorted(set(msg_ids))
+        entries = []
+        for start in range(0, len(msg_ids), chunk_size):
+            query = cls._account_filter(session.query(cls), account)
+            entries.extend(query.filter(cls.status == cls.PENDING, cls.msg_id.in_(msg_ids[start:start + chunk_size])))
+        return sorted(entries, key=lambda entry: entry.id)
+
+    @classmethod
+    def earliest_attempt_at(cls, account):
+        query = cls._account_filter(session.query(func.min(cls.next_attempt_at)), account)
+        return query.filter(cls.status == cls.PENDING).scalar()
+
+    @classmethod
+    def counts(cls, account=None):
+        query = cls._account_filter(session.query(cls.status, func.count()), account)
+        return dict(query.group_by(cls.status))
+
+    @classmethod
+    def _update(cls, ids, values, chunk_size=500):
+        ids = list(ids)
+        for start in range(0, len(ids), chunk_size):
+            session.query(cls).filter(cls.id.in_(ids[start:start + chunk_size])).update(
+                values, synchronize_session=False)
+        session.commit()
+
+    @classmethod
+    def mark_done(cls, ids, done_at):
+        cls._update(ids, {cls.status: cls.DONE, cls.attempts: cls.attempts + 1, cls.error: None,
+                          cls.done_at: done_at})
+
+    @classmethod
+    def mark_retry(cls, ids, error, next_attempt_at):
+        cls._update(ids, {cls.attempts: cls.attempts + 1, cls.error: str(error),
+                          cls.next_attempt_at: next_attempt_at})
+
+    @classmethod
+    def mark_failed(cls, ids, error, failed_at):
+        cls._update(ids, {cls.status: cls.FAILED, cls.attempts: cls.attempts + 1, cls.error: str(error),
+                          cls.done_at: failed_at})
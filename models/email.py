@@ -1,18 +1,47 @@
+import itertools
+import re
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
-from sqlalchemy import Column, String, DateTime, and_
+from sqlalchemy import DDL, Column, String, DateTime, Index, and_, event, false, func, literal_column, or_, select, \
+    tuple_
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 
+from instrumentation import metrics
+
 Base = declarative_base()
 
 from session import Session
-session = Session()
+# the scoped_session registry itself, so every thread that touches the models works in its own Session
+session = Session
+
+
+
+# columns the rules match with contains, i.e. LIKE '%value%', which only a trigram index can serve
+TRIGRAM_COLUMNS = ('sender', 'subject', 'recipient', 'cc')
+# the text search configuration of content_tsv: lowercased words, no stemming nor stop words, which the
+# terms of body_terms mirror
+TEXT_SEARCH_CONFIG = 'simple'
+# runs of letters and digits, the words PostgreSQL's parser splits text into
+TERM_RE = re.compile(r'[^\W_]+')
+
 
+def body_terms(text):
+    # the distinct lowercased words of a text, what a matches predicate looks for
+    return set(TERM_RE.findall(text.lower())) if text else set()
 
 
 class Email(Base):
     __tablename__ = 'emails'
+    __table_args__ = (
+        Index('ix_emails_date_received', 'date_received'),
+        Index('ix_emails_account', 'account'),
+        # pg_trgm GIN indexes, created on PostgreSQL only as other databases have no use for them
+        *(Index(f'ix_emails_{column}_trgm', column, postgresql_using='gin',
+                postgresql_ops={column: 'gin_trgm_ops'}).ddl_if(dialect='postgresql')
+          for column in TRIGRAM_COLUMNS),
+    )
 
     msg_id = Column(String, primary_key=True)
     sender = Column(String)
@@ -22,6 +51,9 @@ class Email(Base):
     synced_at = Column(DateTime)
     recipient = Column(String)
     cc = Column(String)
+    # the partition key of the mailbox the email belongs to, when several mailboxes share the table, and
+    # '' when they do not. A message ID is only unique within a mailbox, so it is part of the key
+    account = Column(String, primary_key=True, default='', server_default='')
 
     @classmethod
     def filter(cls, **kwargs):
@@ -29,22 +61,191 @@ class Email(Base):
         for key, value in kwargs.items():
             if isinstance(value, dict):
                 for op, v in value.items():
-                    if op == 'contains':
-                        filters.append(getattr(cls, key).like(f"%{v}%"))
-                    elif op == 'not':
-                        filters.append(getattr(cls, key) != v)
-                    elif op == 'lt':
-                        filters.append(getattr(cls, key) > v)
-                    elif op == 'gt':
-                        filters.append(getattr(cls, key) < v)
+                    filters.append(cls.clause(key, op, v))
             else:
                 filters.append(getattr(cls, key) == value)
         return session.query(cls.msg_id).filter(and_(*filters))
 
     @classmethod
-    def get_by_msg_id(cls, msg_id):
-        return session.query(cls).filter_by(msg_id=msg_id).first()
+    def clause(cls, key, op, value):
+        column = getattr(cls, key)
+        if op == 'contains':
+            return column.like(f"%{value}%")
+        elif op == 'not':
+            return column != value
+        elif op == 'lt':
+            return column > value
+        elif op == 'gt':
+            return column < value
+        elif op == 'matches':
+            if key != 'content':
+                raise ValueError(f"Only the body can be searched with matches, not {key}")
+            return cls.matches(value)
+        raise ValueError(f"Unknown predicate: {op}")
+
+    @classmethod
+    def matches(cls, value):
+        # the emails whose body has every word of value, whatever the case. PostgreSQL looks them up in the
+        # GIN index of the content_tsv column, other databases in the email_terms table
+        terms = body_terms(value)
+        if not terms:
+            return false()
+        if session.get_bind().dialect.name == 'postgresql':
+            return literal_column('emails.content_tsv').op('@@')(func.plainto_tsquery(TEXT_SEARCH_CONFIG, value))
+        with_all_terms = select(EmailTerm.account, EmailTerm.msg_id).where(EmailTerm.term.in_(sorted(terms))) \
+            .group_by(EmailTerm.account, EmailTerm.msg_id).having(func.count() == len(terms))
+        return tuple_(cls.account, cls.msg_id).in_(with_all_terms)
+
+    @classmethod
+    def _indexes_terms(cls):
+        # whether the bodies are indexed in email_terms, i.e. the database has no full-text search of its own
+        return session.get_bind().dialect.name != 'postgresql'
+
+    @classmethod
+    def iter_msg_ids(cls, criterion, yield_per=1000):
+        # streams the matching msg_ids from the database yield_per rows at a time
+        for (msg_id,) in session.query(cls.msg_id).filter(criterion).yield_per(yield_per):
+            yield msg_id
+
+    @classmethod
+    def iter_clause_values(cls, clauses, criterion=None, yield_per=1000):
+        # streams each email matching the criterion, by default any of the clauses, as (msg_id, value of every clause)
+        query = session.query(cls.msg_id, *(clause.label(f'clause_{i}') for i, clause in enumerate(clauses)))
+        criterion = or_(*clauses) if criterion is None else criterion
+        for msg_id, *values in query.filter(criterion).yield_per(yield_per):
+            yield msg_id, values
+
+    @classmethod
+    def get_by_msg_id(cls, msg_id, account=None):
+        # with an account, the email of that mailbox, otherwise the first one with the msg_id
+        query = session.query(cls).filter_by(msg_id=msg_id)
+        if account is not None:
+            query = query.filter_by(account=account)
+        return query.first()
+
+    @classmethod
+    def delete_by_msg_ids(cls, msg_ids, account=None):
+        # with an account, only the emails of that mailbox are deleted
+        msg_ids = list(msg_ids)
+        if not msg_ids:
+            return 0
+        with metrics.timer('db_seconds', statement='delete'):
+            query = session.query(cls).filter(cls.msg_id.in_(msg_ids))
+            if account is not None:
+                query = query.filter(cls.account == account)
+            deleted = query.delete(synchronize_session=False)
+            if cls._indexes_terms():
+                EmailTerm.delete_by_msg_ids(msg_ids, account)
+            session.commit()
+        metrics.increment('db_rows_deleted_total', deleted)
+        return deleted
+
+    @classmethod
+    def bulk_upsert(cls, rows, chunk_size=500):
+        # rows is an iterable of column dicts keyed by account, '' when left out, and msg_id. It is consumed
+        # chunk_size rows at a time, each chunk is written with one INSERT ... ON CONFLICT (account, msg_id)
+        # DO UPDATE and committed once. Returns the number of (inserted, updated) rows.
+        inserted = updated = 0
+        rows = iter(rows)
+        while True:
+            # a row repeated within a chunk would hit the same conflict twice, so the last one wins
+            chunk = list(dict((cls._key(row), row) for row in itertools.islice(rows, chunk_size)).values())
+            if not chunk:
+                return inserted, updated
+            try:
+                # timed apart from building the rows, which pulls the fetches and parses behind them
+                with metrics.timer('db_seconds', statement='upsert'):
+                    chunk_inserted = cls._upsert_chunk(chunk)
+                    session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            metrics.increment('db_rows_upserted_total', chunk_inserted, result='inserted')
+            metrics.increment('db_rows_upserted_total', len(chunk) - chunk_inserted, result='updated')
+            inserted += chunk_inserted
+            updated += len(chunk) - chunk_inserted
+
+    @classmethod
+    def _upsert_chunk(cls, chunk):
+        dialect = session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            stmt = postgresql.insert(cls).values(chunk)
+        elif dialect == 'sqlite':
+            stmt = sqlite.insert(cls).values(chunk)
+        else:
+            raise NotImplementedError(f"bulk_upsert does not support the {dialect} dialect")
+
+        columns = set(itertools.chain(*chunk)) - {'account', 'msg_id'}
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.account, cls.msg_id],
+            set_=dict((column, stmt.excluded[column]) for column in columns),
+        )
+
+        if dialect == 'postgresql':
+            # xmax is 0 only on freshly inserted row versions
+            return sum(1 for (is_insert,) in session.execute(stmt.returning(literal_column('xmax = 0'))) if is_insert)
+
+        # SQLite has no way to tell inserts from updates in RETURNING, so look the existing rows up first
+        keys = [cls._key(row) for row in chunk]
+        existing = session.query(cls.msg_id).filter(tuple_(cls.account, cls.msg_id).in_(keys)).count()
+        session.execute(stmt)
+        EmailTerm.index(dict((cls._key(row), row['content']) for row in chunk if 'content' in row))
+        return len(chunk) - existing
+
+    @staticmethod
+    def _key(row):
+        # the (account, msg_id) primary key of a row to upsert
+        return row.get('account', ''), row['msg_id']
 
     def save(self):
         session.add(self)
         session.commit()
+
+
+# the inverted index of the email bodies on databases without full-text search, i.e. SQLite: a row per
+# distinct word of each body, kept up to date by Email.bulk_upsert. PostgreSQL searches content_tsv instead,
+# so the migrations do not create the table there
+class EmailTerm(Base):
+    __tablename__ = 'email_terms'
+    __table_args__ = (
+        Index('ix_email_terms_account_msg_id', 'account', 'msg_id'),
+        {'sqlite_with_rowid': False},
+    )
+
+    term = Column(String, primary_key=True)
+    account = Column(String, primary_key=True, default='', server_default='')
+    msg_id = Column(String, primary_key=True)
+
+    @classmethod
+    def index(cls, contents, chunk_size=10000):
+        # replaces the terms of each email of contents, (account, msg_id) to body; left to the caller to commit
+        if not contents:
+            return
+        session.query(cls).filter(tuple_(cls.account, cls.msg_id).in_(list(contents))) \
+            .delete(synchronize_session=False)
+        rows = ({'term': term, 'account': account, 'msg_id': msg_id}
+                for (account, msg_id), content in contents.items() for term in body_terms(content))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            session.execute(cls.__table__.insert(), chunk)
+
+    @classmethod
+    def delete_by_msg_ids(cls, msg_ids, account=None):
+        query = session.query(cls).filter(cls.msg_id.in_(list(msg_ids)))
+        if account is not None:
+            query = query.filter(cls.account == account)
+        query.delete(synchronize_session=False)
+
+
+# the trigram indexes need the pg_trgm extension, so enable it whenever the table is created on PostgreSQL
+event.listen(Email.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+# the words of the bodies, kept up to date by PostgreSQL itself, and the GIN index matches searches them with
+event.listen(Email.__table__, 'after_create', DDL(
+    f"ALTER TABLE emails ADD COLUMN content_tsv tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(content, ''))) STORED"
+).execute_if(dialect='postgresql'))
+event.listen(Email.__table__, 'after_create',
+             DDL('CREATE INDEX ix_emails_content_tsv ON emails USING gin (content_tsv)').execute_if(dialect='postgresql'))
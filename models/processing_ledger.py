@@ -0,0 +1,55 @@
+import json
+
+from sqlalchemy import Column, String, DateTime, insert
+
+from models.email import Base, session
+
+
+# the progress of a rule set: the synced_at up to which the emails have been evaluated
+class RuleSetRun(Base):
+    __tablename__ = 'rule_set_runs'
+
+    rule_set_hash = Column(String, primary_key=True)
+    rules_file_path = Column(String)
+    watermark = Column(DateTime)
+    last_run_at = Column(DateTime)
+
+    @classmethod
+    def get(cls, rule_set_hash):
+        return session.query(cls).filter_by(rule_set_hash=rule_set_hash).first()
+
+    def save(self):
+        session.add(self)
+        session.commit()
+
+
+# one row per email a rule set's actions were applied to
+class AppliedAction(Base):
+    __tablename__ = 'applied_actions'
+
+    rule_set_hash = Column(String, primary_key=True)
+    msg_id = Column(String, primary_key=True)
+    actions = Column(String)
+    applied_at = Column(DateTime)
+
+    @classmethod
+    def applied_ids(cls, rule_set_hash, msg_ids, chunk_size=500):
+        msg_ids = list(msg_ids)
+        applied = set()
+        for start in range(0, len(msg_ids), chunk_size):
+            query = session.query(cls.msg_id).filter(cls.rule_set_hash == rule_set_hash,
+                                                     cls.msg_id.in_(msg_ids[start:start + chunk_size]))
+            applied.update(msg_id for (msg_id,) in query)
+        return applied
+
+    @classmethod
+    def record(cls, rule_set_hash, msg_ids, actions, applied_at, chunk_size=500):
+        msg_ids = sorted(set(msg_ids) - cls.applied_ids(rule_set_hash, msg_ids))
+        actions = json.dumps(actions)
+        for start in range(0, len(msg_ids), chunk_size):
+            session.execute(insert(cls), [
+                {'rule_set_hash': rule_set_hash, 'msg_id': msg_id, 'actions': actions, 'applied_at': applied_at}
+                for msg_id in msg_ids[start:start + chunk_size]
+            ])
+        session.commit()
+        return len(msg_ids)
@@ -0,0 +1,82 @@
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, DateTime, Text
+
+from models.email import Base, session
+
+
+# where an interrupted full sync of an account resumes: the list page to request again and the last
+# message ID of that page already saved, plus the historyId the sync started from
+class SyncCheckpoint(Base):
+    __tablename__ = 'sync_checkpoints'
+
+    account = Column(String, primary_key=True)
+    history_id = Column(String)
+    page_token = Column(String)
+    last_msg_id = Column(String)
+    updated_at = Column(DateTime)
+
+    @classmethod
+    def get(cls, account):
+        return session.query(cls).filter_by(account=account).first()
+
+    @classmethod
+    def store(cls, account, history_id, page_token, last_msg_id):
+        # looked up again on every call, as consecutive steps of a sync may run on different threads
+        checkpoint = cls.get(account) or cls(account=account)
+        checkpoint.history_id = history_id
+        checkpoint.page_token = page_token
+        checkpoint.last_msg_id = last_msg_id
+        checkpoint.updated_at = datetime.now()
+        session.add(checkpoint)
+        session.commit()
+
+    @classmethod
+    def clear(cls, account):
+        session.query(cls).filter_by(account=account).delete()
+        session.commit()
+
+
+# the dead-letter list: messages of an account that could not be fetched or parsed, and why
+class FailedMessage(Base):
+    __tablename__ = 'failed_messages'
+
+    account = Column(String, primary_key=True)
+    msg_id = Column(String, primary_key=True)
+    error = Column(Text)
+    attempts = Column(Integer)
+    failed_at = Column(DateTime)
+
+    @classmethod
+    def retriable_ids(cls, account, max_attempts):
+        query = session.query(cls.msg_id).filter(cls.account == account, cls.attempts < max_attempts)
+        return [msg_id for (msg_id,) in query.order_by(cls.msg_id)]
+
+    @classmethod
+    def record(cls, account, errors, chunk_size=500):
+        # errors maps message IDs to the reason they failed; a message failing again counts one more attempt
+        msg_ids = sorted(errors)
+        now = datetime.now()
+        for start in range(0, len(msg_ids), chunk_size):
+            chunk = msg_ids[start:start + chunk_size]
+            existing = dict((failed.msg_id, failed) for failed in
+                            session.query(cls).filter(cls.account == account, cls.msg_id.in_(chunk)))
+            for msg_id in chunk:
+                failed = existing.get(msg_id) or cls(account=account, msg_id=msg_id, attempts=0)
+                failed.error = str(errors[msg_id])
+                failed.attempts += 1
+                failed.failed_at = now
+                session.add(failed)
+        session.commit()
+        return len(msg_ids)
+
+    @classmethod
+    def resolve(cls, account, msg_ids, chunk_size=500):
+        msg_ids = list(msg_ids)
+        resolved = 0
+        for start in range(0, len(msg_ids), chunk_size):
+            resolved += session.query(cls).filter(cls.account == account,
+                                                  cls.msg_id.in_(msg_ids[start:start + chunk_size])
+                                                  ).delete(synchronize_session=False)
+        session.commit()
+        return resolved
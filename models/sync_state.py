@@ -0,0 +1,19 @@
+from sqlalchemy import Column, String, DateTime
+
+from models.email import Base, session
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    account = Column(String, primary_key=True)
+    history_id = Column(String)
+    updated_at = Column(DateTime)
+
+    @classmethod
+    def get(cls, account):
+        return session.query(cls).filter_by(account=account).first()
+
+    def save(self):
+        session.add(self)
+        session.commit()
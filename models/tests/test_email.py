@@ -0,0 +1,154 @@
+import io
+import os
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, create_mock_engine, inspect
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from models.email import Base, Email, EmailTerm, session
+
+
+def email_row(msg_id, subject='Hello', content='<p>Hello</p>'):
+    return {
+        'msg_id': msg_id,
+        'subject': subject,
+        'sender': 'sender@example.com',
+        'content': content,
+        'recipient': 'me@example.com',
+        'cc': None,
+        'date_received': datetime(2024, 3, 23, 10, 0),
+        'synced_at': datetime(2024, 3, 24, 10, 0),
+    }
+
+
+class TestEmail(unittest.TestCase):
+    def setUp(self):
+        self.engine = engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+    def test_bulk_upsert_inserts_new_rows(self):
+        inserted, updated = Email.bulk_upsert(email_row(f'msg{i}') for i in range(5))
+
+        self.assertEqual((inserted, updated), (5, 0))
+        self.assertEqual(session.query(Email).count(), 5)
+
+    def test_bulk_upsert_updates_existing_rows(self):
+        Email.bulk_upsert([email_row('msg0'), email_row('msg1')])
+
+        inserted, updated = Email.bulk_upsert([email_row('msg1', subject='Changed'), email_row('msg2')])
+
+        self.assertEqual((inserted, updated), (1, 1))
+        session.expire_all()
+        self.assertEqual(Email.get_by_msg_id('msg1').subject, 'Changed')
+        self.assertEqual(session.query(Email).count(), 3)
+
+    def test_bulk_upsert_commits_once_per_chunk(self):
+        with patch.object(session, 'commit', wraps=session.commit) as mock_commit:
+            Email.bulk_upsert((email_row(f'msg{i}') for i in range(25)), chunk_size=10)
+
+        self.assertEqual(mock_commit.call_count, 3)
+
+    def test_bulk_upsert_keeps_last_duplicate_in_chunk(self):
+        inserted, updated = Email.bulk_upsert([email_row('msg0'), email_row('msg0', subject='Last')])
+
+        self.assertEqual((inserted, updated), (1, 0))
+        self.assertEqual(Email.get_by_msg_id('msg0').subject, 'Last')
+
+    def test_bulk_upsert_keeps_a_row_per_account(self):
+        Email.bulk_upsert([dict(email_row('msg0', content='invoice'), account='alice'),
+                           dict(email_row('msg0', content='receipt'), account='bob')])
+
+        inserted, updated = Email.bulk_upsert([dict(email_row('msg0', subject='Changed'), account='alice')])
+
+        self.assertEqual((inserted, updated), (0, 1))
+        self.assertEqual(Email.get_by_msg_id('msg0', 'alice').subject, 'Changed')
+        self.assertEqual(Email.get_by_msg_id('msg0', 'bob').subject, 'Hello')
+        self.assertEqual(self.search('receipt'), ['msg0'])
+        Email.delete_by_msg_ids(['msg0'], 'bob')
+        self.assertEqual(self.search('receipt'), [])
+        self.assertEqual(session.query(Email.account).all(), [('alice',)])
+
+    def test_trigram_indexes_are_postgresql_only(self):
+        indexes = [index['name'] for index in inspect(self.engine).get_indexes('emails')]
+
+        self.assertEqual(sorted(indexes), ['ix_emails_account', 'ix_emails_date_received'])
+        ddl = dict((index.name, str(CreateIndex(index).compile(dialect=postgresql.dialect())))
+                   for index in Email.__table__.indexes)
+        self.assertEqual(ddl['ix_emails_subject_trgm'],
+                         'CREATE INDEX ix_emails_subject_trgm ON emails USING gin (subject gin_trgm_ops)')
+
+
+    def search(self, value):
+        query = session.query(Email.msg_id).filter(Email.clause('content', 'matches', value))
+        return sorted(msg_id for (msg_id,) in query)
+
+    def test_matches_finds_bodies_with_every_word(self):
+        Email.bulk_upsert([email_row('msg0', content='The quarterly report is attached.'),
+                           email_row('msg1', content='Quarterly numbers, no report yet'),
+                           email_row('msg2', content='Lunch?')])
+
+        self.assertEqual(self.search('report'), ['msg0', 'msg1'])
+        self.assertEqual(self.search('QUARTERLY report!'), ['msg0', 'msg1'])
+        self.assertEqual(self.search('report attached'), ['msg0'])
+        self.assertEqual(self.search('repo'), [])
+        self.assertEqual(self.search('...'), [])
+
+    def test_body_index_follows_upserts_and_deletes(self):
+        Email.bulk_upsert([email_row('msg0', content='old invoice'), email_row('msg1', content='invoice')])
+
+        Email.bulk_upsert([email_row('msg0', content='new receipt')])
+        # a row synced without its body keeps the words of the body stored
+        row = email_row('msg1')
+        del row['content']
+        Email.bulk_upsert([row])
+
+        self.assertEqual(self.search('invoice'), ['msg1'])
+        self.assertEqual(self.search('receipt'), ['msg0'])
+        Email.delete_by_msg_ids(['msg1'])
+        self.assertEqual(session.query(EmailTerm).filter_by(msg_id='msg1').count(), 0)
+
+    def test_matches_is_only_for_the_body(self):
+        with self.assertRaises(ValueError):
+            Email.clause('subject', 'matches', 'report')
+
+    def test_matches_searches_the_tsvector_column_on_postgresql(self):
+        with patch.object(session.registry(), 'get_bind', return_value=create_engine('postgresql://')):
+            clause = Email.clause('content', 'matches', 'quarterly report')
+
+        compiled = clause.compile(dialect=postgresql.dialect())
+        self.assertRegex(str(compiled), r'^emails.content_tsv @@ plainto_tsquery\(')
+        self.assertEqual(sorted(compiled.params.values()), ['quarterly report', 'simple'])
+
+    def test_tsvector_column_and_index_are_created_on_postgresql(self):
+        statements = []
+        engine = create_mock_engine('postgresql://', lambda sql, *args, **kwargs: statements.append(
+            str(sql.compile(dialect=postgresql.dialect()))))
+        Base.metadata.create_all(engine, tables=[Email.__table__], checkfirst=False)
+        self.assertIn("ALTER TABLE emails ADD COLUMN content_tsv tsvector GENERATED ALWAYS AS "
+                      "(to_tsvector('simple', coalesce(content, ''))) STORED", statements)
+        self.assertIn('CREATE INDEX ix_emails_content_tsv ON emails USING gin (content_tsv)', statements)
+
+    def test_migrations_leave_the_body_index_table_to_sqlite(self):
+        output = io.StringIO()
+        config = Config(output_buffer=output)
+        config.set_main_option('script_location', os.path.join(os.path.dirname(__file__), '..', '..', 'alembic'))
+        config.set_main_option('sqlalchemy.url', 'postgresql://')
+
+        command.upgrade(config, 'head', sql=True)
+
+        self.assertIn('CREATE INDEX CONCURRENTLY ix_emails_content_tsv', output.getvalue())
+        self.assertNotIn('email_terms', output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+"""
+action_executor.py
+
+This module contains the executors the rule engines hand their label changes to, and the drain of the
+outbox.
+
+Classes:
+    DirectExecutor: Sends label changes to Gmail right away.
+    OutboxExecutor: Stores label changes in the outbox table, for an OutboxDrain to send later.
+    OutboxDrain: Sends the pending label changes of the outbox under a budget of calls per second.
+
+"""
+
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from googleapiclient.errors import HttpError
+
+from email_manager.email_manager import EmailManager, ModifyResult
+from instrumentation import metrics
+from logger import logger
+from models.action_outbox import OutboxEntry
+
+
+class DirectExecutor:
+    """
+    Sends label changes to Gmail as they are planned, with one messages.batchModify call per delta
+    and 1,000 emails. Changes whose call failed are lost unless the caller records them.
+
+    Attributes:
+        email_manager (EmailManager): Sends the batchModify calls.
+    """
+
+    def __init__(self, email_manager):
+        self.email_manager = email_manager
+
+    def execute(self, changes):
+        """
+        Applies the given label changes.
+
+        Args:
+            changes (dict): The label IDs to add and to remove, mapped to the message IDs getting them.
+
+        Returns:
+            list: A ModifyResult per batchModify call, with the message IDs it covered and its error, if any.
+        """
+        results = []
+        for (add_label_ids, remove_label_ids), msg_ids in changes.items():
+            results.extend(self.email_manager.batch_modify(msg_ids, add_label_ids=list(add_label_ids),
+                                                           remove_label_ids=list(remove_label_ids)))
+        return results
+
+
+class OutboxExecutor:
+    """
+    Stores label changes in the `action_outbox` table instead of sending them, so that evaluating
+    rules takes no API call at all. The changes are committed before execute returns, and are sent
+    by an OutboxDrain, in this process or another, whatever happens to this one.
+
+    Attributes:
+        account (str): The partition key of the mailbox the changes are for, or None.
+    """
+
+    def __init__(self, account=None):
+        self.account = account
+
+    def execute(self, changes):
+        """
+        Enqueues the given label changes.
+
+        Args:
+            changes (dict): The label IDs to add and to remove, mapped to the message IDs getting them.
+
+        Returns:
+            list: A ModifyResult without error per delta, as every change is now bound to be sent.
+        """
+        changes = dict((delta, list(msg_ids)) for delta, msg_ids in changes.items() if msg_ids)
+        count = OutboxEntry.enqueue(changes, account=self.account)
+        metrics.increment('outbox_enqueued_total', count)
+        logger.info(f"Enqueued label changes for {count} emails")
+        return [ModifyResult(msg_ids, None) for msg_ids in changes.values()]
+
+
+class OutboxDrain:
+    """
+    Sends the label changes pending in the outbox. The changes enqueued for the same email are first
+    coalesced into one delta, applied in the order they were enqueued, so that a label added and then
+    removed again is only removed. Emails with the same delta are sent together, 1,000 per
+    messages.batchModify call, and no more than `qps` calls are made per second.
+
+    An entry is marked done once its call succeeded. A call failing with 429 or 5xx is retried after
+    `backoff` seconds, doubled on every attempt up to `max_backoff`; other errors, or `max_attempts`
+    failures, mark its entries failed. As the entries are only marked after the call, a crash in
+    between sends them again, which label changes make harmless.
+
+    When an entry of an email is due, every pending entry of that email is sent with it, including the
+    earlier ones waiting for their retry, so that the changes of an email are never applied out of
+    order. Only one drain should run per account at a time.
+
+    Attributes:
+        email_manager (EmailManager): Sends the batchModify calls.
+        qps (float): The number of batchModify calls made per second at most.
+        max_attempts (int): The number of calls after which an entry is given up on.
+        backoff (float): The delay in seconds before a failed entry is retried, doubled on every attempt.
+        max_backoff (float): The longest delay between two attempts.
+        account (str): The partition key of the mailbox whose entries are sent, or None.
+        batch_rows (int): The number of pending entries loaded at a time.
+    """
+
+    RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
+    # Gmail allows 250 quota units per user per second, and batchModify costs 50
+    DEFAULT_QPS = 4
+
+    def __init__(self, email_manager, qps=DEFAULT_QPS, max_attempts=8, backoff=1.0, max_backoff=300.0,
+                 account=None, batch_rows=10000):
+        if qps <= 0:
+            raise ValueError(f"qps must be positive, got {qps}")
+        self.email_manager = email_manager
+        self.qps = qps
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.account = account
+        self.batch_rows = batch_rows
+        self._next_call = 0.0
+
+    def drain(self, wait=True):
+        """
+        Sends every pending entry whose attempt is due, until none is left.
+
+        Args:
+            wait (bool): Whether to wait for the entries being retried later, rather than leave them
+                pending for the next drain.
+
+        Returns:
+            dict: The number of entries marked done, failed and retried.
+        """
+        counts = {'done': 0, 'failed': 0, 'retried': 0}
+        while True:
+            due = OutboxEntry.due(self.account, datetime.now(), self.batch_rows)
+            if not due:
+                next_attempt_at = OutboxEntry.earliest_attempt_at(self.account)
+                if next_attempt_at is None or not wait:
+                    break
+                time.sleep(max(0.0, (next_attempt_at - datetime.now()).total_seconds()))
+                continue
+            entries = OutboxEntry.pending_for(self.account, (entry.msg_id for entry in due))
+            for outcome, count in self._send(entries).items():
+                counts[outcome] += count
+        logger.info(f"Drained the outbox: {counts['done']} entries done, {counts['failed']} failed, "
+                    f"{counts['retried']} retried")
+        return counts
+
+    @staticmethod
+    def coalesce(entries):
+        """
+        Merges the entries of each email into one delta, in the order they were enqueued.
+
+        Returns:
+            dict: The sorted tuples of label IDs to add and to remove, mapped to the message IDs getting them.
+        """
+        adds, removes = defaultdict(set), defaultdict(set)
+        for entry in sorted(entries, key=lambda entry: entry.id):
+            add_label_ids, remove_label_ids = entry.label_changes()
+            adds[entry.msg_id].difference_update(remove_label_ids)
+            adds[entry.msg_id].update(add_label_ids)
+            removes[entry.msg_id].difference_update(add_label_ids)
+            removes[entry.msg_id].update(remove_label_ids)
+
+        changes = defaultdict(list)
+        for msg_id in sorted(adds):
+            changes[(tuple(sorted(adds[msg_id])), tuple(sorted(removes[msg_id])))].append(msg_id)
+        return dict(changes)
+
+    def _send(self, entries):
+        counts = {'done': 0, 'failed': 0, 'retried': 0}
+        attempts, entry_ids = {}, defaultdict(list)
+        for entry in entries:
+            attempts[entry.id] = entry.attempts
+            entry_ids[entry.msg_id].append(entry.id)
+
+        for (add_label_ids, remove_label_ids), msg_ids in self.coalesce(entries).items():
+            for start in range(0, len(msg_ids), EmailManager.BATCH_MODIFY_LIMIT):
+                chunk = msg_ids[start:start + EmailManager.BATCH_MODIFY_LIMIT]
+                ids = [entry_id for msg_id in chunk for entry_id in entry_ids[msg_id]]
+                if add_label_ids or remove_label_ids:
+                    self._pace()
+                    results = self.email_manager.batch_modify(chunk, add_label_ids=list(add_label_ids),
+                                                              remove_label_ids=list(remove_label_ids))
+                    error = next((result.error for result in results if result.error is not None), None)
+                else:
+                    # the changes cancelled out, there is nothing to send
+                    error = None
+                outcome = self._settle(ids, error, attempts)
+                counts[outcome] += len(ids)
+                metrics.increment(f'outbox_{outcome}_total', len(ids))
+        return counts
+
+    def _settle(self, ids, error, attempts):
+        now = datetime.now()
+        if error is None:
+            OutboxEntry.mark_done(ids, now)
+            return 'done'
+        attempt = max(attempts[entry_id] for entry_id in ids) + 1
+        if (isinstance(error, HttpError) and error.status_code in self.RETRIABLE_STATUSES
+                and attempt < self.max_attempts):
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            logger.warning(f"Retrying the label changes of {len(ids)} entries in {delay:.1f}s: {error}")
+            OutboxEntry.mark_retry(ids, error, now + timedelta(seconds=delay))
+            return 'retried'
+        logger.error(f"Giving up on the label changes of {len(ids)} entries after {attempt} attempts: {error}")
+        OutboxEntry.mark_failed(ids, error, now)
+        return 'failed'
+
+    def _pace(self):
+        # spaces the calls 1 / qps seconds apart
+        now = time.monotonic()
+        if self._next_call > now:
+            time.sleep(self._next_call - now)
+        self._next_call = max(now, self._next_call) + 1 / self.qps
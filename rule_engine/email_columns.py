@@ -0,0 +1,200 @@
+"""
+email_columns.py
+
+This module contains the EmailColumns class, an in-memory columnar copy of the emails table that
+rules can be evaluated against without querying the database.
+
+Classes:
+    EmailColumns: Holds the rule columns of the emails as NumPy arrays and evaluates predicates on them.
+
+"""
+
+import re
+
+import numpy as np
+
+from logger import logger
+from models.email import Email, body_terms, session
+
+
+class EmailColumns:
+    """
+    Holds the columns rules can match on as NumPy arrays, one entry per email, so that a rule is
+    evaluated with a few vectorized operations over all the emails instead of a database query.
+    Load it once and evaluate any number of rule files against it, e.g. for backfills and dry runs.
+
+    String columns are dictionary encoded: every distinct value is stored once, and each email holds
+    the code of its value. A predicate is evaluated on the distinct values only, and the result is
+    spread to the emails by indexing with the codes. Senders and recipients repeat a lot in a mailbox,
+    so this does far less work than evaluating every email. `contains` scans all the distinct values
+    at once, joined into a single string. `matches` looks the words up in an inverted index of the
+    distinct values, word to values, built the first time a column is searched.
+
+    Predicates mirror Email.clause, and an email whose column is NULL matches no predicate on that
+    column. Whether `contains` is case-sensitive depends on the database, as it is a LIKE in SQL:
+    PostgreSQL's LIKE is, while SQLite's ignores the case of ASCII letters. `load` follows the database
+    it reads from.
+
+    Attributes:
+        msg_ids (numpy.ndarray): The message IDs of the emails.
+        dates (dict): The date columns by name, as datetime64 arrays with NaT for NULL.
+        values (dict): The distinct values of each string column, as object arrays.
+        codes (dict): The index into values of each email's value, per string column; -1 for NULL.
+        case_sensitive (bool): Whether `contains` is case-sensitive; if not, it ignores the case of ASCII letters.
+    """
+
+    DATE_COLUMNS = {'date_received', 'synced_at'}
+    # joins the distinct values of a column for contains, so it cannot occur in a rule value
+    SEPARATOR = '\x00'
+
+    def __init__(self, msg_ids, columns, case_sensitive=True):
+        """
+        Initializes the EmailColumns from lists of values.
+
+        Args:
+            msg_ids (list): The message IDs of the emails.
+            columns (dict): The values of each column by name, in the order of msg_ids; None for NULL.
+            case_sensitive (bool): Whether `contains` is case-sensitive, like PostgreSQL's LIKE, or ignores
+                the case of ASCII letters, like SQLite's.
+        """
+        self.msg_ids = np.array(msg_ids, dtype=object)
+        self.case_sensitive = case_sensitive
+        self.dates = {}
+        self.values = {}
+        self.codes = {}
+        self._texts = {}
+        self._postings = {}
+        for name, values in columns.items():
+            if name in self.DATE_COLUMNS:
+                # None becomes NaT, which compares false with everything, like NULL
+                self.dates[name] = np.array(values, dtype='datetime64[us]')
+            else:
+                self.values[name], self.codes[name] = self._encode(values)
+
+    def __len__(self):
+        return len(self.msg_ids)
+
+    @classmethod
+    def load(cls, columns=('sender', 'subject', 'recipient', 'cc', 'date_received', 'synced_at'), yield_per=10000,
+             criterion=None, case_sensitive=None):
+        """
+        Loads the given columns of every email from the database in one query.
+
+        Args:
+            columns (iterable): The names of the Email columns to load.
+            yield_per (int): The number of rows fetched from the database at a time.
+            criterion: A condition restricting the emails loaded, e.g. to one account, or None for all of them.
+            case_sensitive (bool): Whether `contains` is case-sensitive, or None to match the LIKE of the
+                database: case-insensitive on SQLite, unless PRAGMA case_sensitive_like is set, which
+                cannot be detected, and case-sensitive elsewhere.
+
+        Returns:
+            EmailColumns: The loaded columns.
+        """
+        columns = list(columns)
+        query = session.query(Email.msg_id, *(getattr(Email, name) for name in columns)).yield_per(yield_per)
+        if criterion is not None:
+            query = query.filter(criterion)
+        values = dict((name, []) for name in ['msg_id'] + columns)
+        for row in query:
+            for name, value in zip(values, row):
+                values[name].append(value)
+        msg_ids = values.pop('msg_id')
+        logger.info(f"Loaded {len(msg_ids)} emails into memory, columns: {columns}")
+        if case_sensitive is None:
+            case_sensitive = session.get_bind().dialect.name != 'sqlite'
+        return cls(msg_ids, values, case_sensitive=case_sensitive)
+
+    def mask(self, key, op, value):
+        """
+        Evaluates a predicate on every email, like Email.clause does in SQL.
+
+        Returns:
+            numpy.ndarray: A boolean array, True for the emails matching the predicate.
+        """
+        if key in self.dates:
+            return self._compare(self.dates[key], op, np.datetime64(value, 'us'))
+
+        values, codes = self.values[key], self.codes[key]
+        if op == 'contains':
+            matches = self._contains(key, str(value))
+        elif op == 'matches':
+            matches = self._matches(key, str(value))
+        else:
+            matches = self._compare(values, op, value)
+        if not len(values):
+            # every email is NULL, which no predicate matches
+            return np.zeros(len(codes), dtype=bool)
+        # codes of NULL are -1, which index the last value; those emails are masked out below
+        return matches[codes] & (codes >= 0)
+
+    def select(self, mask):
+        """
+        Returns the message IDs of the emails selected by the boolean mask.
+        """
+        return self.msg_ids[mask].tolist()
+
+    @staticmethod
+    def _compare(column, op, value):
+        if op == 'not':
+            return column != value
+        elif op == 'lt':
+            return column > value
+        elif op == 'gt':
+            return column < value
+        raise ValueError(f"Unknown predicate: {op}")
+
+    @staticmethod
+    def _encode(values):
+        index = {None: -1}
+        codes = np.fromiter((index.setdefault(value, len(index) - 1) for value in values), dtype=np.int32,
+                            count=len(values))
+        del index[None]
+        distinct = np.empty(len(index), dtype=object)
+        distinct[:] = list(index)
+        return distinct, codes
+
+    def _contains(self, key, value):
+        values = self.values[key]
+        matches = np.zeros(len(values), dtype=bool)
+        if not len(values):
+            return matches
+        if key not in self._texts:
+            lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values)) + len(self.SEPARATOR)
+            self._texts[key] = self.SEPARATOR.join(values), np.cumsum(lengths) - lengths
+        text, starts = self._texts[key]
+
+        if '%' in value or '_' in value:
+            # the SQL path passes the value to LIKE as is, where % and _ are wildcards, so they have to be here too
+            wildcard = f'[^{self.SEPARATOR}]'
+            pattern = f'{wildcard}*'.join(wildcard.join(map(re.escape, part.split('_'))) for part in value.split('%'))
+        else:
+            pattern = re.escape(value)
+        # SQLite's LIKE folds ASCII letters only, which is what IGNORECASE does with ASCII
+        flags = 0 if self.case_sensitive else re.IGNORECASE | re.ASCII
+        positions = np.fromiter((match.start() for match in re.finditer(pattern, text, flags)), dtype=np.int64)
+        matches[np.searchsorted(starts, positions, side='right') - 1] = True
+        return matches
+
+    def _matches(self, key, value):
+        values = self.values[key]
+        matches = np.zeros(len(values), dtype=bool)
+        terms = body_terms(value)
+        if not terms:
+            return matches
+        if key not in self._postings:
+            postings = {}
+            for code, text in enumerate(values):
+                for term in body_terms(text):
+                    postings.setdefault(term, []).append(code)
+            self._postings[key] = dict((term, np.array(codes, dtype=np.int32)) for term, codes in postings.items())
+        postings = self._postings[key]
+
+        # intersected from the rarest word up, which keeps the intermediate results small
+        codes = None
+        for term in sorted(terms, key=lambda term: len(postings.get(term, ()))):
+            if term not in postings:
+                return matches
+            codes = postings[term] if codes is None else np.intersect1d(codes, postings[term], assume_unique=True)
+        matches[codes] = True
+        return matches
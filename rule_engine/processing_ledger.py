@@ -0,0 +1,152 @@
+"""
+processing_ledger.py
+
+This module contains the ProcessingLedger class which lets rule files be evaluated incrementally.
+
+Classes:
+    ProcessingLedger: Tracks what each rule set has evaluated and applied, so that runs only process new mail.
+
+"""
+
+import hashlib
+from datetime import datetime
+
+from sqlalchemy import and_, func, or_
+
+from logger import logger
+from models.email import Email, session
+from models.processing_ledger import AppliedAction, RuleSetRun
+
+
+class ProcessingLedger:
+    """
+    Tracks, per rule set, the synced_at watermark up to which emails have been evaluated and the emails
+    its actions were applied to. Rule sets are identified by RuleEngine.rule_set_hash, so editing a rule
+    file starts it afresh: everything is evaluated again and its actions are applied again.
+
+    A run only evaluates the emails synced since the watermark, plus, for rules like "older than 2 days",
+    the emails that became old enough since the last run. Emails the rule set was already applied to are
+    skipped. The watermark only moves forward when all the actions of the run succeeded, so failed
+    emails are evaluated again by the next run.
+
+    With an account, the watermarks and applied actions are kept apart from those of the same rule
+    files applied to other mailboxes.
+
+    Attributes:
+        full (bool): Whether to evaluate all the emails regardless of the watermarks.
+        account (str): The partition key of the mailbox the rules apply to, or None.
+    """
+
+    def __init__(self, full=False, account=None):
+        self.full = full
+        self.account = account
+        self.started_at = None
+        self.high_watermark = None
+        self._runs = {}
+
+    def start(self, rule_engines):
+        """
+        Starts a run of the given rule engines, reading their watermarks.
+        """
+        self.started_at = datetime.now()
+        # emails synced while the run is going on are evaluated again next time, which the ledger makes harmless
+        query = session.query(func.max(Email.synced_at))
+        if self.account is not None:
+            query = query.filter(Email.account == self.account)
+        self.high_watermark = query.scalar()
+        self._runs = dict((self.key(rule_engine), None) for rule_engine in rule_engines)
+        if not self.full:
+            for rule_set_hash in self._runs:
+                self._runs[rule_set_hash] = RuleSetRun.get(rule_set_hash)
+
+    def window_clause(self, rule_engine):
+        """
+        Builds the SQL condition selecting the emails the rule engine has to evaluate in this run.
+
+        Returns:
+            The condition, or None if every email has to be evaluated.
+        """
+        run = self._run(rule_engine)
+        if run is None:
+            return None
+        clauses = [Email.synced_at > run.watermark]
+        for rule in rule_engine.rules:
+            if rule.ages_into_match():
+                (_, _, now), (_, _, before) = rule.get_constituents(self.started_at), rule.get_constituents(run.last_run_at)
+                clauses.append(and_(Email.date_received < now, Email.date_received >= before))
+        return or_(*clauses)
+
+    def window_mask(self, rule_engine, email_columns):
+        """
+        Selects the emails the rule engine has to evaluate in this run, among emails held in memory.
+
+        Returns:
+            numpy.ndarray: A boolean array, or None if every email has to be evaluated.
+        """
+        run = self._run(rule_engine)
+        if run is None:
+            return None
+        mask = email_columns.mask('synced_at', 'lt', run.watermark)
+        for rule in rule_engine.rules:
+            if rule.ages_into_match():
+                (_, _, now), (_, _, before) = rule.get_constituents(self.started_at), rule.get_constituents(run.last_run_at)
+                mask |= email_columns.mask('date_received', 'gt', now) & ~email_columns.mask('date_received', 'gt', before)
+        return mask
+
+    def pending(self, rule_engine, msg_ids):
+        """
+        Drops the emails the rule engine's actions were already applied to.
+
+        Returns:
+            set: The message IDs still to apply the actions to.
+        """
+        msg_ids = set(msg_ids)
+        applied = AppliedAction.applied_ids(self.key(rule_engine), msg_ids)
+        if applied:
+            logger.info(f"{rule_engine.rules_file_path}: skipping {len(applied)} emails already processed")
+        return msg_ids - applied
+
+    def finish(self, rule_engine, applied_ids, failed_ids=()):
+        """
+        Records the emails the rule engine's actions were applied to and, unless some failed, moves its
+        watermark up to the emails evaluated in this run.
+
+        Args:
+            rule_engine (RuleEngine): The rule engine of the run.
+            applied_ids (iterable): The message IDs the actions were applied to.
+            failed_ids (iterable): The message IDs the actions could not be applied to.
+        """
+        rule_set_hash = self.key(rule_engine)
+        actions = [{'action_name': action.action_name, 'action_value': action.action_value}
+                   for action in rule_engine.actions]
+        recorded = AppliedAction.record(rule_set_hash, applied_ids, actions, self.started_at)
+
+        run = RuleSetRun.get(rule_set_hash) or RuleSetRun(rule_set_hash=rule_set_hash)
+        run.rules_file_path = rule_engine.rules_file_path
+        failed_ids = set(failed_ids)
+        if failed_ids:
+            logger.error(f"{rule_engine.rules_file_path}: {len(failed_ids)} emails failed, keeping the watermark "
+                         f"at {run.watermark} so that they are evaluated again")
+        else:
+            run.watermark = self.high_watermark or run.watermark
+            run.last_run_at = self.started_at
+        if run.last_run_at is None:
+            run.last_run_at = self.started_at
+        run.save()
+        logger.info(f"{rule_engine.rules_file_path}: recorded {recorded} processed emails, watermark {run.watermark}")
+
+    def key(self, rule_engine):
+        """
+        The key the rule engine's runs and applied actions are recorded under: its rule set hash, or a
+        hash of the account and the rule set hash when there is an account.
+        """
+        rule_set_hash = rule_engine.rule_set_hash()
+        if self.account is None:
+            return rule_set_hash
+        return hashlib.sha256(f'{self.account}\n{rule_set_hash}'.encode()).hexdigest()
+
+    def _run(self, rule_engine):
+        run = self._runs.get(self.key(rule_engine))
+        if run is None or run.watermark is None:
+            return None
+        return run
@@ -10,14 +10,18 @@ Classes:
 
 """
 
-import itertools
+import hashlib
 import json
 from datetime import datetime, timedelta
 
+import numpy as np
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import and_, or_
 
-from logger import logger
+from instrumentation import metrics
+from logger import debug_sampled, logger
 from models.email import Email
+from rule_engine.action_executor import DirectExecutor
 
 
 class Rule:
@@ -37,6 +41,7 @@ class Rule:
         'to': 'recipient',
         'cc': 'cc',
         'date_received': 'date_received',
+        'body': 'content',
     }
 
     def __init__(self, field_name, predicate, value):
@@ -44,20 +49,51 @@ class Rule:
         self.predicate = predicate
         self.value = value
 
-    def get_constituents(self):
+    def get_constituents(self, now=None):
         field_name = self.FIELD_NAME_COLUMN_MAPPING[self.field_name]
         predicate = self.predicate
         value = self.value
+        # relative dates like 2d are counted back from now, which can be pinned to evaluate the rule at another time
+        now = now or datetime.now()
 
         if field_name == 'date_received' and 'd' in self.value:
             days = int(self.value.replace('d', ''))
-            value = datetime.now() - timedelta(days=days)
+            value = now - timedelta(days=days)
         elif field_name == 'date_received' and 'm' in self.value:
             months = int(self.value.replace('m', ''))
-            value = datetime.now() - relativedelta(months=months)
+            value = now - relativedelta(months=months)
 
         return field_name, predicate, value
 
+    def to_clause(self):
+        """
+        Builds the SQL condition an email has to meet to satisfy the rule.
+        """
+        field_name, predicate, value = self.get_constituents()
+        return Email.clause(field_name, predicate, value)
+
+    def ages_into_match(self):
+        """
+        Whether emails can start to satisfy the rule just by getting older, without changing. That is
+        the case for a relative date_received rule with gt, e.g. older than 2 days.
+        """
+        field_name, predicate, value = self.get_constituents()
+        return field_name == 'date_received' and predicate == 'gt' and value != self.value
+
+    def to_mask(self, email_columns):
+        """
+        Evaluates the rule on all the emails held in memory.
+
+        Args:
+            email_columns (EmailColumns): The emails to evaluate the rule on.
+
+        Returns:
+            numpy.ndarray: A boolean array, True for the emails satisfying the rule.
+        """
+        field_name, predicate, value = self.get_constituents()
+        with metrics.timer('rule_clause_seconds', field=field_name, predicate=predicate):
+            return email_columns.mask(field_name, predicate, value)
+
 
 class Action:
     """
@@ -72,13 +108,37 @@ class Action:
         self.action_name = action_name
         self.action_value = action_value
 
+    def label_changes(self, email_manager):
+        """
+        Translates the action into the labels it adds and removes.
+
+        Args:
+            email_manager (EmailManager): Used to resolve label names to IDs.
+
+        Returns:
+            tuple: The sets of label IDs to add and to remove.
+        """
+        if self.action_name == 'mark_as_read':
+            return set(), {'UNREAD'}
+        elif self.action_name == 'move_to_label':
+            label_id = email_manager.get_label_id(self.action_value)
+            if label_id is None:
+                logger.error(f"Label {self.action_value} does not exist, skipping action: {self.action_name}")
+                return set(), set()
+            return {label_id}, set()
+        logger.error(f"Unknown action: {self.action_name}")
+        return set(), set()
+
     def perform(self, msg_id, email_manager):
         if self.action_name == 'mark_as_read':
-            logger.info(f"Marking email as read: {msg_id}")
+            debug_sampled('mark_as_read', "Marking email as read: %s", msg_id)
             email_manager.mark_as_read(msg_id)
         elif self.action_name == 'move_to_label':
-            logger.info(f"Moving email to label: {msg_id}")
+            debug_sampled('move_to_label', "Moving email to label: %s", msg_id)
             email_manager.move_to_label(msg_id, self.action_value)
+        else:
+            return
+        metrics.increment('rule_actions_sent_total', action=self.action_name)
 
 
 class RuleEngine:
@@ -90,6 +150,7 @@ class RuleEngine:
     """
 
     def __init__(self, rules_file_path):
+        self.rules_file_path = rules_file_path
         self.collection_predicate = None
         self.rules = []
         self.actions = []
@@ -105,27 +166,113 @@ class RuleEngine:
         self.collection_predicate = data.get('collection_predicate')
         logger.info(f"successfully parsed rules from file: {file_path}")
 
-    def filter(self):
-        for rule in self.rules:
-            field_name, predicate, value = rule.get_constituents()
-            email_msg_ids = Email.filter(**{field_name: {predicate: value}}).all()
-            email_msg_ids = list(itertools.chain(*email_msg_ids)) if email_msg_ids else email_msg_ids
-            # if collection_predicate is all, then we need to take intersection of all the filtered email ids
-            # if collection_predicate is any, then we need to take union of all the filtered email ids
-            logger.info(f"field_name: {field_name}, predicate: {predicate}, value: {value}  Filtered email ids: {email_msg_ids}")
-            # Initialize self.filtered_email_ids if it's None
-            if self.filtered_email_ids is None:
-                self.filtered_email_ids = set(email_msg_ids)
+    def rule_set_hash(self):
+        """
+        Hashes the rules, the collection predicate and the actions, so that any change to the rule file
+        that could change what it does gives a different hash.
+        """
+        rule_set = {
+            'collection_predicate': self.collection_predicate,
+            'rules': [[rule.field_name, rule.predicate, rule.value] for rule in self.rules],
+            'actions': [[action.action_name, action.action_value] for action in self.actions],
+        }
+        return hashlib.sha256(json.dumps(rule_set, sort_keys=True).encode()).hexdigest()
+
+    def needs_content(self):
+        """
+        Whether any rule looks at the email content, in which case a sync has to download the bodies.
+        """
+        return any(Rule.FIELD_NAME_COLUMN_MAPPING[rule.field_name] == 'content' for rule in self.rules)
+
+    def compile(self):
+        """
+        Compiles all the rules into one SQL condition, combined according to collection_predicate:
+        'all' requires every rule to match, anything else requires at least one.
+        """
+        clauses = [rule.to_clause() for rule in self.rules]
+        return and_(*clauses) if self.collection_predicate == 'all' else or_(*clauses)
+
+    def matching_ids(self, yield_per=1000):
+        """
+        Runs the compiled rules as a single query and streams the matching message IDs.
+
+        Yields:
+            str: The message ID of each matching email.
+        """
+        if not self.rules:
+            return
+        criterion = self.compile()
+        logger.info(f"Filtering emails with: {criterion}")
+        yield from Email.iter_msg_ids(criterion, yield_per=yield_per)
+
+    def evaluate(self, email_columns):
+        """
+        Evaluates the rules on emails held in memory, combining the rule masks according to
+        collection_predicate like compile does. Gives the same emails as matching_ids without
+        querying the database.
+
+        Args:
+            email_columns (EmailColumns): The emails to evaluate the rules on.
+
+        Returns:
+            list: The message IDs of the matching emails.
+        """
+        if not self.rules:
+            return []
+        combine = np.logical_and if self.collection_predicate == 'all' else np.logical_or
+        mask = combine.reduce([rule.to_mask(email_columns) for rule in self.rules])
+        return email_columns.select(mask)
+
+    def filter(self, email_columns=None):
+        """
+        Finds the emails the rules apply to, in the database or, when given, in the in-memory email_columns.
+        """
+        with metrics.timer('rule_filter_seconds', rules_file=self.rules_file_path):
+            if email_columns is None:
+                self.filtered_email_ids = set(self.matching_ids())
             else:
-                # Perform the appropriate operation based on self.collection_predicate
-                if self.collection_predicate == 'all':
-                    self.filtered_email_ids &= set(email_msg_ids)  # Intersection operation
-                else:
-                    self.filtered_email_ids |= set(email_msg_ids)  # Union operation
+                self.filtered_email_ids = set(self.evaluate(email_columns))
+        logger.info(f"Filtered {len(self.filtered_email_ids)} emails")
         return self
 
-    def perform_action(self, email_manager):
-        for msg_id in self.filtered_email_ids:
-            for action in self.actions:
-                logger.info(f"Performing action: {action.action_name} on email: {msg_id}")
-                action.perform(msg_id, email_manager)
+    def plan_label_changes(self, email_manager):
+        """
+        Merges the label changes of all the actions into one delta.
+
+        Returns:
+            tuple: The sorted lists of label IDs to add and to remove.
+        """
+        add_label_ids, remove_label_ids = set(), set()
+        for action in self.actions:
+            add, remove = action.label_changes(email_manager)
+            add_label_ids |= add
+            remove_label_ids |= remove
+        return sorted(add_label_ids), sorted(remove_label_ids)
+
+    def perform_action(self, email_manager, executor=None):
+        """
+        Applies the actions to all the filtered emails. The actions are merged into one label delta,
+        which the executor sends with messages.batchModify, up to 1,000 emails per call, or enqueues
+        to the outbox.
+
+        Args:
+            email_manager (EmailManager): Used to resolve label names to IDs, and to send the changes
+                when no executor is given.
+            executor: A DirectExecutor or OutboxExecutor, by default a DirectExecutor of email_manager.
+
+        Returns:
+            list: A ModifyResult per batchModify call, with the message IDs it covered and its error, if any.
+        """
+        msg_ids = sorted(self.filtered_email_ids or [])
+        add_label_ids, remove_label_ids = self.plan_label_changes(email_manager)
+        if not msg_ids or not (add_label_ids or remove_label_ids):
+            return []
+
+        logger.info(f"Performing actions: {[action.action_name for action in self.actions]} on {len(msg_ids)} emails")
+        executor = executor or DirectExecutor(email_manager)
+        results = executor.execute({(tuple(add_label_ids), tuple(remove_label_ids)): msg_ids})
+        failed = sum(len(result.msg_ids) for result in results if result.error is not None)
+        logger.info(f"Modified {len(msg_ids) - failed} emails in {len(results)} calls, {failed} failed")
+        for action in self.actions:
+            metrics.increment('rule_actions_sent_total', len(msg_ids) - failed, action=action.action_name)
+        return results
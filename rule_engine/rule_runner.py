@@ -0,0 +1,293 @@
+"""
+rule_runner.py
+
+This module contains the RuleRunner class which applies several rule files after a single sync.
+
+Classes:
+    RuleRunner: Evaluates many rule files in one pass over the emails and applies their merged actions.
+
+"""
+
+import asyncio
+import glob
+import os.path
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import and_, or_
+
+from instrumentation import metrics
+from logger import logger
+from models.email import Email
+from rule_engine.action_executor import DirectExecutor
+from rule_engine.rule_engine import RuleEngine
+
+
+class RuleRunner:
+    """
+    Applies several rule files together. The mailbox is synced once, all the rule files are evaluated
+    in a single pass over the emails, and the label changes of every file an email matches are merged
+    into one delta per email before any API call is made.
+
+    A rule appearing in several files, i.e. the same field, predicate and value, is evaluated only once.
+    When files disagree on a label, the file loaded last wins, as if the files had been applied one
+    after another.
+
+    With a ProcessingLedger, each rule file only evaluates the emails that are new to it and skips the
+    emails its actions were already applied to, so that a run costs in proportion to the new mail.
+
+    When several mailboxes share the database, `account` restricts the rules to the emails of one of
+    them; the EmailColumns given to `filter` must then hold only that account's emails.
+
+    Attributes:
+        rule_engines (list): The RuleEngine of each rule file, in the order they are applied.
+        ledger (ProcessingLedger): Tracks what was already processed, or None to process everything.
+        account (str): The partition key of the mailbox the rules apply to, or None for every email.
+    """
+
+    def __init__(self, rule_engines, ledger=None, account=None):
+        self.rule_engines = list(rule_engines)
+        self.ledger = ledger
+        self.account = account
+
+    @classmethod
+    def from_directory(cls, rules_dir, pattern='*.json', ledger=None, account=None):
+        """
+        Loads every rule file of the directory, in file name order.
+
+        Args:
+            rules_dir (str): The directory containing the rule files.
+            pattern (str): The glob pattern the rule files match.
+            ledger (ProcessingLedger): Tracks what was already processed, or None to process everything.
+            account (str): The partition key of the mailbox the rules apply to, or None for every email.
+
+        Returns:
+            RuleRunner: A runner over the loaded rule files.
+        """
+        paths = sorted(glob.glob(os.path.join(rules_dir, pattern)))
+        logger.info(f"Loading {len(paths)} rule files from {rules_dir}")
+        return cls((RuleEngine(path) for path in paths), ledger=ledger, account=account)
+
+    def run(self, email_manager, email_columns=None, executor=None):
+        """
+        Syncs the mailbox once, then filters the emails with every rule file and applies the merged actions
+        with the executor, by default a DirectExecutor. The message bodies are only downloaded when a rule
+        looks at the content; the bodies of the emails synced without them earlier are then downloaded
+        too, as the rules could not match them otherwise.
+
+        Returns:
+            list: A ModifyResult per batchModify call.
+        """
+        bodies = any(rule_engine.needs_content() for rule_engine in self.rule_engines)
+        email_manager.sync_emails(bodies=bodies)
+        if bodies:
+            email_manager.fetch_bodies()
+        self.filter(email_columns)
+        return self.perform_actions(email_manager, executor)
+
+    async def run_async(self, email_manager, email_columns=None, executor=None):
+        """
+        Does what `run` does with an AsyncEmailManager, without blocking its event loop: the syncs and
+        label changes are coroutines of the manager, while the rules are evaluated and the ledger is
+        updated on worker threads. The label names of the actions are resolved before planning.
+
+        Returns:
+            list: A ModifyResult per batchModify call.
+        """
+        bodies = any(rule_engine.needs_content() for rule_engine in self.rule_engines)
+        await email_manager.sync_emails(bodies=bodies)
+        if bodies:
+            await email_manager.fetch_bodies()
+        await asyncio.to_thread(self.filter, email_columns)
+
+        label_ids = {name: await email_manager.get_label_id(name) for name in self._label_names()}
+        changes = self.plan_label_changes(_ResolvedLabels(label_ids))
+        self._log_changes(changes)
+        if executor is not None:
+            results = await asyncio.to_thread(executor.execute, changes)
+        else:
+            results = []
+            for (add_label_ids, remove_label_ids), msg_ids in changes.items():
+                results.extend(await email_manager.batch_modify(msg_ids, add_label_ids=list(add_label_ids),
+                                                                remove_label_ids=list(remove_label_ids)))
+        return await asyncio.to_thread(self._record_results, results)
+
+    def unique_rules(self):
+        """
+        Collects the distinct rules of all the rule files, and where each rule file uses them.
+
+        Returns:
+            tuple: The list of distinct rules, and for each rule engine the indices of its rules in that list.
+        """
+        rules, positions, engine_positions = [], {}, []
+        for rule_engine in self.rule_engines:
+            indices = []
+            for rule in rule_engine.rules:
+                key = (rule.field_name, rule.predicate, rule.value)
+                if key not in positions:
+                    positions[key] = len(rules)
+                    rules.append(rule)
+                indices.append(positions[key])
+            engine_positions.append(indices)
+        return rules, engine_positions
+
+    def filter(self, email_columns=None):
+        """
+        Finds the emails each rule file applies to, with a single query over the database or, when
+        given, a single pass over the in-memory email_columns. Sets filtered_email_ids on every rule engine.
+        """
+        rules, engine_positions = self.unique_rules()
+        total = sum(len(indices) for indices in engine_positions)
+        logger.info(f"Evaluating {len(rules)} distinct rules out of {total} in {len(self.rule_engines)} rule files")
+        for rule_engine in self.rule_engines:
+            rule_engine.filtered_email_ids = set()
+        if self.ledger is not None:
+            self.ledger.start(self.rule_engines)
+        if not rules:
+            return self
+
+        with metrics.timer('rule_filter_seconds', rules_file='*'):
+            if email_columns is None:
+                self._filter_sql(rules, engine_positions)
+            else:
+                self._filter_in_memory(rules, engine_positions, email_columns)
+
+        for rule_engine in self.rule_engines:
+            if self.ledger is not None:
+                rule_engine.filtered_email_ids = self.ledger.pending(rule_engine, rule_engine.filtered_email_ids)
+            logger.info(f"{rule_engine.rules_file_path}: filtered {len(rule_engine.filtered_email_ids)} emails")
+        return self
+
+    def _filter_sql(self, rules, engine_positions):
+        clauses = [rule.to_clause() for rule in rules]
+        criterion = None
+        # the window of each rule engine is selected after the rules, as one more column
+        windows = [None] * len(self.rule_engines)
+        if self.ledger is not None:
+            for position, rule_engine in enumerate(self.rule_engines):
+                window = self.ledger.window_clause(rule_engine)
+                if window is not None and engine_positions[position]:
+                    windows[position] = len(clauses)
+                    clauses.append(window)
+            if all(window is not None for window, indices in zip(windows, engine_positions) if indices):
+                # only the new emails, when no rule engine needs to look at them all
+                criterion = and_(or_(*(clauses[window] for window in windows if window is not None)),
+                                 or_(*clauses[:len(rules)]))
+        if self.account is not None:
+            criterion = and_(Email.account == self.account,
+                             or_(*clauses[:len(rules)]) if criterion is None else criterion)
+        logger.info(f"Filtering emails with {len(clauses)} conditions in one query")
+
+        for msg_id, values in Email.iter_clause_values(clauses, criterion=criterion):
+            for rule_engine, indices, window in zip(self.rule_engines, engine_positions, windows):
+                if not indices or (window is not None and not values[window]):
+                    continue
+                if self._combine(rule_engine, (bool(values[i]) for i in indices)):
+                    rule_engine.filtered_email_ids.add(msg_id)
+
+    def _filter_in_memory(self, rules, engine_positions, email_columns):
+        masks = [rule.to_mask(email_columns) for rule in rules]
+        for rule_engine, indices in zip(self.rule_engines, engine_positions):
+            if not indices:
+                continue
+            combine = np.logical_and if rule_engine.collection_predicate == 'all' else np.logical_or
+            mask = combine.reduce([masks[i] for i in indices])
+            window = self.ledger.window_mask(rule_engine, email_columns) if self.ledger is not None else None
+            if window is not None:
+                mask &= window
+            rule_engine.filtered_email_ids = set(email_columns.select(mask))
+
+    def plan_label_changes(self, email_manager):
+        """
+        Merges the label changes of every rule file into one delta per email.
+
+        Returns:
+            dict: The sorted tuples of label IDs to add and to remove, mapped to the message IDs getting them.
+        """
+        adds, removes = defaultdict(set), defaultdict(set)
+        for rule_engine in self.rule_engines:
+            if not rule_engine.filtered_email_ids:
+                continue
+            add_label_ids, remove_label_ids = rule_engine.plan_label_changes(email_manager)
+            for msg_id in rule_engine.filtered_email_ids:
+                # applied in file order, so a later file undoes what an earlier one did to the same label
+                adds[msg_id].difference_update(remove_label_ids)
+                adds[msg_id].update(add_label_ids)
+                removes[msg_id].difference_update(add_label_ids)
+                removes[msg_id].update(remove_label_ids)
+
+        changes = defaultdict(list)
+        for msg_id in sorted(adds):
+            delta = (tuple(sorted(adds[msg_id])), tuple(sorted(removes[msg_id])))
+            if delta != ((), ()):
+                changes[delta].append(msg_id)
+        return dict(changes)
+
+    def perform_actions(self, email_manager, executor=None):
+        """
+        Applies the merged label changes, with one batchModify call per distinct delta and 1,000 emails,
+        or enqueues them to the outbox with an OutboxExecutor. Enqueued changes count as applied for the
+        ledger, as the outbox sees them through.
+
+        Args:
+            email_manager (EmailManager): Used to resolve label names to IDs, and to send the changes
+                when no executor is given.
+            executor: A DirectExecutor or OutboxExecutor, by default a DirectExecutor of email_manager.
+
+        Returns:
+            list: A ModifyResult per batchModify call, with the message IDs it covered and its error, if any.
+        """
+        changes = self.plan_label_changes(email_manager)
+        self._log_changes(changes)
+        return self._record_results((executor or DirectExecutor(email_manager)).execute(changes))
+
+    def _label_names(self):
+        """
+        Collects the names of the labels the actions of the rule files with filtered emails move emails to.
+        """
+        return sorted(set(action.action_value for rule_engine in self.rule_engines if rule_engine.filtered_email_ids
+                          for action in rule_engine.actions if action.action_name == 'move_to_label'))
+
+    @staticmethod
+    def _log_changes(changes):
+        for (add_label_ids, remove_label_ids), msg_ids in changes.items():
+            logger.info(f"Adding labels {list(add_label_ids)} and removing {list(remove_label_ids)} "
+                        f"on {len(msg_ids)} emails")
+
+    def _record_results(self, results):
+        """
+        Logs and counts the outcome of applying the label changes, and records it in the ledger.
+
+        Returns:
+            list: The results, unchanged.
+        """
+        failed_ids = set(msg_id for result in results if result.error is not None for msg_id in result.msg_ids)
+        logger.info(f"Applied {len(self.rule_engines)} rule files in {len(results)} calls, "
+                    f"{len(failed_ids)} emails failed")
+
+        applied_ids = set(msg_id for result in results if result.error is None for msg_id in result.msg_ids)
+        for rule_engine in self.rule_engines:
+            for action in rule_engine.actions:
+                metrics.increment('rule_actions_sent_total', len(rule_engine.filtered_email_ids & applied_ids),
+                                  action=action.action_name)
+        if self.ledger is not None:
+            for rule_engine in self.rule_engines:
+                self.ledger.finish(rule_engine, rule_engine.filtered_email_ids & applied_ids,
+                                   rule_engine.filtered_email_ids & failed_ids)
+        return results
+
+    @staticmethod
+    def _combine(rule_engine, values):
+        return all(values) if rule_engine.collection_predicate == 'all' else any(values)
+
+
+class _ResolvedLabels:
+    """
+    Stands in for the email manager when planning label changes, with the label IDs looked up beforehand.
+    """
+
+    def __init__(self, label_ids):
+        self.label_ids = label_ids
+
+    def get_label_id(self, label_name):
+        return self.label_ids.get(label_name)
@@ -0,0 +1,100 @@
+import unittest
+from unittest.mock import MagicMock, call, patch
+
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.errors import HttpError
+from sqlalchemy import create_engine
+
+from email_manager.email_manager import EmailManager, ModifyResult
+from email_manager.tests.fake_gmail_server import FakeGmailServer, make_message
+from models.action_outbox import OutboxEntry
+from models.email import Base, session
+from ..action_executor import OutboxDrain, OutboxExecutor
+
+
+class TestActionOutbox(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+        self.email_manager = MagicMock()
+        self.email_manager.batch_modify.side_effect = lambda msg_ids, **kwargs: [ModifyResult(msg_ids, None)]
+
+    def statuses(self):
+        return dict((entry.msg_id, entry.status) for entry in session.query(OutboxEntry))
+
+    def test_executor_enqueues_without_calling_gmail(self):
+        results = OutboxExecutor().execute({(('Label_1',), ('UNREAD',)): ['msg001', 'msg002']})
+
+        self.assertEqual(results, [ModifyResult(['msg001', 'msg002'], None)])
+        self.assertEqual(self.statuses(), {'msg001': 'pending', 'msg002': 'pending'})
+        self.assertEqual(session.query(OutboxEntry).first().label_changes(), (['Label_1'], ['UNREAD']))
+
+    def test_drain_coalesces_the_changes_of_each_email(self):
+        executor = OutboxExecutor()
+        executor.execute({(('Label_1',), ('UNREAD',)): ['msg001', 'msg002']})
+        executor.execute({((), ('Label_1',)): ['msg001']})
+
+        counts = OutboxDrain(self.email_manager, qps=1000).drain()
+
+        self.assertEqual(counts, {'done': 3, 'failed': 0, 'retried': 0})
+        self.assertEqual(self.email_manager.batch_modify.call_args_list, [
+            call(['msg001'], add_label_ids=[], remove_label_ids=['Label_1', 'UNREAD']),
+            call(['msg002'], add_label_ids=['Label_1'], remove_label_ids=['UNREAD']),
+        ])
+        self.assertEqual(set(self.statuses().values()), {'done'})
+
+    def test_drain_sends_changes_waiting_for_a_retry_with_the_later_ones(self):
+        quota_exceeded = HttpError(MagicMock(status=429), b'Quota exceeded')
+        self.email_manager.batch_modify.side_effect = [[ModifyResult(['msg001'], quota_exceeded)],
+                                                       [ModifyResult(['msg001'], None)]]
+        drain = OutboxDrain(self.email_manager, qps=1000, backoff=60)
+        OutboxExecutor().execute({(('Label_1',), ()): ['msg001']})
+        self.assertEqual(drain.drain(wait=False), {'done': 0, 'failed': 0, 'retried': 1})
+
+        # a later run undoes the label before the first change went through
+        OutboxExecutor().execute({((), ('Label_1',)): ['msg001']})
+        counts = drain.drain(wait=False)
+
+        self.assertEqual(counts, {'done': 2, 'failed': 0, 'retried': 0})
+        self.assertEqual(self.email_manager.batch_modify.call_args,
+                         call(['msg001'], add_label_ids=[], remove_label_ids=['Label_1']))
+        self.assertEqual(OutboxEntry.counts(), {'done': 2})
+
+    def test_drain_gives_up_on_client_errors(self):
+        self.email_manager.batch_modify.side_effect = lambda msg_ids, **kwargs: [
+            ModifyResult(msg_ids, HttpError(MagicMock(status=400), b'Invalid label'))]
+        OutboxExecutor().execute({(('Label_9',), ()): ['msg001']})
+
+        counts = OutboxDrain(self.email_manager, qps=1000).drain()
+
+        self.assertEqual(counts, {'done': 0, 'failed': 1, 'retried': 0})
+        entry = session.query(OutboxEntry).one()
+        self.assertEqual((entry.status, entry.attempts), ('failed', 1))
+        self.assertIn('Invalid label', entry.error)
+
+    def test_drain_retries_quota_rejections_until_every_change_is_sent(self):
+        messages = [make_message(f'msg{i:03d}') for i in range(6)]
+        # two batchModify calls, at 50 units each, empty the bucket
+        with FakeGmailServer(messages, quota_units_per_second=100) as server, \
+                patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            email_manager = EmailManager(api_endpoint=server.url)
+            OutboxExecutor().execute({((f'Label_{i}',), ()): [f'msg{i:03d}', f'msg{i + 3:03d}'] for i in range(3)})
+
+            counts = OutboxDrain(email_manager, qps=1000, backoff=0.2).drain()
+
+            self.assertGreater(server.quota_rejections, 0)
+            self.assertEqual(counts['done'], 6)
+            self.assertGreater(counts['retried'], 0)
+            for i in range(6):
+                self.assertIn(f'Label_{i % 3}', server.messages[f'msg{i:03d}']['labelIds'])
+        self.assertEqual(OutboxEntry.counts(), {'done': 6})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+import itertools
+import json
+import random
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import mock_open, patch
+
+from sqlalchemy import create_engine, event
+
+from models.email import Base, Email, EmailTerm, session
+from ..email_columns import EmailColumns
+from ..rule_engine import Rule, RuleEngine
+
+WORDS = ['alert', 'Alert', 'invoice', 'meeting', 'report', 'no-reply', '50%', 'a_b', 'ab', 'youtube']
+
+
+def random_emails(count, seed=0):
+    rng = random.Random(seed)
+    now = datetime.now()
+    for i in range(count):
+        yield Email(
+            msg_id=f'msg{i:04d}',
+            sender=f'{rng.choice(WORDS)}@{rng.choice(["youtube.com", "google.com", "example.com"])}',
+            subject=' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))),
+            recipient=rng.choice(['me@example.com', 'you@example.com']),
+            cc=rng.choice([None, 'team@example.com', 'boss@example.com']),
+            content=' '.join(rng.choice(WORDS + ['Report.', 'INVOICE']) for _ in range(rng.randint(0, 6))),
+            # whole hours plus a few minutes, so that no email sits exactly on a '2d' or '1m' boundary
+            date_received=now - timedelta(hours=rng.randrange(24 * 60), minutes=rng.randint(5, 55)),
+            synced_at=now,
+        )
+
+
+class TestEmailColumns(unittest.TestCase):
+    RULES = [
+        Rule('subject', 'contains', 'alert'),
+        Rule('subject', 'contains', 'Alert'),
+        Rule('subject', 'contains', '50%'),
+        Rule('subject', 'contains', 'a_b'),
+        Rule('from', 'contains', 'youtube.com'),
+        Rule('from', 'not', 'alert@google.com'),
+        Rule('to', 'not', 'me@example.com'),
+        Rule('cc', 'contains', 'team'),
+        Rule('cc', 'not', 'boss@example.com'),
+        Rule('subject', 'lt', 'm'),
+        Rule('subject', 'gt', 'm'),
+        Rule('date_received', 'lt', '2d'),
+        Rule('date_received', 'gt', '2d'),
+        Rule('date_received', 'lt', '1m'),
+        Rule('date_received', 'gt', '1m'),
+        Rule('body', 'matches', 'invoice'),
+        Rule('body', 'matches', 'meeting REPORT'),
+        Rule('body', 'matches', 'no-reply'),
+        Rule('body', 'matches', 'absent'),
+        Rule('body', 'contains', 'invoice'),
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_engine('sqlite://')
+        # SQLite's LIKE ignores case by default, PostgreSQL's does not; these tests hold both to PostgreSQL's
+        event.listen(cls.engine, 'connect',
+                     lambda conn, record: conn.execute('PRAGMA case_sensitive_like = ON'))
+        Base.metadata.create_all(cls.engine)
+
+    def setUp(self):
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', self.engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+        if session.query(Email).count() == 0:
+            emails = list(random_emails(500))
+            session.add_all(emails)
+            # the body index is kept by bulk_upsert, which these inserts bypass
+            EmailTerm.index(dict((('', email.msg_id), email.content) for email in emails))
+            session.commit()
+        self.email_columns = EmailColumns.load(columns=('sender', 'subject', 'recipient', 'cc', 'content',
+                                                        'date_received', 'synced_at'), case_sensitive=True)
+        with patch('builtins.open', mock_open(read_data=json.dumps({'rules': [], 'actions': []}))):
+            self.rule_engine = RuleEngine('rules.json')
+
+    def assert_parity(self, rules, collection_predicate):
+        self.rule_engine.rules = list(rules)
+        self.rule_engine.collection_predicate = collection_predicate
+
+        in_memory = self.rule_engine.evaluate(self.email_columns)
+
+        self.assertEqual(len(in_memory), len(set(in_memory)))
+        self.assertEqual(set(in_memory), set(self.rule_engine.matching_ids()),
+                         [(rule.field_name, rule.predicate, rule.value) for rule in rules])
+
+    def test_load_reads_every_email(self):
+        self.assertEqual(len(self.email_columns), 500)
+        self.assertEqual(int((self.email_columns.codes['cc'] < 0).sum()),
+                         session.query(Email).filter(Email.cc.is_(None)).count())
+
+    def test_string_columns_store_distinct_values_once(self):
+        email_columns = EmailColumns(['msg1', 'msg2', 'msg3', 'msg4'],
+                                     {'sender': ['a@example.com', None, 'b@example.com', 'a@example.com']})
+
+        self.assertEqual(email_columns.values['sender'].tolist(), ['a@example.com', 'b@example.com'])
+        self.assertEqual(email_columns.codes['sender'].tolist(), [0, -1, 1, 0])
+        self.assertEqual(email_columns.mask('sender', 'not', 'b@example.com').tolist(), [True, False, False, True])
+
+    def test_single_rules_match_sql(self):
+        for rule in self.RULES:
+            self.assert_parity([rule], 'all')
+
+    def test_rule_pairs_match_sql(self):
+        for rules in itertools.combinations(self.RULES, 2):
+            for collection_predicate in ('all', 'any'):
+                self.assert_parity(rules, collection_predicate)
+
+    def test_rule_files_match_sql(self):
+        for path in ('rules/mark_as_read_rule.json', 'rules/move_yt_or_mani.json'):
+            self.rule_engine.load_rules_from_json(path)
+            self.assert_parity(self.rule_engine.rules, self.rule_engine.collection_predicate)
+
+    def test_no_rules_match_nothing(self):
+        self.assert_parity([], 'any')
+
+    def test_filter_uses_email_columns(self):
+        self.rule_engine.rules = [Rule('subject', 'contains', 'alert')]
+        self.rule_engine.collection_predicate = 'all'
+
+        with patch.object(Email, 'iter_msg_ids') as mock_iter_msg_ids:
+            self.rule_engine.filter(self.email_columns)
+
+        mock_iter_msg_ids.assert_not_called()
+        self.assertEqual(self.rule_engine.filtered_email_ids, set(self.rule_engine.matching_ids()))
+
+    def test_null_columns_match_sql(self):
+        # e.g. a mailbox without Cc'd mail
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        with patch.object(session.registry(), 'bind', engine):
+            for email in random_emails(20):
+                email.cc = email.content = None
+                session.add(email)
+            session.commit()
+            self.email_columns = EmailColumns.load(columns=('cc', 'content'))
+
+            for rule in self.RULES:
+                if rule.field_name in ('cc', 'body'):
+                    self.assert_parity([rule], 'all')
+            session.close()
+
+    def test_contains_follows_the_like_of_sqlite(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        with patch.object(session.registry(), 'bind', engine):
+            emails = list(random_emails(200))
+            emails[0].subject = 'ALERT Ärger'
+            session.add_all(emails)
+            session.commit()
+            self.email_columns = EmailColumns.load(columns=('sender', 'subject', 'cc'))
+
+            self.assertFalse(self.email_columns.case_sensitive)
+            for rule in self.RULES + [Rule('subject', 'contains', 'ärger'), Rule('subject', 'contains', 'Ärger')]:
+                if rule.predicate == 'contains' and rule.field_name != 'body':
+                    self.assert_parity([rule], 'all')
+            session.close()
+
+    def test_contains_is_case_sensitive_like_postgresql(self):
+        email_columns = EmailColumns(['msg1', 'msg2'], {'subject': ['Alert', 'alert']})
+
+        self.assertEqual(email_columns.mask('subject', 'contains', 'alert').tolist(), [False, True])
+        email_columns.case_sensitive = False
+        self.assertEqual(email_columns.mask('subject', 'contains', 'alert').tolist(), [True, True])
+
+    def test_unknown_predicate_raises(self):
+        with self.assertRaises(ValueError):
+            self.email_columns.mask('subject', 'startswith', 'alert')
+
+
+if __name__ == '__main__':
+    unittest.main()
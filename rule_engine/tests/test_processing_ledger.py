@@ -0,0 +1,137 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import create_engine
+
+from email_manager.email_manager import ModifyResult
+from models.email import Base, Email, session
+from models.processing_ledger import AppliedAction, RuleSetRun
+from ..email_columns import EmailColumns
+from ..processing_ledger import ProcessingLedger
+from ..rule_runner import RuleRunner
+
+ALERT_RULES = {
+    'collection_predicate': 'all',
+    'rules': [{'field_name': 'subject', 'predicate': 'contains', 'value': 'alert'}],
+    'actions': [{'action_name': 'mark_as_read'}],
+}
+OLD_RULES = {
+    'collection_predicate': 'all',
+    'rules': [{'field_name': 'date_received', 'predicate': 'gt', 'value': '2d'}],
+    'actions': [{'action_name': 'move_to_label', 'action_value': 'Old'}],
+}
+
+
+class TestProcessingLedger(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+        rules_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(rules_dir.cleanup)
+        self.rules_dir = rules_dir.name
+        self.write_rules('alerts.json', ALERT_RULES)
+
+        self.email_manager = MagicMock()
+        self.email_manager.get_label_id.side_effect = lambda name: f'Label_{name}'
+        self.email_manager.batch_modify.side_effect = lambda msg_ids, **kwargs: [ModifyResult(list(msg_ids), None)]
+        self.synced_at = datetime.now() - timedelta(hours=1)
+
+    def write_rules(self, name, data):
+        with open(os.path.join(self.rules_dir, name), 'w') as f:
+            json.dump(data, f)
+
+    def add_emails(self, *msg_ids, subject='security alert', age=timedelta(hours=1)):
+        # every batch of emails is synced a minute after the previous one
+        self.synced_at += timedelta(minutes=1)
+        for msg_id in msg_ids:
+            session.add(Email(msg_id=msg_id, sender='alerts@google.com', subject=subject, recipient='me@example.com',
+                              content='', date_received=datetime.now() - age, synced_at=self.synced_at))
+        session.commit()
+
+    def run_rules(self, email_columns=None, full=False):
+        self.email_manager.batch_modify.reset_mock()
+        rule_runner = RuleRunner.from_directory(self.rules_dir, ledger=ProcessingLedger(full=full))
+        rule_runner.filter(email_columns() if email_columns else None)
+        rule_runner.perform_actions(self.email_manager)
+        return sorted(msg_id for args, _ in self.email_manager.batch_modify.call_args_list for msg_id in args[0])
+
+    def test_second_run_only_processes_new_emails(self):
+        for email_columns in (None, EmailColumns.load):
+            with self.subTest(in_memory=email_columns is not None):
+                session.query(Email).delete()
+                session.query(AppliedAction).delete()
+                session.query(RuleSetRun).delete()
+                session.commit()
+                self.add_emails('email1', 'email2')
+
+                self.assertEqual(self.run_rules(email_columns), ['email1', 'email2'])
+                self.assertEqual(self.run_rules(email_columns), [])
+
+                self.add_emails('email3')
+                self.assertEqual(self.run_rules(email_columns), ['email3'])
+
+    def test_run_only_reads_emails_past_the_watermark(self):
+        self.add_emails(*(f'old{i}' for i in range(20)))
+        self.run_rules()
+        self.add_emails('new1')
+
+        with patch.object(Email, 'iter_clause_values', wraps=Email.iter_clause_values) as mock_iter:
+            rule_runner = RuleRunner.from_directory(self.rules_dir, ledger=ProcessingLedger())
+            rule_runner.filter()
+            rows = list(Email.iter_clause_values(*mock_iter.call_args.args, **mock_iter.call_args.kwargs))
+
+        self.assertEqual([msg_id for msg_id, _ in rows], ['new1'])
+
+    def test_applied_emails_are_skipped_on_a_full_run(self):
+        self.add_emails('email1')
+        self.run_rules()
+
+        self.assertEqual(self.run_rules(full=True), [])
+
+    def test_changing_the_rule_file_applies_it_again(self):
+        self.add_emails('email1', 'email2')
+        self.run_rules()
+
+        self.write_rules('alerts.json', dict(ALERT_RULES, actions=[{'action_name': 'move_to_label',
+                                                                     'action_value': 'Alerts'}]))
+
+        self.assertEqual(self.run_rules(), ['email1', 'email2'])
+
+    def test_failed_emails_are_evaluated_again(self):
+        self.add_emails('email1', 'email2')
+        self.email_manager.batch_modify.side_effect = lambda msg_ids, **kwargs: [
+            ModifyResult(['email1'], None), ModifyResult(['email2'], Exception('rate limited'))]
+        self.run_rules()
+        self.email_manager.batch_modify.side_effect = lambda msg_ids, **kwargs: [ModifyResult(list(msg_ids), None)]
+
+        self.assertEqual(self.run_rules(), ['email2'])
+        self.assertEqual(self.run_rules(), [])
+
+    def test_emails_aging_into_a_rule_are_picked_up(self):
+        self.write_rules('alerts.json', OLD_RULES)
+        self.add_emails('old', age=timedelta(days=3))
+        self.add_emails('recent', age=timedelta(days=1, hours=12))
+        self.assertEqual(self.run_rules(), ['old'])
+
+        # a day passes, so the recent email is now older than 2 days without having been synced again
+        for email in session.query(Email):
+            email.date_received -= timedelta(days=1)
+        session.query(RuleSetRun).one().last_run_at -= timedelta(days=1)
+        session.commit()
+
+        self.assertEqual(self.run_rules(), ['recent'])
+        self.assertEqual(self.run_rules(EmailColumns.load), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
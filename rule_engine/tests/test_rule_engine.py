@@ -1,9 +1,15 @@
 import json
 import unittest
-from unittest.mock import MagicMock, call
-from ..rule_engine import RuleEngine
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+from ..rule_engine import Action, Rule, RuleEngine
 from unittest.mock import mock_open, patch
 
+from sqlalchemy import create_engine, event
+
+from email_manager.email_manager import ModifyResult
+from models.email import Base, Email, session
+
 class TestRuleEngine(unittest.TestCase):
 
     @patch('builtins.open', new_callable=mock_open, read_data=json.dumps({
@@ -13,6 +19,23 @@ class TestRuleEngine(unittest.TestCase):
     }))
     def setUp(self, mock_file):
         self.rule_engine = RuleEngine('rules.json')
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', self.engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+    def add_emails(self):
+        now = datetime.now()
+        for msg_id, subject, sender, age in [('email1', 'test one', 'sender1@example.com', timedelta(days=1)),
+                                             ('email2', 'a test', 'sender2@example.com', timedelta(days=5)),
+                                             ('email3', 'other', 'sender1@example.com', timedelta(days=5)),
+                                             ('email4', 'hello', 'sender3@example.com', timedelta(hours=1))]:
+            session.add(Email(msg_id=msg_id, subject=subject, sender=sender, recipient='me@example.com',
+                              content='', date_received=now - age, synced_at=now))
+        session.commit()
 
     @patch('rule_engine.rule_engine.Rule')
     @patch('rule_engine.rule_engine.Action')
@@ -30,51 +53,75 @@ class TestRuleEngine(unittest.TestCase):
         # Assert that the collection_predicate attribute was set correctly
         self.assertEqual(self.rule_engine.collection_predicate, 'all')
 
-    @patch('rule_engine.rule_engine.Email.filter')
-    def test_filter(self, mock_filter):
-        # Mock the filter method to return a predefined list of email IDs
-        mock_filter.return_value.all.return_value = [('email1',), ('email2',)]
+    def test_filter(self):
+        self.add_emails()
 
         # Call the filter method
         self.rule_engine.filter()
 
-        # Assert that the filter method was called with the correct arguments
-        mock_filter.assert_called_with(subject={'contains': 'test'})
-
         # Assert that the filtered_email_ids attribute was set correctly
         self.assertEqual(self.rule_engine.filtered_email_ids, set(['email1', 'email2']))
 
-    @patch('rule_engine.rule_engine.Action.perform')
-    def test_perform_action(self, mock_perform):
+    def test_filter_runs_one_query(self):
+        self.add_emails()
+        statements = []
+        listener = lambda conn, cursor, statement, parameters, *args: statements.append((statement, parameters))
+        event.listen(self.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute', listener)
+        self.rule_engine.rules = [Rule('subject', 'contains', 'test'), Rule('from', 'contains', 'sender1'),
+                                  Rule('date_received', 'lt', '2d')]
+        self.rule_engine.collection_predicate = 'any'
+
+        self.rule_engine.filter()
+
+        self.assertEqual(len(statements), 1)
+        statement, parameters = statements[0]
+        with self.engine.connect() as conn:
+            plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        # a single scan of the emails table, no subqueries or compound selects
+        self.assertEqual(len(plan), 1)
+        self.assertIn('emails', plan[0][-1])
+
+    def test_perform_action(self):
         # Set the filtered_email_ids attribute to a predefined list of email IDs
-        self.rule_engine.filtered_email_ids = ['email1', 'email2']
+        self.rule_engine.filtered_email_ids = ['email2', 'email1']
+        email_manager = MagicMock()
+        email_manager.batch_modify.return_value = [ModifyResult(['email1', 'email2'], None)]
 
         # Call the perform_action method
-        self.rule_engine.perform_action(None)
+        results = self.rule_engine.perform_action(email_manager)
+
+        # Assert that one batch modification was sent for all the email IDs
+        email_manager.batch_modify.assert_called_once_with(['email1', 'email2'], add_label_ids=[],
+                                                           remove_label_ids=['UNREAD'])
+        self.assertEqual(results, email_manager.batch_modify.return_value)
+
+    def test_perform_action_merges_actions(self):
+        self.rule_engine.actions = [Action('mark_as_read'), Action('move_to_label', 'Receipts'),
+                                    Action('move_to_label', 'Travel')]
+        self.rule_engine.filtered_email_ids = {'email1'}
+        email_manager = MagicMock()
+        email_manager.get_label_id.side_effect = {'Receipts': 'Label_1', 'Travel': 'Label_2'}.get
+
+        self.rule_engine.perform_action(email_manager)
+
+        email_manager.batch_modify.assert_called_once_with(['email1'], add_label_ids=['Label_1', 'Label_2'],
+                                                           remove_label_ids=['UNREAD'])
+
+    def test_perform_action_without_filtered_emails(self):
+        self.rule_engine.filtered_email_ids = set()
+        email_manager = MagicMock()
 
-        # Assert that the perform method was called for each email ID
-        calls = [call('email1', None), call('email2', None)]
-        mock_perform.assert_has_calls(calls)
+        self.assertEqual(self.rule_engine.perform_action(email_manager), [])
+        email_manager.batch_modify.assert_not_called()
 
-    @patch('rule_engine.rule_engine.Email.filter')
     @patch('builtins.open', new_callable=mock_open, read_data=json.dumps({
         'rules': [{'field_name': 'subject', 'predicate': 'contains', 'value': 'test'}, {'field_name': 'from', 'predicate': 'contains', 'value': 'sender1'}],
         'actions': [{'action_name': 'mark_as_read'}],
         'collection_predicate': 'all'
     }))
-    def test_filter_all_multiple_rules(self, file_mock, mock_filter):
-        # Mock the filter method to return different lists of email IDs for different rules
-        def side_effect(**kwargs):
-            mock_all = MagicMock()
-            if kwargs == {'subject': {'contains': 'test'}}:
-                mock_all.all.return_value = [('email1',), ('email2',)]
-            elif kwargs == {'sender': {'contains': 'sender1'}}:
-                mock_all.all.return_value = [('email1',)]
-            else:
-                mock_all.all.return_value = []
-            return mock_all
-
-        mock_filter.side_effect = side_effect
+    def test_filter_all_multiple_rules(self, file_mock):
+        self.add_emails()
         self.rule_engine.load_rules_from_json('rules.json')
 
         self.rule_engine.collection_predicate = 'all'
@@ -85,26 +132,14 @@ class TestRuleEngine(unittest.TestCase):
         # Assert that the filtered_email_ids attribute contains only the email IDs that are common to all rules
         self.assertEqual(self.rule_engine.filtered_email_ids, set(['email1']))
 
-    @patch('rule_engine.rule_engine.Email.filter')
     @patch('builtins.open', new_callable=mock_open, read_data=json.dumps({
         'rules': [{'field_name': 'subject', 'predicate': 'contains', 'value': 'test'},
                   {'field_name': 'from', 'predicate': 'contains', 'value': 'sender1'}],
         'actions': [{'action_name': 'mark_as_read'}],
         'collection_predicate': 'all'
     }))
-    def test_filter_any_multiple_rules(self, file_mock, mock_filter):
-        # Mock the filter method to return different lists of email IDs for different rules
-        def side_effect(**kwargs):
-            mock_all = MagicMock()
-            if kwargs == {'subject': {'contains': 'test'}}:
-                mock_all.all.return_value = [('email1',), ('email2',)]
-            elif kwargs == {'sender': {'contains': 'sender1'}}:
-                mock_all.all.return_value = [('email1',)]
-            else:
-                mock_all.all.return_value = []
-            return mock_all
-
-        mock_filter.side_effect = side_effect
+    def test_filter_any_multiple_rules(self, file_mock):
+        self.add_emails()
         self.rule_engine.load_rules_from_json('rules.json')
 
         self.rule_engine.collection_predicate = 'any'
@@ -113,7 +148,30 @@ class TestRuleEngine(unittest.TestCase):
         self.rule_engine.filter()
 
         # Assert that the filtered_email_ids attribute contains the email IDs that satisfy any of the rules
-        self.assertEqual(self.rule_engine.filtered_email_ids, set(['email1', 'email2']))
+        self.assertEqual(self.rule_engine.filtered_email_ids, set(['email1', 'email2', 'email3']))
+
+    def test_filter_date_received(self):
+        self.add_emails()
+        self.rule_engine.rules = [Rule('date_received', 'lt', '2d')]
+
+        self.rule_engine.filter()
+
+        self.assertEqual(self.rule_engine.filtered_email_ids, set(['email1', 'email4']))
+
+    def test_body_rules_need_content(self):
+        self.assertFalse(self.rule_engine.needs_content())
+
+        self.rule_engine.rules.append(Rule('body', 'matches', 'invoice'))
+
+        self.assertTrue(self.rule_engine.needs_content())
+
+    def test_filter_without_rules(self):
+        self.add_emails()
+        self.rule_engine.rules = []
+
+        self.rule_engine.filter()
+
+        self.assertEqual(self.rule_engine.filtered_email_ids, set())
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
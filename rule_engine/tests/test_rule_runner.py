@@ -0,0 +1,233 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, call, patch
+
+from google.auth.credentials import AnonymousCredentials
+from sqlalchemy import create_engine, event
+
+from email_manager.async_email_manager import AsyncEmailManager
+from email_manager.email_manager import EmailManager
+from email_manager.tests.fake_gmail_server import FakeGmailServer, make_message
+
+from models.email import Base, Email, session
+from ..email_columns import EmailColumns
+from ..processing_ledger import ProcessingLedger
+from ..rule_engine import Rule, RuleEngine
+from ..rule_runner import RuleRunner
+
+ALERT_RULES = {
+    'collection_predicate': 'all',
+    'rules': [{'field_name': 'from', 'predicate': 'contains', 'value': 'google.com'},
+              {'field_name': 'subject', 'predicate': 'contains', 'value': 'alert'}],
+    'actions': [{'action_name': 'mark_as_read'}, {'action_name': 'move_to_label', 'action_value': 'Alerts'}],
+}
+GOOGLE_RULES = {
+    'collection_predicate': 'any',
+    'rules': [{'field_name': 'from', 'predicate': 'contains', 'value': 'google.com'},
+              {'field_name': 'date_received', 'predicate': 'lt', 'value': '2d'}],
+    'actions': [{'action_name': 'move_to_label', 'action_value': 'Google'}],
+}
+
+
+class TestRuleRunner(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', self.engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+        now = datetime.now()
+        for msg_id, sender, subject, age in [('email1', 'alerts@google.com', 'security alert', 5),
+                                             ('email2', 'news@google.com', 'weekly digest', 5),
+                                             ('email3', 'friend@example.com', 'lunch', 1),
+                                             ('email4', 'friend@example.com', 'old alert', 5)]:
+            session.add(Email(msg_id=msg_id, sender=sender, subject=subject, recipient='me@example.com',
+                              content='', date_received=now - timedelta(days=age), synced_at=now))
+        session.commit()
+
+        rules_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(rules_dir.cleanup)
+        self.rules_dir = rules_dir.name
+        for name, data in [('1_alerts.json', ALERT_RULES), ('2_google.json', GOOGLE_RULES)]:
+            with open(os.path.join(self.rules_dir, name), 'w') as f:
+                json.dump(data, f)
+        self.rule_runner = RuleRunner.from_directory(self.rules_dir)
+
+        self.email_manager = MagicMock()
+        self.email_manager.get_label_id.side_effect = lambda name: f'Label_{name}'
+        self.email_manager.batch_modify.return_value = []
+
+    def filtered(self):
+        return [rule_engine.filtered_email_ids for rule_engine in self.rule_runner.rule_engines]
+
+    def test_from_directory_loads_files_in_name_order(self):
+        paths = [os.path.basename(rule_engine.rules_file_path) for rule_engine in self.rule_runner.rule_engines]
+
+        self.assertEqual(paths, ['1_alerts.json', '2_google.json'])
+
+    def test_unique_rules_shares_rules_between_files(self):
+        rules, engine_positions = self.rule_runner.unique_rules()
+
+        self.assertEqual([(rule.field_name, rule.value) for rule in rules],
+                         [('from', 'google.com'), ('subject', 'alert'), ('date_received', '2d')])
+        self.assertEqual(engine_positions, [[0, 1], [0, 2]])
+
+    def test_filter_matches_each_rule_file_alone(self):
+        expected = [set(RuleEngine(rule_engine.rules_file_path).filter().filtered_email_ids)
+                    for rule_engine in self.rule_runner.rule_engines]
+
+        self.rule_runner.filter()
+
+        self.assertEqual(self.filtered(), expected)
+        self.assertEqual(self.filtered(), [{'email1'}, {'email1', 'email2', 'email3'}])
+
+    def test_filter_runs_one_query_with_each_rule_once(self):
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute', listener)
+
+        self.rule_runner.filter()
+
+        self.assertEqual(len(statements), 1)
+        # every rule is selected once, and repeated once more in the WHERE clause
+        self.assertEqual(statements[0].count('LIKE'), 4)
+
+    def test_filter_in_memory_matches_sql(self):
+        self.rule_runner.filter()
+        expected = self.filtered()
+
+        self.rule_runner.filter(EmailColumns.load())
+
+        self.assertEqual(self.filtered(), expected)
+
+    def test_plan_label_changes_merges_deltas_per_email(self):
+        self.rule_runner.filter()
+
+        changes = self.rule_runner.plan_label_changes(self.email_manager)
+
+        self.assertEqual(changes, {
+            (('Label_Alerts', 'Label_Google'), ('UNREAD',)): ['email1'],
+            (('Label_Google',), ()): ['email2', 'email3'],
+        })
+
+    def test_plan_label_changes_later_file_wins(self):
+        rule_engines = self.rule_runner.rule_engines
+        rule_engines[0].filtered_email_ids = {'email1'}
+        rule_engines[1].filtered_email_ids = {'email1'}
+        with patch.object(rule_engines[1], 'plan_label_changes', return_value=(['UNREAD'], ['Label_Alerts'])):
+            changes = self.rule_runner.plan_label_changes(self.email_manager)
+
+        self.assertEqual(changes, {(('UNREAD',), ('Label_Alerts',)): ['email1']})
+
+    def test_run_syncs_once_and_batches_per_delta(self):
+        self.rule_runner.run(self.email_manager)
+
+        self.email_manager.sync_emails.assert_called_once_with(bodies=False)
+        self.email_manager.batch_modify.assert_has_calls([
+            call(['email1'], add_label_ids=['Label_Alerts', 'Label_Google'], remove_label_ids=['UNREAD']),
+            call(['email2', 'email3'], add_label_ids=['Label_Google'], remove_label_ids=[]),
+        ], any_order=True)
+        self.assertEqual(self.email_manager.batch_modify.call_count, 2)
+
+    def test_rule_files_without_rules_match_nothing(self):
+        self.rule_runner.rule_engines[0].rules = []
+        self.rule_runner.rule_engines[1].rules = [Rule('subject', 'contains', 'lunch')]
+
+        self.rule_runner.filter()
+
+        self.assertEqual(self.filtered(), [set(), {'email3'}])
+
+
+class TestBodyRules(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session.close()
+        bind_patcher = patch.object(session.registry(), 'bind', engine)
+        bind_patcher.start()
+        self.addCleanup(bind_patcher.stop)
+        self.addCleanup(session.close)
+
+        self.server = FakeGmailServer([make_message('msg001', body='<p>Invoice overdue</p>'),
+                                       make_message('msg002', body='<p>Lunch?</p>')]).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.server.labels.append({'id': 'Label_1', 'name': 'Finance', 'type': 'user'})
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            self.email_manager = EmailManager(api_endpoint=self.server.url)
+
+        rules_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(rules_dir.cleanup)
+        self.rules_dir = rules_dir.name
+
+    def write_rules(self, name, rules, actions):
+        with open(os.path.join(self.rules_dir, name), 'w') as f:
+            json.dump({'collection_predicate': 'all', 'rules': rules, 'actions': actions}, f)
+
+    def test_body_rules_match_emails_synced_without_bodies(self):
+        self.write_rules('1_hello.json', [{'field_name': 'subject', 'predicate': 'contains', 'value': 'Hello'}],
+                         [{'action_name': 'mark_as_read'}])
+        RuleRunner.from_directory(self.rules_dir, ledger=ProcessingLedger()).run(self.email_manager)
+        self.assertEqual(session.query(Email).filter(Email.content.is_(None)).count(), 2)
+
+        self.write_rules('2_invoices.json', [{'field_name': 'body', 'predicate': 'matches', 'value': 'invoice'}],
+                         [{'action_name': 'move_to_label', 'action_value': 'Finance'}])
+        rule_runner = RuleRunner.from_directory(self.rules_dir, ledger=ProcessingLedger())
+        rule_runner.run(self.email_manager)
+
+        self.assertEqual(rule_runner.rule_engines[1].filtered_email_ids, {'msg001'})
+        self.assertIn('Label_1', self.server.messages['msg001']['labelIds'])
+        self.assertNotIn('Label_1', self.server.messages['msg002']['labelIds'])
+
+
+class TestRunWithAsyncManager(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.rules_dir = tmp_dir.name
+        # a file database, as the rules are evaluated on worker threads, each with its own connection
+        engine = create_engine(f"sqlite:///{os.path.join(self.rules_dir, 'emails.db')}")
+        self.addCleanup(engine.dispose)
+        Base.metadata.create_all(engine)
+        session.close()
+        for patcher in (patch.object(session.registry(), 'bind', engine),
+                        patch.dict(session.session_factory.kw, {'bind': engine})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(session.close)
+
+        self.server = FakeGmailServer([make_message('msg001', subject='Security alert', sender='no-reply@google.com',
+                                                    body='<p>New sign-in</p>'),
+                                       make_message('msg002', subject='Lunch?')]).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.server.labels.append({'id': 'Label_1', 'name': 'Alerts', 'type': 'user'})
+        with open(os.path.join(self.rules_dir, 'alerts.json'), 'w') as f:
+            json.dump(ALERT_RULES, f)
+
+    async def test_rule_file_runs_end_to_end(self):
+        rule_runner = RuleRunner.from_directory(self.rules_dir, ledger=ProcessingLedger())
+        with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+            email_manager = AsyncEmailManager(api_endpoint=self.server.url, backoff=0)
+        async with email_manager:
+            results = await rule_runner.run_async(email_manager)
+
+        self.assertEqual([(result.msg_ids, result.error) for result in results], [(['msg001'], None)])
+        self.assertEqual(session.query(Email).count(), 2)
+        self.assertIn('Label_1', self.server.messages['msg001']['labelIds'])
+        self.assertNotIn('UNREAD', self.server.messages['msg001']['labelIds'])
+        self.assertIn('UNREAD', self.server.messages['msg002']['labelIds'])
+
+        # the ledger recorded the email as done, so the next run has nothing to apply
+        async with email_manager:
+            self.assertEqual(await RuleRunner.from_directory(self.rules_dir, ledger=ProcessingLedger())
+                             .run_async(email_manager), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,2 @@
+from .account_scheduler import Account
+from .account_scheduler import SyncScheduler
@@ -0,0 +1,305 @@
+"""
+account_scheduler.py
+
+This module contains the SyncScheduler class which syncs many mailboxes and applies their rules on a shared
+pool of worker threads.
+
+Classes:
+    Account: A mailbox to sync, with its credentials and the partition key its emails are stored under.
+    QuotaBucket: Tracks the Gmail quota units an account may spend.
+    AccountStats: The throughput and lag of an account over a run.
+    SyncScheduler: Interleaves the syncs of many accounts fairly on a shared pool of worker threads.
+
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from email_manager.email_manager import EmailManager
+from logger import logger
+from rule_engine.action_executor import OutboxDrain, OutboxExecutor
+from rule_engine.processing_ledger import ProcessingLedger
+from rule_engine.rule_runner import RuleRunner
+
+
+class Account:
+    """
+    A mailbox the scheduler syncs.
+
+    Attributes:
+        name (str): Identifies the account, and is the partition key its emails are stored under.
+        credentials_file (str): The path to the file containing the OAuth client credentials.
+        token_file (str): The path to the file containing the account's token.
+        rules_dir (str): The directory of the rule files applied to the account, or None to only sync it.
+        api_endpoint (str): The Gmail API root URL, or None for the public endpoint.
+        quota_units_per_second (int): The number of Gmail quota units the account spends per second at most.
+    """
+
+    # Gmail's per-user limit, see https://developers.google.com/gmail/api/reference/quota
+    DEFAULT_QUOTA_UNITS_PER_SECOND = 250
+
+    def __init__(self, name, credentials_file='credentials.json', token_file=None, rules_dir=None, api_endpoint=None,
+                 quota_units_per_second=DEFAULT_QUOTA_UNITS_PER_SECOND):
+        self.name = name
+        self.credentials_file = credentials_file
+        self.token_file = token_file or f'token_{name}.pickle'
+        self.rules_dir = rules_dir
+        self.api_endpoint = api_endpoint
+        self.quota_units_per_second = quota_units_per_second
+
+    @classmethod
+    def load_all(cls, accounts_file):
+        """
+        Loads the accounts listed in a JSON file, a list of objects with the Account attributes as keys.
+
+        Returns:
+            list: The accounts, in file order.
+        """
+        with open(accounts_file, 'r') as f:
+            return [cls(**config) for config in json.load(f)]
+
+
+class QuotaBucket:
+    """
+    Tracks the Gmail quota units an account may spend. The bucket refills at `rate` units per second
+    up to `capacity`. Units are taken after they were spent, which may leave the bucket below zero;
+    the account then waits until the bucket refills above zero.
+
+    Unlike the TokenBucket of AsyncEmailManager it never blocks: the scheduler runs another account's
+    work instead of waiting.
+
+    Attributes:
+        rate (float): The number of units added per second.
+        capacity (float): The largest number of units the bucket holds.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def available(self):
+        """
+        Returns the number of units in the bucket, negative while the account is over its quota.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            return self._tokens
+
+    def spend(self, units):
+        """
+        Takes the given number of units from the bucket.
+        """
+        self.available()
+        with self._lock:
+            self._tokens -= units
+
+    def wait_time(self):
+        """
+        Returns the number of seconds until the bucket is above zero again.
+        """
+        return max(0.0, -self.available() / self.rate)
+
+
+class AccountStats:
+    """
+    The work done for an account over a run of the scheduler.
+
+    Attributes:
+        name (str): The name of the account.
+        emails (int): The number of emails synced.
+        steps (int): The number of steps run on the worker pool.
+        quota_units (int): The number of Gmail quota units spent.
+        busy_seconds (float): The time the account's steps took on the worker threads.
+        started_at (float): When the first step of the account started, from time.monotonic().
+        finished_at (float): When the account was synced and its rules applied, from time.monotonic().
+        lag (float): The number of seconds from the start of the run until the account was done.
+        error (Exception): The error the account stopped on, if any.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.emails = 0
+        self.steps = 0
+        self.quota_units = 0
+        self.busy_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self.lag = None
+        self.error = None
+
+    @property
+    def throughput(self):
+        """
+        The number of emails synced per second, from the account's first step until it was done.
+        """
+        if self.started_at is None or self.finished_at is None or self.finished_at <= self.started_at:
+            return 0.0
+        return self.emails / (self.finished_at - self.started_at)
+
+    def __repr__(self):
+        return (f"AccountStats({self.name}: {self.emails} emails in {self.steps} steps, "
+                f"{self.throughput:.1f} emails/s, {self.quota_units} quota units, lag {self.lag:.2f}s"
+                + (f", failed: {self.error}" if self.error is not None else "") + ")")
+
+
+class SyncScheduler:
+    """
+    Syncs many accounts and applies their rules on a shared pool of worker threads. The sync of each
+    account is split into steps of `chunk_size` messages (EmailManager.sync_steps), followed by one step
+    filtering the emails with its rules and one applying the actions. Accounts take turns round-robin:
+    each turn runs one step of the next account, so a huge mailbox gets no more of the pool than a small
+    one and cannot hold the others back.
+
+    With `outbox`, the actions step only enqueues the label changes of the account to the outbox, under
+    its name, and a last step drains them, leaving the entries to retry for the next run or drain.
+
+    Each account spends Gmail quota through its own QuotaBucket. An account over its per-user quota is
+    skipped until the bucket refills, leaving the workers to the other accounts. An account has at most
+    one step running at a time; its EmailManager may still fetch with several threads within a step.
+
+    Attributes:
+        accounts (list): The accounts to sync.
+        workers (int): The number of worker threads shared by all the accounts.
+        chunk_size (int): The number of messages fetched per step.
+        full (bool): Whether to run full syncs and evaluate every email regardless of the rule watermarks.
+        manager_factory (callable): Builds the EmailManager of an account.
+        outbox (bool): Whether the label changes go through the outbox rather than straight to Gmail.
+        stats (dict): The AccountStats of each account name, for the last run.
+    """
+
+    def __init__(self, accounts, workers=4, chunk_size=100, full=False, manager_factory=None, outbox=False):
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        self.accounts = list(accounts)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.full = full
+        self.manager_factory = manager_factory or self.build_manager
+        self.outbox = outbox
+        self.stats = {}
+
+    @staticmethod
+    def build_manager(account):
+        """
+        Builds the EmailManager of an account, storing its emails under the account name.
+        """
+        return EmailManager(account.credentials_file, account.token_file, api_endpoint=account.api_endpoint,
+                            account=account.name)
+
+    def run(self):
+        """
+        Syncs every account and applies its rules, interleaving their steps on the worker pool.
+
+        Returns:
+            dict: The AccountStats of each account name.
+        """
+        run_started = time.monotonic()
+        self.stats = dict((account.name, AccountStats(account.name)) for account in self.accounts)
+        ready = deque(_AccountRun(account, self.manager_factory(account), self._steps) for account in self.accounts)
+        running = {}
+        logger.info(f"Syncing {len(ready)} accounts on {self.workers} workers")
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='account-sync') as executor:
+            while ready or running:
+                # one pass of the round robin: every account gets at most one step submitted
+                for _ in range(len(ready)):
+                    if len(running) >= self.workers:
+                        break
+                    account_run = ready.popleft()
+                    if account_run.bucket.available() <= 0:
+                        ready.append(account_run)
+                        continue
+                    running[executor.submit(self._run_step, account_run)] = account_run
+
+                # wake up for the first step done or, if nothing can run, the first bucket to refill
+                timeout = min((account_run.bucket.wait_time() for account_run in ready), default=None)
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout if ready and len(running) < self.workers else None,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    account_run = running.pop(future)
+                    if future.result():
+                        ready.append(account_run)
+                    else:
+                        stats = self.stats[account_run.account.name]
+                        stats.finished_at = time.monotonic()
+                        stats.lag = stats.finished_at - run_started
+
+        for stats in self.stats.values():
+            logger.info(f"{stats}")
+        return self.stats
+
+    def _steps(self, account, email_manager):
+        """
+        The steps of an account: its sync a chunk at a time, then its rules, then the drain of its outbox.
+
+        Yields:
+            int: The number of emails synced by each step.
+        """
+        rule_runner = None
+        if account.rules_dir:
+            rule_runner = RuleRunner.from_directory(account.rules_dir, account=account.name,
+                                                    ledger=ProcessingLedger(full=self.full, account=account.name))
+        bodies = rule_runner is not None and any(rule_engine.needs_content()
+                                                 for rule_engine in rule_runner.rule_engines)
+        yield from email_manager.sync_steps(full=self.full, bodies=bodies, chunk_size=self.chunk_size)
+        if bodies:
+            # the emails synced without their bodies earlier, which the rules could not match otherwise
+            yield email_manager.fetch_bodies()
+        if rule_runner is not None:
+            rule_runner.filter()
+            yield 0
+            executor = OutboxExecutor(account=account.name) if self.outbox else None
+            rule_runner.perform_actions(email_manager, executor)
+            yield 0
+            if self.outbox:
+                OutboxDrain(email_manager, account=account.name).drain(wait=False)
+                yield 0
+
+    def _run_step(self, account_run):
+        """
+        Runs the next step of an account on a worker thread and charges the quota it spent.
+
+        Returns:
+            bool: Whether the account has more steps to run.
+        """
+        stats = self.stats[account_run.account.name]
+        email_manager = account_run.email_manager
+        started = time.monotonic()
+        if stats.started_at is None:
+            stats.started_at = started
+        units = email_manager.quota_units
+        try:
+            stats.emails += next(account_run.steps)
+            more = True
+        except StopIteration:
+            more = False
+        except Exception as e:
+            logger.error(f"Account {account_run.account.name} failed: {e}")
+            stats.error = e
+            more = False
+        spent = email_manager.quota_units - units
+        account_run.bucket.spend(spent)
+        stats.quota_units += spent
+        stats.busy_seconds += time.monotonic() - started
+        stats.steps += more
+        return more
+
+
+class _AccountRun:
+    # an account being run by the scheduler: its manager, its steps and its quota bucket
+    def __init__(self, account, email_manager, steps):
+        self.account = account
+        self.email_manager = email_manager
+        self.steps = steps(account, email_manager)
+        self.bucket = QuotaBucket(account.quota_units_per_second)
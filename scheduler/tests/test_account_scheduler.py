@@ -0,0 +1,174 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from google.auth.credentials import AnonymousCredentials
+from sqlalchemy import create_engine, func
+
+from email_manager.email_manager import EmailManager
+from email_manager.tests.fake_gmail_server import FakeGmailServer, make_message
+from models.action_outbox import OutboxEntry
+from models.email import Base, Email, session
+from models.sync_state import SyncState
+from ..account_scheduler import Account, QuotaBucket, SyncScheduler
+
+ALERT_RULES = {
+    'collection_predicate': 'all',
+    'rules': [{'field_name': 'subject', 'predicate': 'contains', 'value': 'alert'}],
+    'actions': [{'action_name': 'mark_as_read'}],
+}
+
+
+class TestSyncScheduler(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+        # a file database, as the worker threads each open their own connection
+        engine = create_engine(f"sqlite:///{os.path.join(self.tmp_dir, 'emails.db')}")
+        self.addCleanup(engine.dispose)
+        Base.metadata.create_all(engine)
+        session.close()
+        for patcher in (patch.object(session.registry(), 'bind', engine),
+                        patch.dict(session.session_factory.kw, {'bind': engine})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(session.close)
+        self.servers = {}
+
+    def add_account(self, name, count, subject='Hello', latency=0, msg_prefix=None, **kwargs):
+        messages = [make_message(f'{msg_prefix or name}{i:04d}', subject=subject) for i in range(count)]
+        server = FakeGmailServer(messages, page_size=50, email_address=f'{name}@example.com').__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        server.latency = latency
+        self.servers[name] = server
+        return Account(name, api_endpoint=server.url, **kwargs)
+
+    def scheduler(self, accounts, **kwargs):
+        def build_manager(account):
+            with patch.object(EmailManager, 'get_credentials', return_value=AnonymousCredentials()):
+                return EmailManager(api_endpoint=account.api_endpoint, batch_size=None, account=account.name)
+        return SyncScheduler(accounts, manager_factory=build_manager, **kwargs)
+
+    def rules_dir(self, name):
+        rules_dir = os.path.join(self.tmp_dir, name)
+        os.mkdir(rules_dir)
+        with open(os.path.join(rules_dir, 'alerts.json'), 'w') as f:
+            json.dump(ALERT_RULES, f)
+        return rules_dir
+
+    def test_accounts_are_synced_into_their_partitions(self):
+        accounts = [self.add_account('alice', 30), self.add_account('bob', 20)]
+
+        stats = self.scheduler(accounts, workers=2, chunk_size=8).run()
+
+        counts = dict(session.query(Email.account, func.count()).group_by(Email.account))
+        self.assertEqual(counts, {'alice': 30, 'bob': 20})
+        self.assertEqual((stats['alice'].emails, stats['bob'].emails), (30, 20))
+        self.assertEqual(stats['alice'].steps, 4)
+        self.assertEqual(stats['alice'].quota_units, 1 + 5 + 30 * 5)
+        self.assertIsNotNone(SyncState.get('alice'))
+        self.assertIsNotNone(SyncState.get('bob'))
+
+    def test_small_accounts_are_not_starved(self):
+        accounts = [self.add_account('huge', 400, latency=0.002)]
+        accounts += [self.add_account(f'small{i}', 10, latency=0.002) for i in range(3)]
+
+        stats = self.scheduler(accounts, workers=2, chunk_size=10).run()
+
+        self.assertEqual(stats['huge'].emails, 400)
+        small_lag = max(stats[f'small{i}'].lag for i in range(3))
+        self.assertLess(small_lag, stats['huge'].lag / 4)
+
+    def test_quota_is_spent_per_account(self):
+        accounts = [self.add_account('limited', 60, quota_units_per_second=150), self.add_account('free', 60)]
+
+        started = time.monotonic()
+        stats = self.scheduler(accounts, workers=2, chunk_size=10).run()
+
+        # getProfile, two list pages and 60 gets, at 150 units per second with 150 to start with
+        self.assertEqual(stats['limited'].quota_units, 1 + 2 * 5 + 60 * 5)
+        self.assertGreater(time.monotonic() - started, 0.5)
+        self.assertLess(stats['free'].lag, stats['limited'].lag)
+
+    def test_rules_are_applied_to_each_account_alone(self):
+        accounts = [self.add_account('alice', 5, subject='security alert', rules_dir=self.rules_dir('alice_rules')),
+                    self.add_account('bob', 5, subject='security alert', rules_dir=self.rules_dir('bob_rules'))]
+        modified = []
+        batch_modify = EmailManager.batch_modify
+
+        def record_batch_modify(email_manager, msg_ids, **kwargs):
+            modified.append((email_manager.account, sorted(msg_ids)))
+            return batch_modify(email_manager, msg_ids, **kwargs)
+
+        with patch.object(EmailManager, 'batch_modify', autospec=True, side_effect=record_batch_modify):
+            self.scheduler(accounts, workers=2).run()
+
+        self.assertEqual(sorted(modified), [('alice', [f'alice{i:04d}' for i in range(5)]),
+                                            ('bob', [f'bob{i:04d}' for i in range(5)])])
+        self.assertTrue(all('UNREAD' not in message['labelIds'] for message in self.servers['bob'].messages.values()))
+
+    def test_outbox_entries_are_enqueued_and_drained_per_account(self):
+        accounts = [self.add_account('alice', 5, subject='security alert', rules_dir=self.rules_dir('alice_rules')),
+                    self.add_account('bob', 5, subject='security alert', rules_dir=self.rules_dir('bob_rules'))]
+
+        stats = self.scheduler(accounts, workers=2, outbox=True).run()
+
+        self.assertEqual(OutboxEntry.counts('alice'), {OutboxEntry.DONE: 5})
+        self.assertEqual(OutboxEntry.counts('bob'), {OutboxEntry.DONE: 5})
+        self.assertEqual(OutboxEntry.counts(), {})
+        for name in ('alice', 'bob'):
+            self.assertIsNone(stats[name].error)
+            self.assertTrue(all('UNREAD' not in message['labelIds']
+                                for message in self.servers[name].messages.values()))
+
+    def test_accounts_keep_their_own_copy_of_a_shared_message_id(self):
+        accounts = [self.add_account('alice', 5, msg_prefix='shared'), self.add_account('bob', 5, msg_prefix='shared')]
+        self.scheduler(accounts, workers=2).run()
+
+        self.servers['alice'].delete_message('shared0000')
+        self.scheduler(accounts, workers=2).run()
+
+        counts = dict(session.query(Email.account, func.count()).group_by(Email.account))
+        self.assertEqual(counts, {'alice': 4, 'bob': 5})
+        self.assertIsNotNone(Email.get_by_msg_id('shared0000', 'bob'))
+        self.assertIsNone(Email.get_by_msg_id('shared0000', 'alice'))
+
+    def test_failing_account_does_not_stop_the_others(self):
+        accounts = [self.add_account('alice', 10), self.add_account('broken', 10)]
+        self.servers['broken'].__exit__(None, None, None)
+
+        stats = self.scheduler(accounts, workers=2).run()
+
+        self.assertIsNotNone(stats['broken'].error)
+        self.assertEqual(stats['alice'].emails, 10)
+
+
+class TestQuotaBucket(unittest.TestCase):
+    def test_spending_past_zero_waits_for_the_refill(self):
+        bucket = QuotaBucket(rate=100)
+
+        bucket.spend(150)
+
+        self.assertLess(bucket.available(), 0)
+        self.assertAlmostEqual(bucket.wait_time(), 0.5, delta=0.05)
+
+
+class TestAccount(unittest.TestCase):
+    def test_load_all(self):
+        accounts_file = os.path.join(tempfile.mkdtemp(), 'accounts.json')
+        with open(accounts_file, 'w') as f:
+            json.dump([{'name': 'alice', 'token_file': 'alice.pickle', 'rules_dir': 'rules'}, {'name': 'bob'}], f)
+
+        accounts = Account.load_all(accounts_file)
+
+        self.assertEqual([(a.name, a.token_file, a.rules_dir) for a in accounts],
+                         [('alice', 'alice.pickle', 'rules'), ('bob', 'token_bob.pickle', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()